@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Time taken by clone_version with each copy strategy, and with dedup on.
+
+A strategy the filesystem or C library cannot do falls back to the stream copy, which shows in
+the strategy column. Run it with the temporary directory on the filesystem you care about
+(e.g. TMPDIR=/mnt/btrfs) to see reflinks.
+
+Usage: python benchmarks/bench_fastcopy.py [number of files] [MB per file]
+"""
+
+import sys, os, time, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import Silo
+
+RUNS = [("stream", {'copy_strategies':()}),
+        ("reflink", {'copy_strategies':("reflink",)}),
+        ("hardlink", {'copy_strategies':("hardlink",), 'copy_hardlinks':True}),
+        ("copy_file_range", {'copy_strategies':("copy_file_range",)}),
+        ("sendfile", {'copy_strategies':("sendfile",)}),
+        ("default", {}),
+        ("dedup", {'dedup':True})]
+
+def main(files=10, mb=20):
+    tmpdir = tempfile.mkdtemp()
+    block = os.urandom(1024 * 1024)
+    try:
+        print "%-16s %10s %12s  %s" % ("run", "clone (s)", "MB/s", "strategies")
+        for name, options in RUNS:
+            silo = Silo(os.path.join(tmpdir, name), manifest_fsync=False)
+            record = silo.get_item("bench")
+            for opt, value in options.items():
+                setattr(record, opt, value)
+            for i in range(files):
+                with open(os.path.join(tmpdir, "src.dat"), "wb") as f:
+                    for j in range(mb):
+                        f.write(block[:-1] + chr(i))
+                with open(os.path.join(tmpdir, "src.dat"), "rb") as f:
+                    record.put_stream("file%04d.dat" % i, f)
+            record.copy_stats.clear()
+            start = time.time()
+            record.clone_version(record.currentversion, "2")
+            taken = time.time() - start
+            print "%-16s %10.3f %12.1f  %s" % (name, taken, files * mb / taken, record.copy_stats.report())
+            shutil.rmtree(os.path.join(tmpdir, name))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:3]])
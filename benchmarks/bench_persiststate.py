@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Load and sync times of PersistentState for manifests of increasing size, per JSON backend.
+
+Usage: python benchmarks/bench_persiststate.py [repeats]
+"""
+
+import sys, os, time, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import persiststate
+from recordsilo.persiststate import PersistentState, SERIALISERS
+
+def make_manifest(versions):
+    m = {'item_id':'bench', 'currentversion':str(versions), 'versions':[], 'version_dates':{},
+         'files':{}, 'metadata_files':{}, 'subdir':{}, 'versionlog':{}, 'metadata':{}}
+    for v in range(1, versions+1):
+        v = str(v)
+        m['versions'].append(v)
+        m['version_dates'][v] = "2011-07-26T12:00:00.000000"
+        m['files'][v] = ["file%04d.dat" % i for i in range(20)]
+        m['metadata_files'][v] = ["mods.xml"]
+        m['subdir'][v] = []
+        m['versionlog'][v] = ["Added or updated file file%04d.dat" % i for i in range(20)]
+    return m
+
+def timeit(func, repeats):
+    start = time.time()
+    for i in range(repeats):
+        func()
+    return (time.time() - start) / repeats * 1000.0
+
+def main(repeats=20):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print "%-10s %9s %10s %10s %10s %16s %18s" % ("backend", "versions", "size (KB)", "load (ms)", "sync (ms)", "no-op sync (ms)",
+                                                     "tracked no-op (ms)")
+        for name in sorted(SERIALISERS):
+            for versions in [1, 10, 100, 300]:
+                ps = PersistentState(tmpdir, "bench.json", fsync=False, serialiser=name)
+                ps.state = make_manifest(versions)
+                ps.sync(force=True)
+                size = os.path.getsize(ps.filepath) / 1024.0
+                load = timeit(ps.revert, repeats)
+                sync = timeit(lambda: ps.sync(force=True), repeats)
+                noop = timeit(ps.sync, repeats)
+                tracked = PersistentState(tmpdir, "bench.json", fsync=False, serialiser=name, track_changes=True)
+                tracked_noop = timeit(tracked.sync, repeats)
+                print "%-10s %9d %10.1f %10.3f %10.3f %16.3f %18.3f" % (name, versions, size, load, sync, noop, tracked_noop)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
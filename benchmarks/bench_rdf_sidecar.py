@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Load times of RDFManifest for graphs of increasing size, parsing the RDF/XML against loading the sidecar,
+and the extra time sync() takes to write the sidecar.
+
+Usage: python benchmarks/bench_rdf_sidecar.py [repeats]
+"""
+
+import sys, os, time, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rdflib import URIRef, Literal
+
+from recordsilo.rdfmanifest import RDFManifest, sidecar_path
+
+URI = "http://example.org/item"
+
+def make_manifest(filepath, triples, sidecar):
+    m = RDFManifest(filepath, uri=URI, sidecar=sidecar)
+    item = URIRef(URI)
+    rows = []
+    for i in range(triples // 2):
+        part = URIRef("%s/file%05d.dat" % (URI, i))
+        rows.append((item, "ore:aggregates", part))
+        rows.append((part, "dcterms:title", Literal("File number %d" % i, lang="en")))
+    m.add_triples(rows)
+    return m
+
+def timeit(func, repeats):
+    start = time.time()
+    for i in range(repeats):
+        func()
+    return (time.time() - start) / repeats * 1000.0
+
+def main(repeats=5):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print "%9s %10s %12s %14s %8s %15s %15s" % ("triples", "rdf (KB)", "parse (ms)", "sidecar (ms)", "speedup", "sync (ms)", "sync+cache (ms)")
+        for triples in [10, 100, 1000, 10000]:
+            filepath = os.path.join(tmpdir, "manifest%d.rdf" % triples)
+            m = make_manifest(filepath, triples, False)
+            sync = timeit(lambda: m.sync(force=True), repeats)
+            m = make_manifest(filepath, triples, True)
+            sync_cached = timeit(lambda: m.sync(force=True), repeats)
+            assert os.path.isfile(sidecar_path(filepath))
+            size = os.path.getsize(filepath) / 1024.0
+            parse = timeit(lambda: RDFManifest(filepath, uri=URI, sidecar=False), repeats)
+            cached = timeit(lambda: RDFManifest(filepath, uri=URI), repeats)
+            print "%9d %10.1f %12.3f %14.3f %7.1fx %15.3f %15.3f" % (triples, size, parse, cached, parse / cached, sync, sync_cached)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Time to load an item, and to add a file to its current version, as its history grows, for the original
+single manifest layout and the split (per-version) layout.
+
+Usage: python benchmarks/bench_split_manifest.py [repeats]
+"""
+
+import sys, os, time, tempfile, shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import Silo
+
+FILES_PER_VERSION = 20
+
+def build_item(silo, item_id, versions):
+    record = silo.get_item(item_id)
+    for v in range(versions):
+        if v:
+            record.increment_version()
+        with record.batch():
+            for i in range(FILES_PER_VERSION):
+                record.put_stream("file%04d.dat" % i, "data")
+    return record
+
+def timeit(func, repeats):
+    start = time.time()
+    for i in range(repeats):
+        func()
+    return (time.time() - start) / repeats * 1000.0
+
+def main(repeats=20):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print "%-8s %9s %15s %10s %15s" % ("layout", "versions", "root size (KB)", "load (ms)", "load+put (ms)")
+        for versions in [1, 10, 100, 300]:
+            for split in [False, True]:
+                silo = Silo(os.path.join(tmpdir, "silo%d%s" % (versions, split and "s" or "")), manifest_fsync=False, split_manifest=split)
+                record = build_item(silo, "deephistory", versions)
+                size = os.path.getsize(os.path.join(record.itempath, "__manifest.json")) / 1024.0
+                load = timeit(lambda: silo.get_item("deephistory"), repeats)
+                def load_and_put():
+                    silo.get_item("deephistory").put_stream("extra.dat", "data")
+                put = timeit(load_and_put, repeats)
+                print "%-8s %9d %15.1f %10.3f %15.3f" % (split and "split" or "single", versions, size, load, put)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""Micro-benchmark of URIHelper term resolution with and without the term cache, and of
+ManifestHelper.add_triple, which resolves every term it is given.
+
+Usage: python benchmarks/bench_urihelper.py [iterations]
+"""
+
+import sys, os, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo.urihelper import URIHelper
+from recordsilo.manifesthelper import ManifestHelper
+
+TERMS = ["ore:aggregates", "dcterms:created", "dcterms:creator", "rdf:type",
+         "http://example.org/item/1", "info:item/1", "just some literal text"]
+
+def time_parse(helper, iterations):
+    start = time.time()
+    for i in xrange(iterations):
+        for term in TERMS:
+            helper.parse_uri(term, return_Literal_not_Exception=True)
+    return time.time() - start
+
+def time_add_triple(cache_size, iterations):
+    m = ManifestHelper(uri="info:bench")
+    m.urihelper.cache_size = cache_size
+    start = time.time()
+    for i in xrange(iterations):
+        m.add_triple("info:bench", "ore:aggregates", "info:bench/file%d" % (i % 100))
+    return time.time() - start
+
+def main(iterations=20000):
+    print "%-34s %12s %12s" % ("", "no cache (s)", "cached (s)")
+    print "%-34s %12.3f %12.3f" % ("parse_uri x %d" % (iterations * len(TERMS)),
+                                  time_parse(URIHelper(None, cache_size=0), iterations),
+                                  time_parse(URIHelper(None), iterations))
+    n = iterations / 10
+    print "%-34s %12.3f %12.3f" % ("ManifestHelper.add_triple x %d" % n,
+                                  time_add_triple(0, n), time_add_triple(4096, n))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -2,3 +2,4 @@ from silo import Silo, RDFSilo, Granary, SiloNotFound
 from records import HarvestedRecord, RDFRecord
 from persiststate import PersistentState
 from rdfmanifest import RDFManifest
+from asyncsilo import AsyncSilo, AsyncRecord
@@ -0,0 +1,249 @@
+"""Non-blocking access to a Silo for services that must not wait on the disc.
+
+Each call on an AsyncSilo or AsyncRecord is run in a bounded pool of worker threads and returns a
+future straight away; call result() on it (or add a done callback) to get the outcome. Calls on the
+same item are run one at a time, in the order they were made: while one is running the others wait
+in a queue for that item, and each is handed to the pool as the one before it finishes. A burst of
+calls on one item therefore takes up a single worker, and calls on other items go ahead alongside
+it. The queue of an item goes once it is empty, so a long running service does not keep one for
+every item it has ever touched.
+
+concurrent.futures is used if it is available (Python 3, or the `futures` backport on Python 2);
+otherwise a small equivalent built on multiprocessing.pool.ThreadPool is used.
+
+>>> silo = AsyncSilo(Silo("data/mysilo"), workers=16)
+>>> record = silo.get_item("item1").result()
+>>> uploads = [record.put_stream(name, chunks) for name, chunks in incoming]
+>>> [f.result() for f in uploads]"""
+
+from __future__ import with_statement
+
+import os
+
+import threading
+
+from collections import deque
+
+from contextlib import contextmanager
+
+from ingest import BUFFER_SIZE
+
+try:
+    from concurrent.futures import ThreadPoolExecutor, Future
+except ImportError:
+    ThreadPoolExecutor = Future = None
+    from multiprocessing.pool import ThreadPool
+
+WORKERS = 8
+
+class PoolFuture(object):
+    """The parts of concurrent.futures.Future that callers need, completed by PoolExecutor."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def _set(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._set(result=result)
+
+    def set_exception(self, exception):
+        self._set(exception=exception)
+
+    def set_running_or_notify_cancel(self):
+        # These cannot be cancelled
+        return True
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout) and not self._done.is_set():
+            raise RuntimeError("Timed out waiting for result")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout) and not self._done.is_set():
+            raise RuntimeError("Timed out waiting for result")
+        return self._exception
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+class PoolExecutor(object):
+    """submit()/shutdown() over multiprocessing.pool.ThreadPool, for when concurrent.futures is missing."""
+    def __init__(self, max_workers):
+        self._pool = ThreadPool(max_workers)
+
+    def submit(self, func, *args, **kw):
+        future = PoolFuture()
+        def run():
+            try:
+                result = func(*args, **kw)
+            except Exception, e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        self._pool.apply_async(run)
+        return future
+
+    def shutdown(self, wait=True):
+        self._pool.close()
+        if wait:
+            self._pool.join()
+
+def make_executor(workers):
+    if ThreadPoolExecutor is not None:
+        return ThreadPoolExecutor(max_workers=workers)
+    return PoolExecutor(workers)
+
+def make_future():
+    if Future is not None:
+        return Future()
+    return PoolFuture()
+
+class AsyncSilo(object):
+    """Wraps a Silo (or RDFSilo) so that its item operations run in a pool of worker threads."""
+    def __init__(self, silo, workers=WORKERS):
+        self.silo = silo
+        self._executor = make_executor(workers)
+        # {item_id: deque of (future, func, args, kw)} of the calls waiting on the one running for the item
+        self._queues = {}
+        self._queues_lock = threading.Lock()
+
+    def _submit_queued(self, item_id, func, *args, **kw):
+        """Run func in the pool once the calls already made on the item have finished. Returns a future."""
+        future = make_future()
+        with self._queues_lock:
+            queue = self._queues.get(item_id)
+            if queue is not None:
+                queue.append((future, func, args, kw))
+                return future
+            self._queues[item_id] = deque()
+        self._start(item_id, future, func, args, kw)
+        return future
+
+    def _start(self, item_id, future, func, args, kw):
+        while not future.set_running_or_notify_cancel():
+            # Cancelled while it waited
+            call = self._next_call(item_id)
+            if call is None:
+                return
+            future, func, args, kw = call
+        running = self._executor.submit(func, *args, **kw)
+        running.add_done_callback(lambda running: self._finished(item_id, future, running))
+
+    def _next_call(self, item_id):
+        with self._queues_lock:
+            queue = self._queues[item_id]
+            if queue:
+                return queue.popleft()
+            del self._queues[item_id]
+            return None
+
+    def _finished(self, item_id, future, running):
+        call = self._next_call(item_id)
+        if call is not None:
+            self._start(item_id, *call)
+        exception = running.exception()
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(running.result())
+
+    def get_item(self, item_id, date=None, force=False, startversion="1"):
+        """Future of an AsyncRecord for the item."""
+        def load():
+            return AsyncRecord(self.silo.get_item(item_id, date=date, force=force, startversion=startversion), self)
+        return self._submit_queued(item_id, load)
+
+    def exists(self, item_id):
+        return self._executor.submit(self.silo.exists, item_id)
+
+    def del_item(self, item_id):
+        return self._submit_queued(item_id, self.silo.del_item, item_id)
+
+    def list_items(self, prefix=None):
+        """Future of a list of the item ids (with the given prefix)."""
+        return self._executor.submit(lambda: list(self.silo.list_items(prefix)))
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+class AsyncRecord(object):
+    """Wraps a HarvestedRecord (or RDFRecord). Every public method of the record is available and runs in the
+    silo's worker pool in turn with the item's other calls, returning a future; attributes that are not methods (files,
+    versions, currentversion, ...) are read directly.
+
+    batch() is a plain context manager here too (see below). The record's lock() is not available, as the
+    calls it would have to cover run in other threads; open the silo with locking=True to have each call
+    lock the item."""
+    def __init__(self, record, async_silo):
+        self.record = record
+        self.async_silo = async_silo
+        self.item_id = record.item_id
+
+    def __getattr__(self, name):
+        if name == "lock":
+            raise AttributeError("lock() cannot be held over calls run in the worker pool")
+        attr = getattr(self.record, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        def call(*args, **kw):
+            return self.async_silo._submit_queued(self.item_id, attr, *args, **kw)
+        call.__name__ = name
+        call.__doc__ = attr.__doc__
+        return call
+
+    @contextmanager
+    def batch(self, flush_every=None, flush_interval=None):
+        """Defer the manifest writes of the calls made on the record during the block, as HarvestedRecord.batch
+        does, writing once when the block exits. The block is opened and closed in the worker pool, so the
+        futures of calls made inside it can be waited on there; with locking on, each call locks the item
+        for itself rather than the item being locked for the whole block."""
+        block = self.record._batch(flush_every, flush_interval)
+        self.async_silo._submit_queued(self.item_id, block.__enter__).result()
+        try:
+            yield self
+        finally:
+            self.async_silo._submit_queued(self.item_id, block.__exit__, None, None, None).result()
+
+    def read_chunks(self, filename, version=None, buffer_size=BUFFER_SIZE):
+        """Generator of futures of the successive buffer_size byte chunks of a file, as it was when its first
+        chunk was read (an empty file gives a single empty chunk). Each chunk is read as a call of its own, so
+        other calls on the item can go on between them. The size of the file is only known once the first
+        chunk has been read, so the generator waits on that before going on to the second."""
+        size = []
+        def first_chunk():
+            size.append(os.path.getsize(self.record._known_file(filename, version)))
+            return self.record.get_range(filename, 0, min(buffer_size, size[0]), version=version)
+        first = self.async_silo._submit_queued(self.item_id, first_chunk)
+        yield first
+        first.exception()
+        if not size:
+            return
+        for offset in xrange(buffer_size, size[0], buffer_size):
+            yield self.async_silo._submit_queued(self.item_id, self.record.get_range, filename, offset,
+                                                 min(buffer_size, size[0] - offset), version=version)
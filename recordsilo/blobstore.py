@@ -0,0 +1,109 @@
+from __future__ import with_statement
+
+import os
+
+import hashlib
+
+import thread
+
+from ingest import write_chunks, temp_path, BUFFER_SIZE
+
+import logging
+
+logger = logging.getLogger("BlobStore")
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+
+logger.addHandler(ch)
+
+BLOB_DIRNAME = "__blobs"
+
+class BlobStore(object):
+    """Content addressed store of file contents, keyed by SHA-256.
+
+    Blobs live at <dirpath>/<first two hex digits>/<digest> and are hard linked into the version
+    directories that hold them, so a blob whose link count has dropped to one is no longer used
+    by any version and can be removed. Blobs are shared, so they must never be written to in place."""
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+
+    def path(self, digest):
+        return os.path.join(self.dirpath, digest[:2], digest)
+
+    def _tmp_path(self):
+        if not os.path.isdir(self.dirpath):
+            os.makedirs(self.dirpath)
+        return os.path.join(self.dirpath, ".tmp-%d-%d" % (os.getpid(), thread.get_ident()))
+
+    def _commit(self, tmp_path, digest):
+        blob_path = self.path(digest)
+        if os.path.exists(blob_path):
+            # Identical content is already stored
+            os.remove(tmp_path)
+        else:
+            if not os.path.isdir(os.path.dirname(blob_path)):
+                os.makedirs(os.path.dirname(blob_path))
+            os.rename(tmp_path, blob_path)
+        return blob_path
+
+    def put(self, bytestream, buffer_size=BUFFER_SIZE, hashers=()):
+        """Store a string, file-like object or iterable of strings. Returns (digest, blob path, size).
+        Any hashers given are fed the data as well."""
+        tmp_path = self._tmp_path()
+        hasher = hashlib.sha256()
+        size = write_chunks(tmp_path, bytestream, buffer_size, [hasher] + list(hashers))
+        digest = hasher.hexdigest()
+        return digest, self._commit(tmp_path, digest), size
+
+    def put_file(self, filepath, buffer_size=BUFFER_SIZE):
+        """Store the contents of a file on disc. Returns (digest, blob path, size)."""
+        with open(filepath, "rb") as f:
+            return self.put(f, buffer_size)
+
+    def link(self, digest, target):
+        """Make target a hard link to a blob, replacing whatever was there."""
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        tmp_target = temp_path(target)
+        os.link(self.path(digest), tmp_target)
+        os.rename(tmp_target, target)
+
+    def is_blob(self, filepath, digest):
+        """True if filepath is (a link to) the blob with this digest."""
+        try:
+            return os.path.samefile(filepath, self.path(digest))
+        except OSError:
+            return False
+
+    def release(self, digest):
+        """Remove a blob if nothing links to it any more."""
+        blob_path = self.path(digest)
+        try:
+            if os.stat(blob_path).st_nlink <= 1:
+                os.remove(blob_path)
+                return True
+        except OSError:
+            pass
+        return False
+
+    def gc(self):
+        """Remove every blob that nothing links to. Returns the number of blobs removed."""
+        removed = 0
+        if not os.path.isdir(self.dirpath):
+            return removed
+        for fanout in os.listdir(self.dirpath):
+            fanout_dir = os.path.join(self.dirpath, fanout)
+            if not os.path.isdir(fanout_dir):
+                continue
+            for digest in os.listdir(fanout_dir):
+                if self.release(digest):
+                    removed += 1
+            if not os.listdir(fanout_dir):
+                os.rmdir(fanout_dir)
+        logger.debug("Removed %s unreferenced blobs from %s" % (removed, self.dirpath))
+        return removed
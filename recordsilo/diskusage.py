@@ -0,0 +1,65 @@
+"""In-process disc usage accounting, in place of shelling out to `du`.
+
+Symbolic links are counted as links and not followed, and a file reachable through several
+hard links is only counted once, so delta versions made of links to an earlier version
+add next to nothing."""
+
+import os
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def _walk_stats(dirpath):
+    """lstat results of dirpath and everything beneath it."""
+    if scandir is not None:
+        stack = [dirpath]
+        yield os.lstat(dirpath)
+        while stack:
+            d = stack.pop()
+            for entry in scandir(d):
+                st = entry.stat(follow_symlinks=False)
+                yield st
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+    else:
+        yield os.lstat(dirpath)
+        for root, dirs, files in os.walk(dirpath):
+            for name in dirs + files:
+                yield os.lstat(os.path.join(root, name))
+
+def tree_usage(dirpath, seen=None):
+    """(apparent size in bytes, allocated size in KB) of a directory tree.
+
+    seen is a set of (device, inode) pairs already counted; pass the same set in to a number
+    of calls to count files shared between the trees only once."""
+    if seen is None:
+        seen = set()
+    size = 0
+    blocks = 0
+    for st in _walk_stats(dirpath):
+        key = (st.st_dev, st.st_ino)
+        if key in seen:
+            continue
+        seen.add(key)
+        size += st.st_size
+        blocks += getattr(st, 'st_blocks', (st.st_size + 511) // 512)
+    # st_blocks is in 512 byte units; du -k rounds up to whole KB
+    return size, (blocks + 1) // 2
+
+def file_sizes(dirpath, exclude=None):
+    """{relative path: size} of the regular files beneath dirpath, skipping names for which
+    exclude(name) is true."""
+    sizes = {}
+    for root, dirs, files in os.walk(dirpath):
+        for name in files:
+            if exclude and exclude(name):
+                continue
+            filepath = os.path.join(root, name)
+            if os.path.isfile(filepath):
+                sizes[os.path.relpath(filepath, dirpath)] = os.path.getsize(filepath)
+    return sizes
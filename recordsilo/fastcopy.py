@@ -0,0 +1,163 @@
+"""Copying files between versions without pushing their contents through Python.
+
+fast_copy tries, in order, a reflink (FICLONE - a copy-on-write clone on btrfs, XFS and the like),
+a hard link (only if asked for, as the two names then share their contents), and the in-kernel
+copies copy_file_range(2) and sendfile(2), called from the C library through ctypes as Python 2's os
+module has neither. It returns None if none of them could be used, leaving the caller to copy the
+file the slow way."""
+
+import os
+
+import errno
+
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import ctypes, ctypes.util
+except ImportError:
+    ctypes = None
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+STRATEGIES = ("reflink", "hardlink", "copy_file_range", "sendfile")
+
+# Errors meaning "this filesystem / kernel / pair of paths cannot do that", as opposed to real failures
+UNSUPPORTED_ERRNOS = set([getattr(errno, name) for name in
+                          ("EXDEV", "EOPNOTSUPP", "ENOTSUP", "ENOTTY", "EINVAL", "ENOSYS", "EBADF", "EPERM", "EMLINK")
+                          if hasattr(errno, name)])
+
+CHUNK_SIZE = 1024 * 1024 * 8
+
+# Devices on which reflinks have been seen to fail, so they are not tried again
+_no_reflink_devices = set()
+
+def _libc_function(name, restype, argtypes):
+    """A function of the C library, or None if there is no such function (or no ctypes) here."""
+    if ctypes is None:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+if ctypes is not None:
+    _offset_p = ctypes.POINTER(ctypes.c_longlong)
+    # glibc 2.27 and later
+    _copy_file_range = _libc_function("copy_file_range", ctypes.c_ssize_t,
+                                      [ctypes.c_int, _offset_p, ctypes.c_int, _offset_p, ctypes.c_size_t, ctypes.c_uint])
+    # Linux only; the BSDs' sendfile takes other arguments, and sendfile64 takes a 64 bit offset everywhere
+    _sendfile = _libc_function("sendfile64", ctypes.c_ssize_t, [ctypes.c_int, ctypes.c_int, _offset_p, ctypes.c_size_t])
+else:
+    _copy_file_range = _sendfile = None
+
+def _checked(result):
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+class CopyStats(object):
+    """Number of files, bytes and seconds spent per copy strategy."""
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.strategies = {}
+
+    def add(self, strategy, size, seconds):
+        files, nbytes, total = self.strategies.get(strategy, (0, 0, 0.0))
+        self.strategies[strategy] = (files + 1, nbytes + size, total + seconds)
+
+    def report(self):
+        lines = []
+        for strategy in sorted(self.strategies):
+            files, nbytes, seconds = self.strategies[strategy]
+            lines.append("%s: %d files, %d bytes in %.3fs" % (strategy, files, nbytes, seconds))
+        return "; ".join(lines)
+
+    def __repr__(self):
+        return "<CopyStats %s>" % self.report()
+
+def _unsupported(e):
+    return getattr(e, 'errno', None) in UNSUPPORTED_ERRNOS
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "No fcntl on this platform")
+    with open(src, "rb") as s:
+        with open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+def hardlink(src, dst):
+    os.link(src, dst)
+
+def _kernel_copy(src, dst, copy):
+    with open(src, "rb") as s:
+        with open(dst, "wb") as d:
+            remaining = os.fstat(s.fileno()).st_size
+            offset = 0
+            while remaining > 0:
+                sent = copy(s.fileno(), d.fileno(), offset, min(remaining, CHUNK_SIZE))
+                if not sent:
+                    break
+                offset += sent
+                remaining -= sent
+
+def copy_file_range(src, dst):
+    if _copy_file_range is None:
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    def copy(i, o, offset, count):
+        return _checked(_copy_file_range(i, ctypes.byref(ctypes.c_longlong(offset)), o, ctypes.byref(ctypes.c_longlong(offset)), count, 0))
+    _kernel_copy(src, dst, copy)
+
+def sendfile(src, dst):
+    if _sendfile is None:
+        raise OSError(errno.ENOSYS, "sendfile is not available")
+    def copy(i, o, offset, count):
+        # The output is written at its current position, which follows the bytes sent so far
+        return _checked(_sendfile(o, i, ctypes.byref(ctypes.c_longlong(offset)), count))
+    _kernel_copy(src, dst, copy)
+
+_COPIERS = {"reflink":reflink, "hardlink":hardlink, "copy_file_range":copy_file_range, "sendfile":sendfile}
+
+def fast_copy(src, dst, hardlinks=False, strategies=STRATEGIES, stats=None):
+    """Copy the file src to dst (which must not exist) with the first strategy that works.
+    Returns the name of the strategy used, or None if the caller has to copy the file itself.
+    hard links are only made if hardlinks is True. If stats (a CopyStats) is given, the copy is counted in it."""
+    size = os.path.getsize(src)
+    for strategy in strategies:
+        if strategy == "hardlink" and not hardlinks:
+            continue
+        if strategy == "reflink" and os.stat(os.path.dirname(os.path.abspath(dst))).st_dev in _no_reflink_devices:
+            continue
+        start = time.time()
+        try:
+            _COPIERS[strategy](src, dst)
+        except (OSError, IOError), e:
+            if not _unsupported(e):
+                raise
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if strategy == "reflink":
+                _no_reflink_devices.add(os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+            continue
+        if strategy != "hardlink":
+            try:
+                os.chmod(dst, os.stat(src).st_mode & 07777)
+                os.utime(dst, (os.stat(src).st_atime, os.stat(src).st_mtime))
+            except OSError:
+                pass
+        if stats is not None:
+            stats.add(strategy, size, time.time() - start)
+        return strategy
+    return None
@@ -0,0 +1,98 @@
+"""Checksums of record files: computed while a file is being written, and checked again later.
+
+The digests of a file are kept as {'size': bytes, '<algorithm>': hexdigest, ...}, for any of the
+algorithms hashlib knows (md5, sha1, sha256, ...)."""
+
+import os
+
+import hashlib
+
+from collections import namedtuple
+
+from multiprocessing.pool import ThreadPool
+
+READ_BUFFER_SIZE = 1024 * 1024 * 4
+
+VERIFY_WORKERS = 4
+
+# found is the digests of the file as it is now, or None if it is missing
+Mismatch = namedtuple("Mismatch", "version filename expected found")
+
+def algorithm_list(algorithms):
+    """Normalise a single algorithm name or a sequence of them to a tuple, checking hashlib has them."""
+    if not algorithms:
+        return ()
+    if isinstance(algorithms, basestring):
+        algorithms = (algorithms,)
+    for name in algorithms:
+        hashlib.new(name)
+    return tuple(algorithms)
+
+class Hasher(object):
+    """Several digests of the same bytes, fed in one pass."""
+    def __init__(self, algorithms):
+        self.algorithms = algorithms
+        self.reset()
+
+    def reset(self):
+        self.hashes = [hashlib.new(name) for name in self.algorithms]
+        self.size = 0
+
+    def update(self, chunk):
+        for h in self.hashes:
+            h.update(chunk)
+        self.size += len(chunk)
+
+    def digests(self):
+        d = {'size':self.size}
+        for name, h in zip(self.algorithms, self.hashes):
+            d[name] = h.hexdigest()
+        return d
+
+def hash_file(filepath, algorithms, buffer_size=READ_BUFFER_SIZE):
+    hasher = Hasher(algorithms)
+    with open(filepath, "rb") as f:
+        chunk = f.read(buffer_size)
+        while chunk:
+            hasher.update(chunk)
+            chunk = f.read(buffer_size)
+    return hasher.digests()
+
+def _check(task):
+    filepath, expected, buffer_size = task
+    if not os.path.isfile(filepath):
+        return None
+    return hash_file(filepath, [k for k in sorted(expected) if k != 'size'], buffer_size)
+
+def _file_key(filepath, expected):
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return filepath
+    return (st.st_dev, st.st_ino, tuple(sorted(expected)))
+
+def verify_files(entries, workers=VERIFY_WORKERS, buffer_size=READ_BUFFER_SIZE):
+    """Re-hash files and compare them with their recorded digests.
+
+    entries - iterable of (version, filename, filepath, expected digests)
+    Returns a list of Mismatch. Files hard linked to each other are only read once."""
+    entries = [(entry, _file_key(entry[2], entry[3])) for entry in entries]
+    tasks = {}
+    for (version, filename, filepath, expected), key in entries:
+        if key not in tasks:
+            tasks[key] = (filepath, expected, buffer_size)
+    keys = tasks.keys()
+    if workers and workers > 1 and len(keys) > 1:
+        pool = ThreadPool(min(workers, len(keys)))
+        try:
+            found = dict(zip(keys, pool.map(_check, [tasks[k] for k in keys])))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        found = dict((k, _check(tasks[k])) for k in keys)
+    mismatches = []
+    for (version, filename, filepath, expected), key in entries:
+        if found[key] != expected:
+            mismatches.append(Mismatch(version, filename, expected, found[key]))
+    return mismatches
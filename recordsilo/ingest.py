@@ -0,0 +1,77 @@
+"""Writing incoming data to disc in chunks, so that the whole of a large upload is never held in memory
+and a partly written file never appears under its final name.
+
+Data may be given as a string, a file-like object with read(), or any iterable of strings (e.g. a
+generator reading from a socket)."""
+
+from __future__ import with_statement
+
+import os
+
+import re
+
+import thread
+
+BUFFER_SIZE = 1024 * 1024
+
+# Names made by temp_path
+TEMP_PATTERN = re.compile(r"\.\d+\.\d+\.part$")
+
+def iter_chunks(bytestream, buffer_size=BUFFER_SIZE):
+    """The data of a string, file-like object or iterable of strings, as a series of non-empty strings."""
+    if isinstance(bytestream, basestring):
+        if bytestream:
+            yield bytestream
+    elif hasattr(bytestream, 'read'):
+        try:
+            # Start from the beginning, if the stream allows it
+            bytestream.seek(0)
+        except:
+            pass
+        chunk = bytestream.read(buffer_size)
+        while chunk:
+            yield chunk
+            chunk = bytestream.read(buffer_size)
+    else:
+        for chunk in bytestream:
+            if chunk:
+                yield chunk
+
+def temp_path(filepath):
+    """Name to write filepath's data to before renaming it into place."""
+    return "%s.%d.%d.part" % (filepath, os.getpid(), thread.get_ident())
+
+def is_temp(name):
+    """True for a name made by temp_path, e.g. one left behind by a writer that crashed."""
+    return TEMP_PATTERN.search(name) is not None
+
+def write_chunks(filepath, bytestream, buffer_size=BUFFER_SIZE, hashers=(), fsync=False):
+    """Write the data to filepath in the given buffer size, feeding each chunk to the hashers.
+    Returns the number of bytes written. The file is removed if anything goes wrong."""
+    written = 0
+    try:
+        with open(filepath, "wb") as f:
+            for chunk in iter_chunks(bytestream, buffer_size):
+                f.write(chunk)
+                for hasher in hashers:
+                    hasher.update(chunk)
+                written += len(chunk)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+    except:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        raise
+    return written
+
+def write_atomic(filepath, bytestream, buffer_size=BUFFER_SIZE, hashers=(), fsync=False):
+    """As write_chunks, but writing to a temporary file alongside filepath and renaming it over filepath
+    once complete. The directory is made if need be."""
+    dirpath = os.path.dirname(filepath)
+    if dirpath and not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+    tmp_filepath = temp_path(filepath)
+    written = write_chunks(tmp_filepath, bytestream, buffer_size, hashers, fsync)
+    os.rename(tmp_filepath, filepath)
+    return written
@@ -0,0 +1,136 @@
+from __future__ import with_statement
+
+import os
+
+from os import path, rename
+
+from bisect import bisect_left
+
+from pairtree import id_encode, id_decode
+
+import logging
+
+logger = logging.getLogger("ItemIndex")
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+
+logger.addHandler(ch)
+
+ITEM_INDEX_FILENAME = "__item_index.log"
+
+class ItemIndex(object):
+    """Persistent index of the item ids held in a Silo.
+
+    The index is an append-only log of '+<id>' and '-<id>' lines (ids are pairtree encoded) which
+    is replayed into an in-memory set on load. rebuild() compacts the log from a fresh list of ids.
+
+    Other processes may share the log, so before answering the index checks whether the file has
+    grown since it was last read and replays the new lines, or reads it all again if it has been
+    replaced (rebuilt) since."""
+    def __init__(self, dirpath, filename=ITEM_INDEX_FILENAME):
+        self.filepath = path.join(dirpath, filename)
+        self._ids = set()
+        self._sorted = None
+        # (inode, bytes replayed) of the log as last read
+        self._read_upto = None
+        self.revert()
+
+    def is_persisted(self):
+        return path.isfile(self.filepath)
+
+    def revert(self):
+        """Replay the log on disc into memory."""
+        self._ids = set()
+        self._sorted = None
+        self._read_upto = None
+        if not path.isfile(self.filepath):
+            logger.debug("Item index %s has not been created yet" % self.filepath)
+            return
+        self._replay(0)
+
+    def _replay(self, offset):
+        """Replay the complete lines of the log from offset on."""
+        with open(self.filepath, "r") as logfile:
+            inode = os.fstat(logfile.fileno()).st_ino
+            logfile.seek(offset)
+            data = logfile.read()
+        # A line still being appended is left for next time
+        data = data[:data.rfind("\n") + 1]
+        for line in data.splitlines():
+            if not line:
+                continue
+            if line.startswith("+"):
+                self._ids.add(id_decode(line[1:]))
+            elif line.startswith("-"):
+                self._ids.discard(id_decode(line[1:]))
+            else:
+                logger.info("Ignoring malformed line in item index %s: %s" % (self.filepath, line))
+        self._read_upto = (inode, offset + len(data))
+        self._sorted = None
+
+    def refresh(self):
+        """Pick up whatever other processes have written to the log since it was last read."""
+        try:
+            st = os.stat(self.filepath)
+        except OSError:
+            return
+        if self._read_upto is None or st.st_ino != self._read_upto[0] or st.st_size < self._read_upto[1]:
+            self.revert()
+        elif st.st_size > self._read_upto[1]:
+            self._replay(self._read_upto[1])
+
+    def _append(self, op, item_id):
+        with open(self.filepath, "a") as logfile:
+            logfile.write("%s%s\n" % (op, id_encode(item_id)))
+
+    def add(self, item_id):
+        self.refresh()
+        if item_id not in self._ids:
+            self._append("+", item_id)
+            self._ids.add(item_id)
+            self._sorted = None
+
+    def remove(self, item_id):
+        self.refresh()
+        if item_id in self._ids:
+            self._append("-", item_id)
+            self._ids.discard(item_id)
+            self._sorted = None
+
+    def rebuild(self, item_ids):
+        """Replace the index with the given ids, writing a compacted log."""
+        ids = set(item_ids)
+        tmp_filepath = self.filepath + ".tmp"
+        with open(tmp_filepath, "w") as logfile:
+            for item_id in sorted(ids):
+                logfile.write("+%s\n" % id_encode(item_id))
+        rename(tmp_filepath, self.filepath)
+        self._ids = ids
+        self._sorted = None
+        self._read_upto = (os.stat(self.filepath).st_ino, os.path.getsize(self.filepath))
+
+    def sorted_ids(self):
+        self.refresh()
+        if self._sorted is None:
+            self._sorted = sorted(self._ids)
+        return self._sorted
+
+    def ids_with_prefix(self, prefix):
+        ids = self.sorted_ids()
+        i = bisect_left(ids, prefix)
+        while i < len(ids) and ids[i].startswith(prefix):
+            yield ids[i]
+            i += 1
+
+    def __contains__(self, item_id):
+        self.refresh()
+        return item_id in self._ids
+    def __len__(self):
+        self.refresh()
+        return len(self._ids)
+    def __iter__(self): return iter(self.sorted_ids())
@@ -0,0 +1,115 @@
+"""Advisory locks on items, shared between threads and processes.
+
+An ItemLock is an flock() on a lock file in the item's directory: shared ("r") for readers, exclusive
+("w") for writers. It is reentrant within a thread, so locked operations can call each other. A held "r"
+cannot be upgraded to "w": flock() would drop the shared lock while waiting for the exclusive one, so
+two readers upgrading at once would deadlock, and anything read under the "r" may have changed by the time
+the "w" is had. Asking for "w" while holding "r" raises LockUpgradeError; take "w" from the start instead.
+Where fcntl is not available only threads of this process are kept apart."""
+
+from __future__ import with_statement
+
+import os
+
+import time
+
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+LOCK_FILENAME = "__lock"
+
+# Seconds between attempts when waiting for a lock with a timeout
+POLL_INTERVAL = 0.01
+MAX_POLL_INTERVAL = 0.2
+
+class LockTimeout(Exception):
+    pass
+
+class LockUpgradeError(Exception):
+    pass
+
+def _poll(attempt, deadline):
+    """Call attempt() until it returns True or the deadline passes. Returns whether it succeeded."""
+    interval = POLL_INTERVAL
+    while not attempt():
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+    return True
+
+class ItemLock(object):
+    def __init__(self, dirpath, filename=LOCK_FILENAME):
+        self.filepath = os.path.join(dirpath, filename)
+        self.mode = None
+        self.depth = 0
+        self._fd = None
+        self._thread_lock = threading.RLock()
+
+    def _flock(self, mode, deadline):
+        if fcntl is None:
+            return True
+        op = fcntl.LOCK_EX
+        if mode == "r":
+            op = fcntl.LOCK_SH
+        if deadline is None:
+            fcntl.flock(self._fd, op)
+            return True
+        def attempt():
+            try:
+                fcntl.flock(self._fd, op | fcntl.LOCK_NB)
+                return True
+            except IOError:
+                return False
+        return _poll(attempt, deadline)
+
+    def acquire(self, mode="w", timeout=None):
+        """Take the lock in mode "r" (shared) or "w" (exclusive), waiting at most timeout seconds
+        (forever if None) before raising LockTimeout."""
+        if mode not in ("r", "w"):
+            raise ValueError("Lock mode must be 'r' or 'w'")
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        if deadline is None:
+            self._thread_lock.acquire()
+        elif not _poll(lambda: self._thread_lock.acquire(False), deadline):
+            raise LockTimeout("Timed out waiting for %s" % self.filepath)
+        try:
+            if not self.depth:
+                self._fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT, 0666)
+                if not self._flock(mode, deadline):
+                    raise LockTimeout("Timed out waiting for %s" % self.filepath)
+                self.mode = mode
+            elif mode == "w" and self.mode == "r":
+                raise LockUpgradeError("%s is held shared (\"r\") and cannot be upgraded to \"w\"" % self.filepath)
+        except:
+            if not self.depth and self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._thread_lock.release()
+            raise
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if not self.depth:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+            self.mode = None
+        self._thread_lock.release()
+
+    def held(self):
+        """True if this thread holds the lock."""
+        if self._thread_lock.acquire(False):
+            try:
+                return self.depth > 0
+            finally:
+                self._thread_lock.release()
+        return False
@@ -0,0 +1,321 @@
+"""Item manifest that keeps the per-version parts of the manifest in the version directories.
+
+In the original layout (1) an item's __manifest.json holds the file lists, version log, sizes and so on
+of every version, so loading an item parses its whole history. In the split layout (2) the root
+__manifest.json keeps the version list, cursor, dates, metadata and the like, while the VERSION_KEYS
+of each version are kept in __<version>/__version.json and are only read when that version is first
+looked at. manifest['files'][version] and the like work the same in either layout.
+
+Either layout is read whatever split is set to; split only decides the layout new items are given.
+Existing items are moved between layouts explicitly, with convert(). Going to layout 2 the root
+manifest (which then drops the per-version keys) is written after the version manifests, and going
+back the version manifests are only removed once the root manifest holds everything again, so an
+interrupted conversion leaves the old manifest in charge.
+
+The root and version manifests track their changes (see PersistentState), so records call mark_dirty()
+with the versions whose parts of the manifest they change in place, which spares sync() comparing the
+serialised manifests to find out; after a sync, synced_versions holds
+the versions written (or changed, in layout 1) by it, for listeners that only want to look at those."""
+
+from __future__ import with_statement
+
+import os
+
+import re
+
+from os import path
+
+from persiststate import PersistentState, BACKUP_SUFFIX
+
+import logging
+
+logger = logging.getLogger("ItemManifest")
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+
+logger.addHandler(ch)
+
+VERSION_MANIFEST_FILENAME = "__version.json"
+
+# The version manifest, its backup and the temp files left by an interrupted PersistentState.sync
+VERSION_MANIFEST_PATTERN = re.compile(r"^%s(%s|\.\d+\.\d+\.tmp)?$" % (re.escape(VERSION_MANIFEST_FILENAME), re.escape(BACKUP_SUFFIX)))
+
+# Per-version parts of the manifest, as {version: value}
+VERSION_KEYS = ('files', 'metadata_files', 'subdir', 'versionlog', 'sizes', 'blobs', 'checksums')
+
+# Lists every existing version is expected to have
+VERSION_DEFAULTS = ('files', 'metadata_files', 'subdir', 'versionlog')
+
+LAYOUT_KEY = "manifest_layout"
+SPLIT_LAYOUT = 2
+
+# {version: count of writes} in the root manifest, so that it changes whenever a version manifest does
+SERIALS_KEY = "version_serials"
+
+def is_version_manifest(name):
+    """True for the files that make up a version manifest in its version directory."""
+    return VERSION_MANIFEST_PATTERN.match(name) is not None
+
+class VersionMap(object):
+    """{version: value} view of one of the VERSION_KEYS, backed by the versions' own manifests."""
+    def __init__(self, manifest, key):
+        self.manifest = manifest
+        self.key = key
+
+    def __getitem__(self, version):
+        try:
+            return self.manifest.version_state(version)[self.key]
+        except KeyError:
+            raise KeyError(version)
+
+    def __setitem__(self, version, value):
+        self.manifest.version_state(version)[self.key] = value
+
+    def __delitem__(self, version):
+        try:
+            del self.manifest.version_state(version)[self.key]
+        except KeyError:
+            raise KeyError(version)
+
+    def __contains__(self, version):
+        return self.manifest.version_state(version).has_key(self.key)
+
+    has_key = __contains__
+
+    def get(self, version, default=None):
+        return self.manifest.version_state(version).get(self.key, default)
+
+    def setdefault(self, version, default=None):
+        state = self.manifest.version_state(version)
+        if not state.has_key(self.key):
+            state[self.key] = default
+        return state[self.key]
+
+    def pop(self, version, *default):
+        state = self.manifest.version_state(version)
+        if state.has_key(self.key):
+            value = state[self.key]
+            del state[self.key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(version)
+
+    def keys(self):
+        return [version for version in self.manifest.known_versions() if version in self]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(version, self[version]) for version in self.keys()]
+
+    def values(self):
+        return [self[version] for version in self.keys()]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class ItemManifest(PersistentState):
+    """PersistentState for an item's __manifest.json that reads and writes the split layout (see above).
+    With split True, a new (empty) manifest is set up in the split layout."""
+    def __init__(self, filepath=None, filename="__manifest.json", create=True, split=False, track_changes=True, **kw):
+        self.split = False
+        self._split_wanted = split
+        self._versions = {}
+        self._maps = dict((key, VersionMap(self, key)) for key in VERSION_KEYS)
+        self._touched = set()
+        # Versions covered by the last sync() that wrote anything; None if not known (nothing synced yet)
+        self.synced_versions = None
+        super(ItemManifest, self).__init__(filepath, filename, create, track_changes=track_changes, **kw)
+
+    def _version_dir(self, version):
+        return path.join(path.dirname(self.filepath), "__%s" % version)
+
+    def version_state(self, version):
+        """The PersistentState of a version's manifest, read from disc on first use."""
+        version = str(version)
+        state = self._versions.get(version)
+        if state is None:
+            state = PersistentState(fsync=self.fsync, keep_backup=self.keep_backup, serialiser=self.serialiser, compact=self.compact,
+                                    track_changes=self.track_changes)
+            # Set directly, as the version directory may not have been made yet
+            state.filepath = path.join(self._version_dir(version), VERSION_MANIFEST_FILENAME)
+            state.revert()
+            self._set_defaults(version, state)
+            self._versions[version] = state
+        return state
+
+    def _set_defaults(self, version, state):
+        if version in self.state.get('versions', []):
+            for key in VERSION_DEFAULTS:
+                if not state.has_key(key):
+                    state[key] = []
+
+    def known_versions(self):
+        versions = list(self.state.get('versions', []))
+        versions.extend([v for v in self._versions if v not in versions])
+        return versions
+
+    def loaded_versions(self):
+        """Versions whose manifests have been read."""
+        return self._versions.keys()
+
+    def revert(self):
+        result = super(ItemManifest, self).revert()
+        self._versions = {}
+        self._touched = set()
+        if self.state.get(LAYOUT_KEY) == SPLIT_LAYOUT:
+            self.split = True
+        else:
+            # Only a manifest that has not been set up yet starts out split
+            self.split = self._split_wanted and not self.state
+        return result
+
+    def convert(self, split):
+        """Move the manifest to the split layout (split True) or back to the original one, and write it out.
+        Returns True if the layout was changed."""
+        split = bool(split)
+        if split == self.split:
+            return False
+        if split:
+            self._migrate()
+            self.sync(force=True)
+            return True
+        versions = list(self.state.get('versions', []))
+        for key in VERSION_KEYS:
+            values = {}
+            for version in versions:
+                state = self.version_state(version)
+                if state.has_key(key):
+                    values[version] = state[key]
+            self.state[key] = values
+        self.state.pop(LAYOUT_KEY, None)
+        self.state.pop(SERIALS_KEY, None)
+        self.split = False
+        stale = self._versions
+        self._versions = {}
+        super(ItemManifest, self).sync(force=True)
+        # Only now that the root manifest holds everything again
+        for state in stale.itervalues():
+            for filepath in (state.filepath, state.backup_filepath()):
+                if path.isfile(filepath):
+                    os.remove(filepath)
+        return True
+
+    def _migrate(self):
+        """Move the per-version keys of a manifest in the original layout into (unsaved) version manifests."""
+        self.split = True
+        migrating = dict((key, self.state.pop(key)) for key in VERSION_KEYS if key in self.state)
+        if not migrating:
+            return
+        self.changed = True
+        logger.debug("Splitting the manifest at %s into per-version manifests" % self.filepath)
+        versions = set()
+        for values in migrating.itervalues():
+            versions.update(values.keys())
+        for version in versions:
+            state = self.version_state(version)
+            # The root manifest is what counts, over anything left by an interrupted migration
+            state.state = {}
+            for key, values in migrating.iteritems():
+                if values.has_key(version):
+                    state[key] = values[version]
+            self._set_defaults(version, state)
+
+    def mark_dirty(self, *versions):
+        """Note that the manifest has been changed in place, along with the per-version parts of it for these versions."""
+        self.changed = True
+        for version in versions:
+            version = str(version)
+            self._touched.add(version)
+            if self.split:
+                self.version_state(version).mark_dirty()
+
+    def is_dirty(self, exact=False):
+        if super(ItemManifest, self).is_dirty(exact):
+            return True
+        return any(state.is_dirty(exact) for state in self._versions.itervalues())
+
+    def sync(self, force=False):
+        """Write out any changed version manifests, and then the root manifest. Returns True if anything was written."""
+        written = False
+        synced = set(self._touched)
+        if self.split and self.filepath:
+            serials = self.state.setdefault(SERIALS_KEY, {})
+            for version, state in self._versions.iteritems():
+                if not (force or state.is_dirty()):
+                    continue
+                if not path.isdir(self._version_dir(version)):
+                    # Deleted (or renamed) since, taking its manifest with it
+                    continue
+                state.sync(force=force)
+                serials[version] = serials.get(version, 0) + 1
+                synced.add(version)
+                written = True
+                self.changed = True
+            for version in serials.keys():
+                if version not in self.state.get('versions', []):
+                    del serials[version]
+                    self.changed = True
+            if [key for key in self.state if key != SERIALS_KEY]:
+                if self.state.get(LAYOUT_KEY) != SPLIT_LAYOUT:
+                    self.state[LAYOUT_KEY] = SPLIT_LAYOUT
+                    self.changed = True
+            else:
+                # Leave a new item's manifest empty until it has been set up
+                del self.state[SERIALS_KEY]
+        if super(ItemManifest, self).sync(force=force) or written:
+            self.synced_versions = synced
+            self._touched = set()
+            return True
+        return False
+
+    def _set_version_key(self, key, values):
+        for version in self.known_versions():
+            state = self.version_state(version)
+            if state.has_key(key):
+                del state[key]
+        for version, value in values.iteritems():
+            self.version_state(version)[key] = value
+
+    # Dictionary methods
+    def keys(self):
+        keys = self.state.keys()
+        if self.split:
+            keys.extend(VERSION_KEYS)
+        return keys
+    def has_key(self, key):
+        if self.split and key in VERSION_KEYS:
+            return True
+        return self.state.has_key(key)
+    def get(self, key, default=None):
+        if self.split and key in VERSION_KEYS:
+            return self._maps[key]
+        return super(ItemManifest, self).get(key, default)
+    def items(self): return [(key, self[key]) for key in self.keys()]
+    def values(self): return [self[key] for key in self.keys()]
+    def __setitem__(self, key, item):
+        if self.split and key in VERSION_KEYS:
+            self._set_version_key(key, item)
+        else:
+            self.state[key] = item
+            self.changed = True
+    def __getitem__(self, key):
+        if self.split and key in VERSION_KEYS:
+            return self._maps[key]
+        return super(ItemManifest, self).__getitem__(key)
+    def __delitem__(self, key):
+        if self.split and key in VERSION_KEYS:
+            self._set_version_key(key, {})
+        else:
+            del self.state[key]
+            self.changed = True
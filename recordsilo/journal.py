@@ -0,0 +1,207 @@
+"""Append-only journal of the changes made to a silo's items, for consumers (indexers, replicators) that
+only want to process what has changed since they last looked.
+
+Each change is a line of JSON, [seq, time, item_id, version, op, filename], appended to the newest
+segment file in the silo's __journal directory. A new segment is started once the newest one reaches
+segment_size bytes; segments are named after the sequence number of their first entry, so changes(since)
+can skip straight to the segment it needs and old segments can be pruned. Appends are made under an
+flock() on the journal's lock file, so several processes can share a journal.
+
+The ops are "create_item", "put" and "del" (of a file), "new_version", "rename_version" (filename is then
+the old name of the version), "del_version" and "del_item". Entries are written once the change has been
+made on disc, but possibly before the item's manifest has been synced (see HarvestedRecord.batch), so
+consumers should read what they need from the item itself."""
+
+from __future__ import with_statement
+
+import os
+
+import threading
+
+from collections import namedtuple
+
+from datetime import datetime
+
+import simplejson
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import logging
+
+logger = logging.getLogger("Journal")
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+
+logger.addHandler(ch)
+
+JOURNAL_DIRNAME = "__journal"
+LOCK_FILENAME = "lock"
+SEGMENT_SUFFIX = ".log"
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# Bytes read at a time when looking backwards for the last entry of a segment
+TAIL_READ_SIZE = 4096
+
+Change = namedtuple("Change", "seq time item_id version op filename")
+
+def _parse(line):
+    """The Change on a line of a segment, or None if it is incomplete (cut short by a crash) or unreadable."""
+    if not line.endswith("\n"):
+        return None
+    try:
+        return Change(*simplejson.loads(line))
+    except (ValueError, TypeError):
+        return None
+
+class Journal(object):
+    def __init__(self, dirpath, dirname=JOURNAL_DIRNAME, segment_size=SEGMENT_SIZE, fsync=False):
+        self.dirpath = os.path.join(dirpath, dirname)
+        if not os.path.isdir(self.dirpath):
+            os.makedirs(self.dirpath)
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        # (segment path, size, last seq) as this journal last left them, to save re-reading the tail
+        self._tail = None
+
+    def _segment_path(self, first_seq):
+        return os.path.join(self.dirpath, "%020d%s" % (first_seq, SEGMENT_SUFFIX))
+
+    def segments(self):
+        """Sorted list of (first seq, path) of the journal's segments."""
+        segments = []
+        for name in os.listdir(self.dirpath):
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+                segments.append((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.dirpath, name)))
+        segments.sort()
+        return segments
+
+    def _flock(self):
+        fd = os.open(os.path.join(self.dirpath, LOCK_FILENAME), os.O_RDWR | os.O_CREAT, 0666)
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _unlock(self, fd):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _last_in_segment(self, filepath, first_seq):
+        """Seq of the last complete entry in a segment (first_seq - 1 if there is none) and whether the
+        segment ends part way through a line."""
+        with open(filepath, "rb") as segment:
+            segment.seek(0, os.SEEK_END)
+            end = segment.tell()
+            if not end:
+                return first_seq - 1, False
+            segment.seek(end - 1)
+            torn = segment.read(1) != "\n"
+            data = ""
+            pos = end
+            while pos > 0:
+                step = min(TAIL_READ_SIZE, pos)
+                pos -= step
+                segment.seek(pos)
+                data = segment.read(step) + data
+                lines = data.splitlines(True)
+                # The first line may be incomplete unless the start of the file has been reached
+                for line in reversed(lines[pos > 0 and 1 or 0:]):
+                    change = _parse(line)
+                    if change is not None:
+                        return change.seq, torn
+            return first_seq - 1, torn
+
+    def append(self, item_id, op, version=None, filename=None):
+        """Record a change, returning its sequence number."""
+        with self._lock:
+            fd = self._flock()
+            try:
+                segments = self.segments()
+                torn = False
+                if not segments:
+                    seq = 1
+                    filepath = self._segment_path(seq)
+                    size = 0
+                else:
+                    first_seq, filepath = segments[-1]
+                    size = os.path.getsize(filepath)
+                    if self._tail is not None and self._tail[:2] == (filepath, size):
+                        last_seq = self._tail[2]
+                    else:
+                        last_seq, torn = self._last_in_segment(filepath, first_seq)
+                    seq = last_seq + 1
+                    if size >= self.segment_size:
+                        filepath = self._segment_path(seq)
+                        size = 0
+                        torn = False
+                line = simplejson.dumps([seq, datetime.now().isoformat(), item_id, version, op, filename],
+                                        separators=(',', ':')) + "\n"
+                if torn:
+                    # Leave the remains of an interrupted append on a line of their own
+                    line = "\n" + line
+                out = os.open(filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+                try:
+                    os.write(out, line)
+                    if self.fsync:
+                        os.fsync(out)
+                finally:
+                    os.close(out)
+                self._tail = (filepath, size + len(line), seq)
+                return seq
+            finally:
+                self._unlock(fd)
+
+    def record_change(self, record, op, version=None, filename=None):
+        """Suitable as a record change listener."""
+        return self.append(record.item_id, op, version, filename)
+
+    def last_seq(self):
+        """Seq of the newest change in the journal (0 if it is empty)."""
+        segments = self.segments()
+        if not segments:
+            return 0
+        first_seq, filepath = segments[-1]
+        return self._last_in_segment(filepath, first_seq)[0]
+
+    def changes(self, since=0):
+        """Generator of the Changes with a seq greater than since, oldest first."""
+        segments = self.segments()
+        for index, (first_seq, filepath) in enumerate(segments):
+            if index + 1 < len(segments) and segments[index + 1][0] <= since + 1:
+                continue
+            try:
+                segment = open(filepath, "rb")
+            except IOError:
+                # Pruned since the segments were listed
+                continue
+            with segment:
+                for line in segment:
+                    change = _parse(line)
+                    if change is not None and change.seq > since:
+                        yield change
+
+    def prune(self, upto):
+        """Delete the segments holding only changes with a seq of upto or less. The newest segment is always kept.
+        Returns the number of segments deleted."""
+        with self._lock:
+            fd = self._flock()
+            try:
+                segments = self.segments()
+                deleted = 0
+                for index in range(len(segments) - 1):
+                    if segments[index + 1][0] - 1 > upto:
+                        break
+                    os.remove(segments[index][1])
+                    deleted += 1
+                return deleted
+            finally:
+                self._unlock(fd)
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Small bounded mapping that discards the least recently used entry when full.
+
+    Keeps hit and miss counts; callers that find an entry unusable should call discard()
+    and count it as a miss with miss()."""
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        # Least recently used first
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        if key in self._data:
+            value = self._data.pop(key)
+            self._data[key] = value
+            self.hits += 1
+            return value
+        self.misses += 1
+        return default
+
+    def miss(self):
+        """Turn the last hit into a miss (e.g. the cached value turned out to be stale)."""
+        self.hits -= 1
+        self.misses += 1
+
+    def put(self, key, value):
+        if key in self._data:
+            del self._data[key]
+        elif len(self._data) >= self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+        self._data[key] = value
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def info(self):
+        return {'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions,
+                'size':len(self._data), 'maxsize':self.maxsize}
+
+    def __contains__(self, key): return key in self._data
+    def __len__(self): return len(self._data)
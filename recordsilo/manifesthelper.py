@@ -18,6 +18,14 @@ class TextInputSource(InputSource, object):
         return self.url
 
 class ManifestHelper(object):
+    """Wraps an rdflib graph with helpers that accept shorthand (prefix:name) terms.
+
+    dirty is set by anything that changes the graph or its namespaces, and is cleared on reset,
+    on loading from a file and by whoever writes the graph out.
+
+    changes is (added, removed), the sets of triples added to and removed from the graph by these helpers
+    since it was loaded or last taken by take_changes(); it is None once get_graph() has handed the graph
+    out, as what is done with it then is not known."""
     def __init__(self, uri=None):
         self.uri = None
         if uri:
@@ -35,74 +43,116 @@ class ManifestHelper(object):
         #add defaults
         for prefix, ns in NAMESPACES.iteritems():
             self.add_namespace(prefix, ns)
+        self.dirty = False
+        self.changes = (set(), set())
+
+    def _added(self, triple):
+        if self.changes is not None and triple not in self.g:
+            added, removed = self.changes
+            if triple in removed:
+                removed.discard(triple)
+            else:
+                added.add(triple)
+
+    def _removing(self, pattern):
+        if self.changes is not None:
+            added, removed = self.changes
+            for triple in self.g.triples(pattern):
+                if triple in added:
+                    added.discard(triple)
+                else:
+                    removed.add(triple)
+
+    def take_changes(self):
+        """The changes made so far (see above), starting afresh."""
+        changes = self.changes
+        self.changes = (set(), set())
+        return changes
     
     def from_string(self, textfile, format="xml", encoding="utf-8"):
         self.reset()
         self.g.parse(textfile, format)
         return
     
-    def triple_exists(self, s, p, o):
-        if not type(self.g).__name__ in ['ConjunctiveGraph', 'Graph']:
-            return False        
-        if s == '*':
-            s = None
-        if p == '*':
-            p = None
-        if o == '*':
-            o = None
-
-        if not isinstance(s, URIRef) and not isinstance(s, BNode) and not s == None:
+    def _normalise_triple(self, s, p, o, wildcards=False):
+        """Turn the terms of a triple into rdflib terms. With wildcards, '*' and None are passed through as None."""
+        if wildcards:
+            if s == '*':
+                s = None
+            if p == '*':
+                p = None
+            if o == '*':
+                o = None
+
+        if not isinstance(s, URIRef) and not isinstance(s, BNode) and not (wildcards and s == None):
             s = self.urihelper.get_uriref(s)
         
-        if not isinstance(p, URIRef) and not p == None:
+        if not isinstance(p, URIRef) and not (wildcards and p == None):
             p = self.urihelper.parse_uri(p)
 
-        if not isinstance(o, URIRef) and not isinstance(o, Literal) and not isinstance(o, BNode) and not o == None:
+        if not isinstance(o, URIRef) and not isinstance(o, Literal) and not isinstance(o, BNode) and not (wildcards and o == None):
             if not isinstance(o, basestring):
                 o = unicode(o)
             o = self.urihelper.parse_uri(o, return_Literal_not_Exception=True)
+        return s, p, o
+
+    def triple_exists(self, s, p, o):
+        if not type(self.g).__name__ in ['ConjunctiveGraph', 'Graph']:
+            return False        
+        s, p, o = self._normalise_triple(s, p, o, wildcards=True)
              
-        count = 0
-        for ans_s, ans_p, ans_o in self.g.triples((s, p, o)):
-            count += 1
-        if count > 0:
+        for triple in self.g.triples((s, p, o)):
             return True
-        else:
-            return False 
-    
-    def list_objects(self, s, p):
-        objects = []
-        if not type(self.g).__name__ in ['ConjunctiveGraph', 'Graph']:
-            return objects
-        if s == '*':
-            s = None
-        if p == '*':
-            p = None
+        return False
 
-        if not isinstance(s, URIRef) and not isinstance(s, BNode) and not s == None:
-            s = self.urihelper.get_uriref(s)
-        
-        if not isinstance(p, URIRef) and not p == None:
-            p = self.urihelper.parse_uri(p)
+    def count_triples(self, s='*', p='*', o='*'):
+        """Number of triples matching the pattern. The graph's own length is used for a full wildcard."""
+        if not type(self.g).__name__ in ['ConjunctiveGraph', 'Graph']:
+            return 0
+        s, p, o = self._normalise_triple(s, p, o, wildcards=True)
+        if s is None and p is None and o is None:
+            return len(self.g)
+        count = 0
+        for triple in self.g.triples((s, p, o)):
+            count += 1
+        return count
 
+    def iter_objects(self, s, p):
+        """Generator over the objects of triples matching (s, p, *)."""
+        if not type(self.g).__name__ in ['ConjunctiveGraph', 'Graph']:
+            return
+        s, p, o = self._normalise_triple(s, p, None, wildcards=True)
         for o in self.g.objects(s, p):
-            objects.append(o)
-        return objects
+            yield o
+    
+    def list_objects(self, s, p):
+        return list(self.iter_objects(s, p))
     
     def add_triple(self, s, p, o):
-        if not isinstance(s, URIRef) and not isinstance(s, BNode):
-            s = self.urihelper.get_uriref(s)
-        
-        if not isinstance(p, URIRef):
-            p = self.urihelper.parse_uri(p)
-
-        if not isinstance(o, URIRef) and not isinstance(o, Literal) and not isinstance(o, BNode):
-            if not isinstance(o, basestring):
-                o = unicode(o)
-            o = self.urihelper.parse_uri(o, return_Literal_not_Exception=True)
+        s, p, o = self._normalise_triple(s, p, o)
+        if (s, p, o) in self.g:
+            return
 
+        self._added((s, p, o))
         self.g.add((s, p, o))
         self.g.commit()
+        self.dirty = True
+        return
+
+    def add_triples(self, triples):
+        """Add an iterable of (s, p, o) triples, normalising them in one pass and committing once."""
+        context = getattr(self.g, 'default_context', self.g)
+        quads = []
+        for s, p, o in triples:
+            s, p, o = self._normalise_triple(s, p, o)
+            if (s, p, o) in self.g:
+                continue
+            self._added((s, p, o))
+            quads.append((s, p, o, context))
+        if quads:
+            self.g.addN(quads)
+            self.g.commit()
+            self.dirty = True
         return
     
     def add_namespace(self, prefix, uri):
@@ -119,41 +169,54 @@ class ManifestHelper(object):
         if isinstance(uri, basestring) and not isinstance(uri, unicode):
             uri = unicode(uri)
 
-        self.namespaces[prefix] = self.urihelper.get_namespace(uri)
+        ns = self.urihelper.get_namespace(uri)
+        if self.namespaces.get(prefix) == ns:
+            return
+        self.namespaces[prefix] = ns
         if prefix not in self.urihelper.namespaces:
-            self.urihelper.namespaces[prefix] = self.urihelper.get_namespace(uri)
-        self.g.bind(prefix, self.namespaces[prefix])
+            self.urihelper.add_namespace(prefix, ns)
+        self.g.bind(prefix, ns)
+        self.dirty = True
         return
     
-    def del_namespace(self, prefix, ns):
+    def del_namespace(self, prefix, ns=None):
         if prefix in self.namespaces:
             del self.namespaces[prefix]
+            self.dirty = True
         return
     
     def del_triple(self, s, p, o=None):
         if not type(self.g).__name__ in ['ConjunctiveGraph', 'Graph']:
             return
-        if s == '*':
-            s = None
-        if p == '*':
-            p = None
-        if o == '*':
-            o = None
-
-        if not isinstance(s, URIRef) and not isinstance(s, BNode) and not s == None:
-            s = self.urihelper.get_uriref(s)
-        
-        if not isinstance(p, URIRef) and not p == None:
-            p = self.urihelper.parse_uri(p)
-
-        if not isinstance(o, URIRef) and not isinstance(o, Literal) and not isinstance(o, BNode) and not o == None:
-            if not isinstance(o, basestring):
-                o = unicode(o)
-            o = self.urihelper.parse_uri(o, return_Literal_not_Exception=True)
+        s, p, o = self._normalise_triple(s, p, o, wildcards=True)
+        if not any(True for _ in self.g.triples((s, p, o))):
+            return
+        self._removing((s, p, o))
         self.g.remove((s, p, o))
+        self.dirty = True
+        return
+
+    def del_triples(self, patterns):
+        """Remove every triple matching each of an iterable of (s, p, o) patterns ('*' or None as wildcards)."""
+        if not type(self.g).__name__ in ['ConjunctiveGraph', 'Graph']:
+            return
+        removed = False
+        for s, p, o in patterns:
+            s, p, o = self._normalise_triple(s, p, o, wildcards=True)
+            if not any(True for _ in self.g.triples((s, p, o))):
+                continue
+            self._removing((s, p, o))
+            self.g.remove((s, p, o))
+            removed = True
+        if removed:
+            self.g.commit()
+            self.dirty = True
         return
     
     def get_graph(self):
+        # The caller can change the graph directly, so assume it will
+        self.dirty = True
+        self.changes = None
         return self.g
     
     def to_string(self, format="xml"):
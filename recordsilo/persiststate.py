@@ -1,7 +1,29 @@
-from os import path, mkdir
+from __future__ import with_statement
+
+from os import path, mkdir, rename, remove, getpid
+import os
+
+from shutil import copy2
+
+import thread
 
 import simplejson
 
+try:
+    import json
+except ImportError:
+    json = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import logging
 
 logger = logging.getLogger("PersistentState")
@@ -17,11 +39,71 @@ logger.addHandler(ch)
 
 PERSISTENCE_FILENAME="persisted_state.json"
 
+BACKUP_SUFFIX=".bak"
+
+COMPACT_SEPARATORS=(',', ':')
+
+# Serialisers are (loads, dumps) pairs; dumps(obj, compact) must be deterministic for a given state
+# (keys are sorted) so that PersistentState can tell whether the state has changed since it was last
+# read or written by comparing the serialised text.
+SERIALISERS = {}
+SERIALISERS['simplejson'] = (simplejson.loads,
+                             lambda obj, compact: simplejson.dumps(obj, sort_keys=True, separators=compact and COMPACT_SEPARATORS or None))
+if json:
+    SERIALISERS['json'] = (json.loads,
+                           lambda obj, compact: json.dumps(obj, sort_keys=True, separators=compact and COMPACT_SEPARATORS or None))
+if ujson:
+    SERIALISERS['ujson'] = (ujson.loads,
+                            lambda obj, compact: ujson.dumps(obj, sort_keys=True))
+if orjson:
+    SERIALISERS['orjson'] = (orjson.loads,
+                             lambda obj, compact: orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode("utf-8"))
+
+# simplejson stays the default: it is what existing stores were written with, its C speedups load
+# faster than the stdlib json, and it hands back ASCII strings as str where the others give unicode.
+# Set this (or pass serialiser= to PersistentState) to use ujson or orjson for their speed.
+DEFAULT_SERIALISER = "simplejson"
+
+def file_signature(filepath=None, st=None):
+    """(inode, size, mtime) of a file, or None if it does not exist. Changes whenever the file is replaced
+    or rewritten, so it is used to tell if something else has written to a file since it was read."""
+    if st is None:
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
 class PersistentState(dict):
-    """Base class for the serialisation of the state of the harvest. Stores itself as JSON at the filepath given in the init phase."""
-    def __init__(self, filepath=None, filename=PERSISTENCE_FILENAME, create = True):
+    """Base class for the serialisation of the state of the harvest. Stores itself as JSON at the filepath given in the init phase.
+
+    Writes go to a temporary file which is renamed over the old one, so a crash never leaves a partly
+    written state file behind. fsync controls whether the data (and the directory entry) is flushed to
+    disc before the rename; bulk loads can turn it off for throughput. If keep_backup is True, the previous
+    generation is kept alongside as <filename>.bak and revert() falls back to it if the file cannot be read.
+
+    serialiser names one of the backends in SERIALISERS, and compact drops the whitespace from the output.
+    sync() does not touch the disc if the serialised state is the same as what was last read or written.
+
+    With track_changes set, the state counts as changed once it has been assigned to through the
+    dictionary methods or mark_dirty() has been called, so is_dirty() and sync() need not serialise it
+    to find out. A dict or list looked up from the state may be changed in place, so until the next
+    sync() or revert() the serialised state is compared as before, unless it has been marked as
+    changed anyway; a value kept from before a sync() must be looked up again to change it after."""
+    def __init__(self, filepath=None, filename=PERSISTENCE_FILENAME, create = True, fsync=True, keep_backup=False, serialiser=None, compact=False, track_changes=False):
         self.state = {}
         self.filepath = None
+        self.fsync = fsync
+        self.keep_backup = keep_backup
+        self.set_serialiser(serialiser or DEFAULT_SERIALISER)
+        self.compact = compact
+        self.track_changes = track_changes
+        self.changed = False
+        # A mutable value has been looked up since the state was last read or written
+        self.handed_out = False
+        self._last_serialised = None
+        self.disk_signature = None
+        self.recovered = False
         if filepath:
             self.set_filepath(filepath, filename, create)
         self.revert()
@@ -30,50 +112,181 @@ class PersistentState(dict):
         if path.isdir(filepath):
             logger.debug("Filepath exists - setting persistence file to %s" % path.join(filepath, filename))
             self.filepath = path.join(filepath, filename)
-            if create and not path.isfile(self.filepath):
+            # A missing file with a backup is left for revert() to recover, rather than started afresh
+            if create and not path.isfile(self.filepath) and not path.isfile(self.backup_filepath()):
                 self.sync()
             return True
         else:
             logger.info("Filepath does not exist - persistence file would not be able to be created")
             return False
     
+    def set_serialiser(self, name):
+        if name not in SERIALISERS:
+            raise ValueError("Unknown or unavailable JSON serialiser: %s" % name)
+        self.serialiser = name
+        self._loads, self._dumps = SERIALISERS[name]
+
+    def _read(self, filepath):
+        with open(filepath, "r") as serialised_file:
+            signature = file_signature(st=os.fstat(serialised_file.fileno()))
+            serialised = serialised_file.read()
+        state = self._loads(serialised)
+        if not isinstance(state, dict):
+            raise ValueError("Persisted state is not a JSON object")
+        return state, serialised, signature
+
+    def changed_on_disc(self):
+        """True if the file has been written by someone else since this state last read or wrote it."""
+        if not self.filepath:
+            return False
+        return file_signature(self.filepath) != self.disk_signature
+
+    def is_dirty(self, exact=False):
+        """True if the in-memory state differs from what was last read from or written to disc. With track_changes
+        a state marked as changed counts as dirty even if the change has since been undone; exact compares the
+        serialised state to make sure."""
+        if self.track_changes:
+            if self.changed and not exact:
+                return True
+            if not (self.changed or self.handed_out):
+                return False
+        return self._dumps(self.state, self.compact) != self._last_serialised
+
+    def mark_dirty(self):
+        """Note that a value held in the state has been changed in place."""
+        self.changed = True
+
+    def backup_filepath(self):
+        if self.filepath:
+            return self.filepath + BACKUP_SUFFIX
+
     def revert(self):
         """Revert the state to the version stored on disc."""
         if self.filepath:
+            self.recovered = False
+            self.handed_out = False
             if path.isfile(self.filepath):
-                with open(self.filepath, "r") as serialised_file:
-                    try:
-                        self.state = simplejson.load(serialised_file)
-                    except ValueError:
-                        logger.info("No JSON information could be read from the persistence file - could be empty: %s" % self.filepath)
+                try:
+                    self.state, self._last_serialised, self.disk_signature = self._read(self.filepath)
+                    self.changed = False
+                except ValueError:
+                    logger.info("No JSON information could be read from the persistence file - could be empty: %s" % self.filepath)
+                    if not self._recover_from_backup():
                         self.state = {}
-            else:
+                        self._last_serialised = None
+                        self.changed = True
+                        self.disk_signature = file_signature(self.filepath)
+            elif not self._recover_from_backup():
                 logger.debug("The persistence file has not yet been created or does not exist, so the state cannot be read from it yet.")
         else:
             logger.debug("Filepath to the persistence file is not set. State cannot be read.")
             return False
+
+    def _recover_from_backup(self):
+        backup = self.backup_filepath()
+        if not path.isfile(backup):
+            return False
+        try:
+            self.state, serialised, signature = self._read(backup)
+        except ValueError:
+            logger.error("The backup persistence file could not be read either: %s" % backup)
+            return False
+        # Not what is in the main file, so the next sync must write
+        self._last_serialised = None
+        self.changed = True
+        logger.warning("Recovered state from the backup persistence file %s" % backup)
+        self.recovered = True
+        return True
     
-    def sync(self):
-        """Synchronise and update the stored state to the in-memory state."""
+    def sync(self, force=False):
+        """Synchronise and update the stored state to the in-memory state. Nothing is written if the state
+        is unchanged since it was last read or written, unless force is True. Returns True if the file was written."""
         if self.filepath:
-            with open(self.filepath, "w") as serialised_file:
-                simplejson.dump(self.state, serialised_file)
+            if self.track_changes and not (force or self.changed or self.handed_out) and path.isfile(self.filepath):
+                logger.debug("State unchanged - not rewriting %s" % self.filepath)
+                return False
+            serialised = self._dumps(self.state, self.compact)
+            if not force and serialised == self._last_serialised and path.isfile(self.filepath):
+                logger.debug("State unchanged - not rewriting %s" % self.filepath)
+                self.changed = False
+                self.handed_out = False
+                return False
+            tmp_filepath = "%s.%d.%d.tmp" % (self.filepath, getpid(), thread.get_ident())
+            try:
+                with open(tmp_filepath, "w") as serialised_file:
+                    serialised_file.write(serialised)
+                    if self.fsync:
+                        serialised_file.flush()
+                        os.fsync(serialised_file.fileno())
+                if self.keep_backup and path.isfile(self.filepath):
+                    self._make_backup()
+                rename(tmp_filepath, self.filepath)
+                self._last_serialised = serialised
+                self.changed = False
+                self.handed_out = False
+                self.disk_signature = file_signature(self.filepath)
+            except:
+                if path.exists(tmp_filepath):
+                    remove(tmp_filepath)
+                raise
+            if self.fsync:
+                self._fsync_dir()
+            return True
         else:
             logger.info("Filepath to the persistence file is not set. State cannot be synced to disc.")
+            return False
+
+    def _make_backup(self):
+        # Hard link the current generation so that the file itself is never missing
+        backup = self.backup_filepath()
+        if path.exists(backup):
+            remove(backup)
+        try:
+            os.link(self.filepath, backup)
+        except (OSError, AttributeError):
+            copy2(self.filepath, backup)
+
+    def _fsync_dir(self):
+        try:
+            fd = os.open(path.dirname(self.filepath) or ".", os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        os.close(fd)
+
+    def _handing_out(self, value):
+        if self.track_changes and isinstance(value, (dict, list)):
+            self.handed_out = True
+        return value
 
     # Dictionary methods
     def keys(self): return self.state.keys()
     def has_key(self, key): return self.state.has_key(key)
-    def items(self): return self.state.items()
-    def values(self): return self.state.values()
-    def clear(self): self.state.clear()
+    def get(self, key, default=None): return self._handing_out(self.state.get(key, default))
+    def items(self):
+        if self.track_changes:
+            self.handed_out = True
+        return self.state.items()
+    def values(self):
+        if self.track_changes:
+            self.handed_out = True
+        return self.state.values()
+    def clear(self):
+        self.state.clear()
+        self.changed = True
     def update(self, kw):
         for key in kw:
             self.state[key] = kw[key]
-    def __setitem__(self, key, item): self.state[key] = item
+        self.changed = True
+    def __setitem__(self, key, item):
+        self.state[key] = item
+        self.changed = True
     def __getitem__(self, key):
         try:
-            return self.state[key]
+            return self._handing_out(self.state[key])
         except KeyError:
             raise KeyError(key)
     def __repr__(self): return repr(self.state)
@@ -83,5 +296,7 @@ class PersistentState(dict):
         else:
             return cmp(self.state, dict)
     def __len__(self): return len(self.state)
-    def __delitem__(self, key): del self.state[key]
+    def __delitem__(self, key):
+        del self.state[key]
+        self.changed = True
 
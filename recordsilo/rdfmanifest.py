@@ -1,10 +1,14 @@
 
 from __future__ import with_statement
 
-from os import path, mkdir
+from os import path, mkdir, rename, remove
 import codecs
+import marshal
+from rdflib import URIRef, Literal, BNode
 #from rdfobject.constructs import Manifest
 from manifesthelper import ManifestHelper
+from persiststate import file_signature
+from ingest import temp_path
 
 import logging
 
@@ -19,16 +23,100 @@ ch.setFormatter(formatter)
 
 logger.addHandler(ch)
 
+# The sidecar sits next to the RDF manifest of a version under this (reserved) name
+SIDECAR_FILENAME = "__rdfmanifest.cache"
+
+# Bumped whenever the layout of the sidecar changes, so that old sidecars are ignored
+SIDECAR_VERSION = 2
+
+URIREF_TERM, BNODE_TERM, LITERAL_TERM = range(3)
+
+def sidecar_path(filepath):
+    return path.join(path.dirname(filepath), SIDECAR_FILENAME)
+
+def is_sidecar(filename):
+    return filename == SIDECAR_FILENAME
+
+def _is_text(value, optional=False):
+    return isinstance(value, basestring) or (optional and value is None)
+
+def _check_sidecar(cached):
+    """Raise ValueError unless cached has the shape _write_sidecar gives it: nothing but tuples of plain values."""
+    if not (isinstance(cached, tuple) and len(cached) == 7):
+        raise ValueError("not a sidecar")
+    version, filename, format, signature, namespaces, terms, triples = cached
+    if not (version == SIDECAR_VERSION and _is_text(filename) and _is_text(format) and isinstance(signature, tuple)
+            and isinstance(namespaces, tuple) and isinstance(terms, tuple) and isinstance(triples, tuple)):
+        raise ValueError("not a sidecar")
+    for pair in namespaces:
+        if not (isinstance(pair, tuple) and len(pair) == 2 and _is_text(pair[0]) and _is_text(pair[1])):
+            raise ValueError("bad namespace in sidecar")
+    for encoded in terms:
+        if not (isinstance(encoded, tuple) and encoded and encoded[0] in (URIREF_TERM, BNODE_TERM, LITERAL_TERM)
+                and len(encoded) == (encoded[0] == LITERAL_TERM and 4 or 2) and _is_text(encoded[1])
+                and (encoded[0] != LITERAL_TERM or (_is_text(encoded[2], True) and _is_text(encoded[3], True)))):
+            raise ValueError("bad term in sidecar")
+    count = len(terms)
+    for row in triples:
+        if not (isinstance(row, tuple) and len(row) == 3 and all(isinstance(i, int) and 0 <= i < count for i in row)):
+            raise ValueError("bad triple in sidecar")
+
+def _encode_term(term):
+    if isinstance(term, Literal):
+        return (LITERAL_TERM, unicode(term), term.language, term.datatype and unicode(term.datatype))
+    if isinstance(term, BNode):
+        return (BNODE_TERM, unicode(term))
+    return (URIREF_TERM, unicode(term))
+
+def _decode_term(encoded):
+    if encoded[0] == LITERAL_TERM:
+        return Literal(encoded[1], lang=encoded[2], datatype=encoded[3])
+    if encoded[0] == BNODE_TERM:
+        return BNode(encoded[1])
+    return URIRef(encoded[1])
+
+def term_table(triples):
+    """(terms, [(s, p, o) as indexes into terms]) for the triples, with each distinct term encoded once."""
+    terms = []
+    index = {}
+    rows = []
+    for triple in triples:
+        row = []
+        for term in triple:
+            position = index.get(term)
+            if position is None:
+                position = index[term] = len(terms)
+                terms.append(_encode_term(term))
+            row.append(position)
+        rows.append(tuple(row))
+    return terms, rows
+
 class RDFManifest(ManifestHelper):
-    def __init__(self, filepath, format="xml", uri=None):
+    """The RDF manifest of a version of an item, kept in filepath in the given rdflib format.
+
+    Parsing RDF/XML is slow, so with sidecar set the graph is also written, as a marshalled table of its terms,
+    to a sidecar file alongside (see sidecar_path). revert() loads the graph from the sidecar instead of parsing,
+    as long as the sidecar was made from the file as it is now (same name, inode, size and mtime). Only tuples of
+    strings and numbers are read back, and anything else is rejected, so a sidecar cannot run code. The RDF
+    file remains the record of the graph; the sidecar is rewritten whenever it is found to be out of date."""
+    def __init__(self, filepath, format="xml", uri=None, sidecar=True):
         super(RDFManifest, self).__init__(uri)
         self.filepath = filepath
         self.format = format
+        self.sidecar = sidecar
+        self.disk_signature = None
+        self.synced_changes = None
         if path.isfile(self.filepath):
             logger.debug(self.filepath + " exists - loading rdf")
             self.revert()
 
+    def changed_on_disc(self):
+        return file_signature(self.filepath) != self.disk_signature
+
     def revert(self):
+        self.disk_signature = file_signature(self.filepath)
+        if self.sidecar and self._load_sidecar():
+            return
         try:
             self.from_string(self.filepath, self.format)
         except Exception, e:
@@ -36,10 +124,76 @@ class RDFManifest(ManifestHelper):
             logger.debug("RDFManifest was unable to read or parse file: %s in format: %s" % (self.filepath, self.format))
             logger.debug("This can happen if no triples have been added for this object.")
             logger.debug("Error: %s" % e)
-               
+        else:
+            if self.sidecar:
+                self._write_sidecar()
 
-    def sync(self):
-        with open(self.filepath, "w") as mfile:
-            m_str = self.to_string(self.format)
-            mfile.write(m_str)
+    def _load_sidecar(self):
+        """Load the graph from the sidecar if it matches the RDF file. Returns True if it was loaded."""
+        if self.disk_signature is None:
+            return False
+        try:
+            with open(sidecar_path(self.filepath), "rb") as sidecar_file:
+                cached = marshal.load(sidecar_file)
+            _check_sidecar(cached)
+            version, filename, format, signature, namespaces, terms, triples = cached
+            if filename != path.basename(self.filepath) or format != self.format or signature != tuple(self.disk_signature):
+                logger.debug("Sidecar of %s is out of date" % self.filepath)
+                return False
+            terms = [_decode_term(encoded) for encoded in terms]
+        except Exception, e:
+            # Missing, or written by something else
+            logger.debug("Could not use the sidecar of %s: %s" % (self.filepath, e))
+            return False
+        self.reset()
+        for prefix, namespace in namespaces:
+            self.g.bind(prefix, URIRef(namespace))
+        context = getattr(self.g, 'default_context', self.g)
+        self.g.addN([(terms[s], terms[p], terms[o], context) for s, p, o in triples])
+        self.dirty = False
+        return True
+
+    def _write_sidecar(self):
+        if self.disk_signature is None:
+            return
+        terms, triples = term_table(self.g)
+        cached = (SIDECAR_VERSION, path.basename(self.filepath), self.format, tuple(self.disk_signature),
+                  tuple((unicode(prefix), unicode(namespace)) for prefix, namespace in self.g.namespaces()),
+                  tuple(terms), tuple(triples))
+        filepath = sidecar_path(self.filepath)
+        tmp_filepath = temp_path(filepath)
+        try:
+            with open(tmp_filepath, "wb") as sidecar_file:
+                marshal.dump(cached, sidecar_file, 2)
+            rename(tmp_filepath, filepath)
+        except (IOError, OSError), e:
+            # Only a cache, so loading just stays slow
+            logger.debug("Could not write the sidecar of %s: %s" % (self.filepath, e))
+            if path.exists(tmp_filepath):
+                remove(tmp_filepath)
+
+    def sync(self, force=False):
+        """Serialise the graph to the manifest file, unless nothing has changed since it was loaded or last written.
+        Returns True if the file was written, leaving the changes it wrote out (see ManifestHelper) in synced_changes."""
+        if not (force or self.dirty) and path.isfile(self.filepath):
+            logger.debug("RDFManifest unchanged - not rewriting %s" % self.filepath)
+            return False
+        # Written alongside and renamed into place, so a file hard linked into other versions is left alone.
+        # Named as put_stream names its temp files, so that one left by a crash is not taken for content
+        tmp_filepath = temp_path(self.filepath)
+        try:
+            with open(tmp_filepath, "w") as mfile:
+                m_str = self.to_string(self.format)
+                mfile.write(m_str)
+            rename(tmp_filepath, self.filepath)
+        except:
+            if path.exists(tmp_filepath):
+                remove(tmp_filepath)
+            raise
+        self.dirty = False
+        self.synced_changes = self.take_changes()
+        self.disk_signature = file_signature(self.filepath)
+        if self.sidecar:
+            self._write_sidecar()
+        return True
 
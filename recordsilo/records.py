@@ -2,14 +2,28 @@
 
 from __future__ import with_statement
 
-from persiststate import PersistentState
-from rdfmanifest import RDFManifest
+from itemmanifest import ItemManifest, is_version_manifest
+from rdfmanifest import RDFManifest, is_sidecar
+from diskusage import tree_usage, file_sizes
+from blobstore import BlobStore, BLOB_DIRNAME
+from fastcopy import fast_copy, CopyStats, STRATEGIES
+from ingest import write_atomic, temp_path, is_temp, BUFFER_SIZE
+from itemlock import ItemLock
+from fixity import algorithm_list, Hasher, hash_file, verify_files, VERIFY_WORKERS, READ_BUFFER_SIZE
 
 from pairtree import id_encode, id_decode, ppath
 from pairtree import FileNotFoundException, ObjectNotFoundException
 
 from datetime import datetime
 
+from contextlib import contextmanager
+
+import time
+
+import hashlib
+
+import mmap
+
 #from os import mkdir, rename
 
 import os
@@ -39,17 +53,94 @@ PAIRTREE_ROOT_DIR = "pairtree_root"
 
 NAMASTE_PATTERN = re.compile(r"[^0=|1=|2=|3=|4=|5=]")  # Must try hard to better this regex
 
+NAMASTE_PREFIXES = ("0=", "1=", "2=", "3=", "4=", "5=")
+
+def _is_bookkeeping(name):
+    """True for the files in a version directory that are not part of the item's content (NAMASTE tags, the version
+    manifest with its backup and temp files, the RDF manifest's sidecar - see rdfmanifest - and partly written files
+    left by put_stream)."""
+    return name[:2] in NAMASTE_PREFIXES or is_version_manifest(name) or is_sidecar(name) or is_temp(name)
+
+def _locked(method):
+    """Run a method that changes the item under the record's write lock, if locking is on."""
+    def locked_method(self, *args, **kw):
+        if not self.locking:
+            return method(self, *args, **kw)
+        with self.lock("w"):
+            return method(self, *args, **kw)
+    locked_method.__name__ = method.__name__
+    locked_method.__doc__ = method.__doc__
+    return locked_method
+
 class HarvestedRecord(object):
-    """Convenience class, handling the persistence of some basic metadata about a harvest item, as well as organising the items files, metadata or otherwise."""
-    def __init__(self, pairtree_object, date=None, manifest_filename="__manifest.json", startversion="1"):
+    """Convenience class, handling the persistence of some basic metadata about a harvest item, as well as organising the items files, metadata or otherwise.
+
+    With dedup set, the contents of files written to the item are kept once each in a store under __blobs,
+    keyed by SHA-256, and the version directories hold hard links to them. Cloning a version then only
+    makes links, and blobs are removed once no version refers to them.
+
+    Otherwise files are copied between versions by reflink or in-kernel copy where the filesystem allows
+    (see recordsilo.fastcopy), or by hard link if copy_hardlinks is set - only do that for data that is
+    never changed in place. copy_stats counts the files, bytes and time taken per strategy.
+
+    checksums is a hashlib algorithm name, or a list of them, to hash files with as they are written.
+    The digests and size of each file are kept in manifest['checksums'][version][filename]; see verify().
+
+    buffer_size is the size of the chunks that put_stream reads and writes by default.
+
+    With locking set, every method that changes the item runs under an exclusive lock on the item, shared
+    by threads and processes (see recordsilo.itemlock), waiting at most lock_timeout seconds for it. On taking
+    the lock the manifest is read again if another writer has changed it. Changes made outside a locked method
+    and not yet synced are kept over the other writer's, so group them in a batch(), which holds the lock
+    throughout.
+
+    With split_manifest set, the file lists, logs, sizes and checksums of each version are kept in a manifest
+    in the version's directory, read only when that version is used, so loading an item with a long history
+    does not parse all of it (see recordsilo.itemmanifest). This only applies to items created with it set;
+    either layout is read regardless, and set_manifest_layout() moves an existing item between them.
+
+    With track_sizes set, the manifest keeps the size of every file and a byte total per version, kept up to
+    date as files are written, so that stored_bytes() and file_size() do not need to look at the disc.
+    Otherwise they look, and the counters of any version that changes are dropped."""
+    def __init__(self, pairtree_object, date=None, manifest_filename="__manifest.json", startversion="1", manifest_fsync=True, manifest_backup=False, manifest_serialiser=None, dedup=False, copy_hardlinks=False, copy_strategies=STRATEGIES, checksums=None, buffer_size=BUFFER_SIZE, locking=False, lock_timeout=None, split_manifest=False, track_sizes=False):
         self.po = pairtree_object
         self.item_id = self.po.id
         self.uri = self.po.uri
         self.manifest_filename = manifest_filename
+        self.manifest_fsync = manifest_fsync
+        self.manifest_backup = manifest_backup
+        self.manifest_serialiser = manifest_serialiser
+        self.dedup = dedup
+        self.copy_hardlinks = copy_hardlinks
+        self.copy_strategies = copy_strategies
+        self.copy_stats = CopyStats()
+        self.checksum_algorithms = algorithm_list(checksums)
+        self.buffer_size = buffer_size
+        self.locking = locking
+        self.lock_timeout = lock_timeout
+        self.split_manifest = split_manifest
+        self.track_sizes = track_sizes
+        # Called with the record after each write of its manifest
+        self.sync_listeners = []
+        # Called with (record, op, version, filename) after each change to the item's files or versions (see journal.py)
+        self.change_listeners = []
+        self.created = False
+        self._batch_depth = 0
+        self._batch_flush_every = None
+        self._batch_flush_interval = None
+        self._pending_syncs = 0
+        self._last_flush = None
+        self._filesets = {}
         if not date:
             date = datetime.now().isoformat()
         self.itempath = self.path_to_item()
-        self.revert(date=date, startversion=startversion)
+        self.blobs = BlobStore(os.path.join(self.itempath, BLOB_DIRNAME))
+        self._item_lock = ItemLock(self.itempath)
+        if locking:
+            with self.lock("w"):
+                self.revert(date=date, startversion=startversion)
+        else:
+            self.revert(date=date, startversion=startversion)
         self.files=None
         self.versions=None
         self.currentversion=None
@@ -78,6 +169,8 @@ class HarvestedRecord(object):
         elif name=='metadata':
             if not self.manifest.has_key('metadata'):
                 self.manifest['metadata'] = {}
+            # The caller can change the metadata in place, so assume it will
+            self.manifest.mark_dirty()
             return self.manifest['metadata']
         else:
             return object.__getattribute__(self, name)
@@ -98,8 +191,20 @@ class HarvestedRecord(object):
         self.manifest['metadata_files'][version] = []
         self.manifest['files'][version] = []
         self.manifest['versionlog'][version] = []
+        if self.track_sizes:
+            self.manifest['sizes'][version] = {}
+            self.manifest['usage'][version] = 0
+        else:
+            self._forget_sizes(version)
+        self.manifest.mark_dirty(version)
         self.set_version_date(version, date)
-        self.po.add_bytestream_by_path(os.path.join("__"+str(version), "4=%s" % id_encode(self.item_id)), self.item_id)
+        self._write_namaste_tag(version, "4=%s" % id_encode(self.item_id), self.item_id)
+
+    def _write_namaste_tag(self, version, tagname, value):
+        # The tag's name encodes its value, so an existing tag never needs rewriting
+        tagpath = os.path.join("__"+str(version), tagname)
+        if not self.po.isfile(tagpath):
+            self.po.add_bytestream_by_path(tagpath, value)
 
     def _init_manifests_emptydatastructures(self):
         self.item_id = self.manifest['item_id']
@@ -111,25 +216,102 @@ class HarvestedRecord(object):
             self.manifest['files'] = {}
         if not self.manifest.has_key('versionlog'):
             self.manifest['versionlog'] = {}
+        # Byte counters, if kept; versions from before they were kept are counted on first use
+        if self.track_sizes and not self.manifest.has_key('sizes'):
+            self.manifest['sizes'] = {}
+        if self.track_sizes and not self.manifest.has_key('usage'):
+            self.manifest['usage'] = {}
+        # {version: {filepath: digest}} of the files held as links to blobs
+        if not self.manifest.has_key('blobs'):
+            self.manifest['blobs'] = {}
+        if not self.manifest.has_key('checksums'):
+            self.manifest['checksums'] = {}
+        if self.manifest.split:
+            # Version manifests are given their defaults as they are read
+            return
         for version in self.manifest['versions']:
-            if not self.manifest['metadata_files'].has_key(version):
-                self.manifest['metadata_files'][version] = []
-            if not self.manifest['subdir'].has_key(version):
-                self.manifest['subdir'][version] = []
-            if not self.manifest['versionlog'].has_key(version):
-                self.manifest['versionlog'][version] = []
+            for key in ('metadata_files', 'subdir', 'versionlog'):
+                if not self.manifest[key].has_key(version):
+                    self.manifest[key][version] = []
+                    self.manifest.mark_dirty(version)
 
     def _reload_filelist(self, version):
         if self.manifest['files'].has_key(version) and version in self.manifest['versions']:
             self.manifest['files'][version] = []
             self.manifest['subdir'][version] = []
+            self.manifest.mark_dirty(version)
             # init from disc
-            for filename in [x for x in self.po.list_parts("__"+str(version)) if not (x.startswith("0=") or x.startswith("1=") or x.startswith("2=") or x.startswith("3=") or x.startswith("4=") or x.startswith("5=")) ]:
-                logger.debug("Item %s has file: %s" % (self.item_id, x) )
+            for filename in [x for x in self.po.list_parts("__"+str(version)) if not _is_bookkeeping(x)]:
+                logger.debug("Item %s has file: %s" % (self.item_id, filename) )
                 if self.po.isdir(os.path.join("__"+str(version), filename)):
                     self.manifest['subdir'][version].append(filename)
                 self.manifest['files'][version].append(filename)
 
+    def _fileset(self, version):
+        """Set mirroring manifest['files'][version], for cheap membership tests. It is rebuilt
+        whenever the list it mirrors has been replaced or changed length behind its back."""
+        files = self.manifest['files'][version]
+        cached = self._filesets.get(version)
+        if cached is None or cached[0] is not files or cached[1] != len(files):
+            cached = (files, len(files), set(files))
+            self._filesets[version] = cached
+        return cached[2]
+
+    def _is_listed_part(self, name):
+        # Mirrors what _reload_filelist would pick up from a listing of the version directory
+        if len(name) <= self.po.fs.shorty_length:
+            return False
+        return not _is_bookkeeping(name)
+
+    def _register_file(self, version, filename, isdir=False):
+        """Update the version's file list after filename (a directory, if isdir) has been written, without rescanning."""
+        if not self.manifest['files'].has_key(version) or not self.manifest['subdir'].has_key(version):
+            self._reload_filelist(version)
+            return
+        top = filename.strip("/").split("/")[0]
+        if not self._is_listed_part(top):
+            return
+        self.manifest.mark_dirty(version)
+        fileset = self._fileset(version)
+        if top not in fileset:
+            self.manifest['files'][version].append(top)
+            fileset.add(top)
+            self._filesets[version] = (self.manifest['files'][version], len(self.manifest['files'][version]), fileset)
+        if (isdir or top != filename.strip("/")) and top not in self.manifest['subdir'][version]:
+            self.manifest['subdir'][version].append(top)
+
+    def _unregister_file(self, version, filename):
+        """Update the version's file list after filename has been deleted, without rescanning."""
+        if not self.manifest['files'].has_key(version) or not self.manifest['subdir'].has_key(version):
+            self._reload_filelist(version)
+            return
+        filename = filename.strip("/")
+        if "/" in filename or not self._is_listed_part(filename):
+            # Removing something inside a subdirectory leaves the top level listing as it was
+            return
+        fileset = self._fileset(version)
+        if filename not in fileset:
+            logger.debug("Item %s: %s was not in the file list for version %s - rescanning" % (self.item_id, filename, version))
+            self._reload_filelist(version)
+            return
+        self.manifest.mark_dirty(version)
+        self.manifest['files'][version].remove(filename)
+        fileset.discard(filename)
+        self._filesets[version] = (self.manifest['files'][version], len(self.manifest['files'][version]), fileset)
+        if filename in self.manifest['subdir'][version]:
+            self.manifest['subdir'][version].remove(filename)
+
+    @_locked
+    def resync_from_disk(self, version=None):
+        """Rebuild the file lists of a version (or of every version) from a listing of the disc."""
+        if version:
+            versions = [version]
+        else:
+            versions = self.manifest['versions']
+        for v in versions:
+            self._reload_filelist(v)
+        self.sync()
+
     def _init_manifest(self, startversion="1"):
         """Set up the template for the item's manifest"""
         self.manifest['metadata_files'] = {}
@@ -139,9 +321,15 @@ class HarvestedRecord(object):
         self.manifest['versions'] = []
         self.manifest['version_dates'] = {}
         self.manifest['subdir'] = {}
+        if self.track_sizes:
+            self.manifest['sizes'] = {}
+            self.manifest['usage'] = {}
+        self.manifest['blobs'] = {}
+        self.manifest['checksums'] = {}
         self.manifest['currentversion'] = startversion
         self._setup_version_dir(startversion, self.manifest['date'])
         self.manifest['versionlog'][startversion] = ["Created new data package"]
+        self.manifest.mark_dirty(startversion)
         self.manifest.sync()
     
     def _read_date(self, version = None):
@@ -151,7 +339,8 @@ class HarvestedRecord(object):
         if len(date_namaste_tags) >= 1:
             lmd = date_namaste_tags.pop()[2:]   # take the first tag and remove the '3='
             lmd = id_decode(lmd)                # reverse the 'pairtree' encoding of the date
-            self.manifest['date'] = lmd
+            if self.manifest.get('date') != lmd:
+                self.manifest['date'] = lmd
 
     def _incr_version(self, latest_version):
         try:
@@ -166,6 +355,7 @@ class HarvestedRecord(object):
         self._reload_filelist(new_version)
         for x in [y for y in self.manifest['files'][latest_version] if y not in exclude_filenames]:
             self._copy_file(x, latest_version, new_version, sync=False)
+        logger.debug("Copied version %s of %s to %s - %s" % (latest_version, self.item_id, new_version, self.copy_stats.report()))
         self.set_version_cursor(version_state)
 
     def _copy_version_delta(self, latest_version, new_version, copy_filenames=[], copy_extensions=[]):
@@ -183,40 +373,301 @@ class HarvestedRecord(object):
                 fp1 = os.path.join(root, name)
                 fp2 = fp1.replace(cur_root, new_root)
                 file_ext = os.path.splitext(name)[1]
-                if name.startswith('0=') or name.startswith('1=') or name.startswith('2=') or name.startswith('3=') or \
-                    name.startswith('4=')  or name.startswith('5='):
+                if _is_bookkeeping(name):
                     pass
                 elif name in copy_filenames or file_ext in copy_extensions:
                     #note: file extensions should start with a dot
                     copy2(fp1, fp2)
                 else:
                     if os.path.islink(fp1):
-                        fp1 = os.readlink(fp1)
-                    os.symlink(fp1, fp2)
+                        fp1 = os.path.normpath(os.path.join(os.path.dirname(fp1), os.readlink(fp1)))
+                    # Relative, so that the links survive the silo being moved
+                    os.symlink(os.path.relpath(fp1, os.path.dirname(fp2)), fp2)
+        self.manifest.mark_dirty(new_version)
         self.manifest['metadata_files'][new_version] = list(self.manifest['metadata_files'][latest_version])
         self.manifest['files'][new_version] = list(self.manifest['files'][latest_version])
         self.manifest['subdir'][new_version] = list(self.manifest['subdir'][latest_version])
+        self.manifest['checksums'][new_version] = dict(self.manifest['checksums'].get(latest_version, {}))
+        for filepath, digests in self.manifest['checksums'][new_version].items():
+            if not os.path.isfile(os.path.join(new_root, filepath)):
+                del self.manifest['checksums'][new_version][filepath]
+        if self._has_sizes(latest_version):
+            self.manifest['sizes'][new_version] = dict(self.manifest['sizes'][latest_version])
+            self.manifest['usage'][new_version] = self.manifest['usage'][latest_version]
+        else:
+            self._forget_sizes(new_version)
         self.set_version_cursor(version_state)
     
     def _copy_file(self, filename, latest_version, new_version, sync = True):
+        if self.dedup:
+            return self._link_file(filename, latest_version, new_version, sync=sync)
+        if self._fast_copy_file(filename, latest_version, new_version):
+            return self._copied_file(filename, latest_version, new_version, sync=sync)
+        start = time.time()
         with self.get_stream(filename, version=latest_version) as filetostream:
             metadata = False
             if filename in self.manifest['metadata_files'][latest_version]:
                 metadata = True
             self.put_stream(filename, filetostream, version=new_version, metadata=metadata, sync=sync)
+        self.copy_stats.add("stream", os.path.getsize(self.to_dirpath(filepath=filename, version=new_version)), time.time() - start)
+
+    def _fast_copy_file(self, filename, latest_version, new_version):
+        """Copy a file (or a directory's files) between versions on disc. Returns False, having copied nothing,
+        if filename is a file that none of the fast strategies could copy."""
+        src = self.to_dirpath(filepath=filename, version=latest_version)
+        if os.path.isdir(src):
+            filepaths = [os.path.relpath(os.path.join(root, name), self.to_dirpath(version=latest_version))
+                         for root, dirs, files in os.walk(src) for name in files]
+        elif os.path.isfile(src):
+            filepaths = [filename]
+        else:
+            raise FileNotFoundException
+        for filepath in filepaths:
+            src = self.to_dirpath(filepath=filepath, version=latest_version)
+            dst = self.to_dirpath(filepath=filepath, version=new_version)
+            if os.path.lexists(dst):
+                os.remove(dst)
+                self._forget_blob(new_version, filepath)
+            elif not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            if fast_copy(src, dst, hardlinks=self.copy_hardlinks, strategies=self.copy_strategies, stats=self.copy_stats) is None:
+                if filepath == filename:
+                    return False
+                start = time.time()
+                copy2(src, dst)
+                self.copy_stats.add("copy", os.path.getsize(dst), time.time() - start)
+            self._track_file_size(new_version, filepath)
+            self._copy_checksum(filepath, latest_version, new_version)
+        return True
+
+    def _copied_file(self, filename, latest_version, new_version, sync=True):
+        """Bookkeeping for a file (or directory) copied between versions behind put_stream's back."""
+        self.manifest.mark_dirty(new_version)
+        if filename in self.manifest['metadata_files'][latest_version] and filename not in self.manifest['metadata_files'][new_version]:
+            self.manifest['metadata_files'][new_version].append(filename)
+        self.manifest['versionlog'][new_version].append("Added or updated file %s"%filename)
+        self._register_file(new_version, filename, isdir=os.path.isdir(self.to_dirpath(filepath=filename, version=new_version)))
+        self._file_added(filename, new_version)
+        if sync:
+            self.sync()
+        self._changed("put", new_version, filename)
+
+    def _link_file(self, filename, latest_version, new_version, sync=True):
+        """Copy a file (or a directory's files) between versions by linking to the blobs holding them."""
+        src = self.to_dirpath(filepath=filename, version=latest_version)
+        if os.path.isdir(src):
+            filepaths = [os.path.relpath(os.path.join(root, name), self.to_dirpath(version=latest_version))
+                         for root, dirs, files in os.walk(src) for name in files]
+        elif os.path.isfile(src):
+            filepaths = [filename]
+        else:
+            raise FileNotFoundException
+        for filepath in filepaths:
+            start = time.time()
+            digest = self._blob_for(latest_version, filepath)
+            self.blobs.link(digest, self.to_dirpath(filepath=filepath, version=new_version))
+            self.copy_stats.add("blob", os.path.getsize(self.blobs.path(digest)), time.time() - start)
+            self.manifest['blobs'].setdefault(new_version, {})[filepath] = digest
+            self.manifest.mark_dirty(new_version)
+            self._track_file_size(new_version, filepath)
+            self._copy_checksum(filepath, latest_version, new_version)
+        self._copied_file(filename, latest_version, new_version, sync=sync)
+
+    def _blob_for(self, version, filepath):
+        """Digest of the blob holding a file, moving the file into the blob store if it is not there already."""
+        digest = self.manifest['blobs'].get(version, {}).get(filepath)
+        fullpath = self.to_dirpath(filepath=filepath, version=version)
+        if digest and self.blobs.is_blob(fullpath, digest):
+            return digest
+        digest = self.blobs.put_file(fullpath)[0]
+        self.blobs.link(digest, fullpath)
+        self.manifest['blobs'].setdefault(version, {})[filepath] = digest
+        self.manifest.mark_dirty(version)
+        return digest
+
+    def _forget_blob(self, version, filepath):
+        """Drop the record of a file's blob once the file no longer links to it, removing the blob if it is now unused."""
+        digest = self.manifest['blobs'].get(version, {}).pop(filepath, None)
+        if digest:
+            self.manifest.mark_dirty(version)
+            self.blobs.release(digest)
+
+    def _unshare_file(self, version, filepath):
+        """Give a file its own copy of its contents if it is hard linked, so that writing to it in place
+        cannot change other versions or the blob store."""
+        fullpath = self.to_dirpath(filepath=filepath, version=version)
+        if os.path.isfile(fullpath) and not os.path.islink(fullpath) and os.stat(fullpath).st_nlink > 1:
+            tmppath = temp_path(fullpath)
+            copy2(fullpath, tmppath)
+            os.rename(tmppath, fullpath)
+        self._forget_blob(version, filepath)
+
+    @_locked
+    def dedup_version(self, version=None):
+        """Move the files of a version (e.g. one written before dedup was turned on) into the blob store,
+        leaving links in their place."""
+        if not version:
+            version = self.manifest['currentversion']
+        self._dedup_version(version)
+        self.sync()
+
+    def _dedup_version(self, version):
+        version_dir = self.to_dirpath(version=version)
+        for root, dirs, files in os.walk(version_dir):
+            for name in files:
+                fullpath = os.path.join(root, name)
+                if _is_bookkeeping(name) or os.path.islink(fullpath):
+                    continue
+                self._blob_for(version, os.path.relpath(fullpath, version_dir))
+
+    def collect_garbage(self):
+        """Remove any blobs that no version links to. Returns the number removed."""
+        return self.blobs.gc()
+
+    def _copy_checksum(self, filepath, latest_version, new_version):
+        digests = self.manifest['checksums'].get(latest_version, {}).get(filepath)
+        if digests:
+            self.manifest['checksums'].setdefault(new_version, {})[filepath] = digests
+            self.manifest.mark_dirty(new_version)
+        else:
+            self._update_checksum(new_version, filepath)
+
+    def _update_checksum(self, version, filepath, digests=None):
+        """Record the digests of a file that has been written (hashing it if they are not given), or forget
+        them if checksums are off or the file is gone."""
+        fullpath = self.to_dirpath(filepath=filepath, version=version)
+        self.manifest.mark_dirty(version)
+        if self.checksum_algorithms and os.path.isfile(fullpath):
+            if not digests:
+                digests = hash_file(fullpath, self.checksum_algorithms)
+            self.manifest['checksums'].setdefault(version, {})[filepath] = digests
+        else:
+            self.manifest['checksums'].get(version, {}).pop(filepath, None)
+
+    def checksums(self, version=None):
+        """{filename: digests} for the files of a version that have checksums."""
+        if not version:
+            version = self.manifest['currentversion']
+        return self.manifest['checksums'].get(version, {})
+
+    @_locked
+    def update_checksums(self, version=None, algorithms=None):
+        """Hash the files of a version that have no checksums yet, e.g. ones written before checksums were
+        turned on. algorithms defaults to those the record was opened with."""
+        if not version:
+            version = self.manifest['currentversion']
+        algorithms = algorithm_list(algorithms) or self.checksum_algorithms
+        if not algorithms:
+            raise ValueError("No checksum algorithms given")
+        self._hash_version(version, algorithms)
+        self.sync()
+
+    def _hash_version(self, version, algorithms):
+        version_dir = self.to_dirpath(version=version)
+        recorded = self.manifest['checksums'].setdefault(version, {})
+        self.manifest.mark_dirty(version)
+        for root, dirs, files in os.walk(version_dir):
+            for name in files:
+                fullpath = os.path.join(root, name)
+                filepath = os.path.relpath(fullpath, version_dir)
+                if _is_bookkeeping(name) or filepath in recorded or not os.path.isfile(fullpath):
+                    continue
+                recorded[filepath] = hash_file(fullpath, algorithms)
+
+    def verify(self, version=None, workers=VERIFY_WORKERS, buffer_size=READ_BUFFER_SIZE):
+        """Re-hash the files of a version (or of every version, if none is given) in a pool of worker threads
+        and compare them with their recorded checksums. Returns a list of recordsilo.fixity.Mismatch
+        (version, filename, expected, found) - empty if everything matches. Files without checksums are not checked."""
+        if self.locking:
+            with self.lock("r"):
+                return self._verify(version, workers, buffer_size)
+        return self._verify(version, workers, buffer_size)
+
+    def _verify(self, version, workers, buffer_size):
+        if version:
+            versions = [version]
+        else:
+            versions = self.manifest['versions']
+        entries = []
+        for v in versions:
+            for filepath, digests in self.manifest['checksums'].get(v, {}).items():
+                entries.append((v, filepath, self.to_dirpath(filepath=filepath, version=v), digests))
+        return verify_files(entries, workers=workers, buffer_size=buffer_size)
 
     def disk_usage(self, version=None):
+        """Space taken on disc by the item (or one version of it) in KB, as a string like `du -ks` gives.
+        Files hard linked or symlinked between versions are only counted once."""
         if version:
             root = False
         else:
             root = True
         item_dir = self.to_dirpath(root=root, version=version)
-        command = "du -ks %s" %item_dir
-        fileobject = popen(command)
-        dataline = fileobject.read()
-        fileobject.close()
-        data = dataline[:-1].split("\t") 
-        return data[0]
+        return str(tree_usage(item_dir)[1])
+
+    def _has_sizes(self, version):
+        """True if the byte counters of a version are kept (and so up to date)."""
+        return (self.track_sizes and self.manifest.has_key('usage') and self.manifest['usage'].has_key(version)
+                and self.manifest['sizes'].has_key(version))
+
+    def _forget_sizes(self, version):
+        """Drop the byte counters of a version, so that nothing reads them once they are out of date."""
+        for key in ('sizes', 'usage'):
+            if self.manifest.has_key(key) and self.manifest[key].has_key(version):
+                del self.manifest[key][version]
+                self.manifest.mark_dirty(version)
+
+    def _track_file_size(self, version, filename):
+        """Bring the byte counters of a version up to date after filename was written or deleted."""
+        if not self.track_sizes:
+            self._forget_sizes(version)
+            return
+        sizes = self.manifest['sizes'].get(version)
+        if sizes is None:
+            # Not counted yet; the whole version is counted when it is first asked for
+            return
+        self.manifest.mark_dirty(version)
+        old = sizes.pop(filename, 0)
+        new = 0
+        filepath = self.to_dirpath(filepath=filename, version=version)
+        if os.path.isfile(filepath):
+            new = sizes[filename] = os.path.getsize(filepath)
+        self.manifest['usage'][version] = self.manifest['usage'].get(version, 0) - old + new
+
+    def _count_version_bytes(self, version):
+        """Count the bytes of a version from the disc, keeping the counts if track_sizes is set."""
+        if not self.track_sizes:
+            self._forget_sizes(version)
+            return
+        sizes = file_sizes(self.to_dirpath(version=version), exclude=_is_bookkeeping)
+        self.manifest['sizes'][version] = sizes
+        self.manifest['usage'][version] = sum(sizes.values())
+        self.manifest.mark_dirty(version)
+
+    def stored_bytes(self, version=None):
+        """Total size in bytes of the files in a version, or summed over every version if none is given,
+        from the counters kept in the manifest where there are any and from the disc otherwise. A file shared
+        between versions counts towards each of them; use disk_usage() for the space actually taken."""
+        if version:
+            versions = [version]
+        else:
+            versions = self.manifest['versions']
+        total = 0
+        for v in versions:
+            if self._has_sizes(v):
+                total += self.manifest['usage'][v]
+            else:
+                total += sum(file_sizes(self.to_dirpath(version=v), exclude=_is_bookkeeping).values())
+        return total
+
+    def file_size(self, filename, version=None):
+        """Size of a file in bytes, as recorded in the manifest if it is there, or None if there is no such file."""
+        if not version:
+            version = self.manifest['currentversion']
+        if self._has_sizes(version):
+            return self.manifest['sizes'][version].get(filename)
+        filepath = self.to_dirpath(filepath=filename, version=version)
+        if os.path.isfile(filepath):
+            return os.path.getsize(filepath)
 
     def path_to_item(self):
         return self.po.fs._id_to_dirpath(self.po.id)
@@ -226,9 +677,10 @@ class HarvestedRecord(object):
             logger.error("Path to harvested item does not exist")
             raise Exception("Path to harvested item does not exist")
         try:
-            self.manifest = PersistentState(self.itempath, self.manifest_filename)
+            self.manifest = ItemManifest(self.itempath, self.manifest_filename, split=self.split_manifest, fsync=self.manifest_fsync, keep_backup=self.manifest_backup, serialiser=self.manifest_serialiser)
             self.manifest.revert()
             if not self.manifest:
+                self.created = True
                 if kw.has_key('date'):
                     self.manifest['date'] = kw['date']
                 else:
@@ -259,51 +711,256 @@ class HarvestedRecord(object):
     def items(self): return self.manifest.items()
     def values(self): return self.manifest.values()
 
+    def is_stale(self):
+        """True if the item's manifest has been rewritten by someone else since this record read or wrote it."""
+        return self.manifest.changed_on_disc()
+
+    @contextmanager
+    def lock(self, mode="w", timeout=None):
+        """Hold the item's lock, "r" (shared) or "w" (exclusive), for the duration of the block. Raises
+        recordsilo.itemlock.LockTimeout if it cannot be had within timeout seconds (the record's
+        lock_timeout by default). Locks can be nested, but "w" cannot be asked for while holding "r"
+        (recordsilo.itemlock.LockUpgradeError) - take "w" from the start to read and then write."""
+        if timeout is None:
+            timeout = self.lock_timeout
+        self._item_lock.acquire(mode, timeout)
+        try:
+            if self._item_lock.depth == 1 and hasattr(self, 'manifest'):
+                self._refresh()
+            yield self
+        finally:
+            self._item_lock.release()
+
+    def _refresh(self):
+        """Re-read anything another writer has changed on disc, unless there are changes here still to be written."""
+        if self.manifest.changed_on_disc():
+            if self.manifest.is_dirty(exact=True):
+                logger.warning("Manifest of %s changed on disc while this record has unsaved changes - keeping them" % self.item_id)
+            else:
+                self.revert_manifest()
+
+    @_locked
     def sync(self):
-        self.manifest.sync()
+        """Write the manifest to disc. Inside a batch() block the write is deferred until the
+        block exits or the batch's flush policy says it is due."""
+        if self._batch_depth:
+            self._pending_syncs += 1
+            if self._batch_flush_due():
+                self.flush()
+            return
+        self._sync()
+
+    def _sync(self):
+        if self.manifest.sync():
+            for listener in self.sync_listeners:
+                listener(self)
+
+    def _changed(self, op, version=None, filename=None):
+        for listener in self.change_listeners:
+            listener(self, op, version, filename)
+
+    def _batch_flush_due(self):
+        if self._batch_flush_every and self._pending_syncs >= self._batch_flush_every:
+            return True
+        if self._batch_flush_interval is not None and time.time() - self._last_flush >= self._batch_flush_interval:
+            return True
+        return False
+
+    @_locked
+    def flush(self):
+        """Write out any manifest changes deferred by batch()."""
+        if self._pending_syncs:
+            self._sync()
+        self._pending_syncs = 0
+        self._last_flush = time.time()
+
+    @contextmanager
+    def batch(self, flush_every=None, flush_interval=None):
+        """Defer manifest writes for the duration of the block, writing once on exit.
+
+        >>> with record.batch(flush_every=500):
+        ...     for name, stream in files:
+        ...         record.put_stream(name, stream)
+
+        flush_every - write the manifest after this many deferred syncs
+        flush_interval - write the manifest if this many seconds have passed since the last write
+
+        Batches can be nested; only the outermost block's flush policy applies. If locking is on, the
+        item is locked for the whole of the block."""
+        if self.locking:
+            with self.lock("w"):
+                with self._batch(flush_every, flush_interval):
+                    yield self
+        else:
+            with self._batch(flush_every, flush_interval):
+                yield self
+
+    @contextmanager
+    def _batch(self, flush_every=None, flush_interval=None):
+        self._batch_depth += 1
+        if self._batch_depth == 1:
+            self._batch_flush_every = flush_every
+            self._batch_flush_interval = flush_interval
+            self._last_flush = time.time()
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.flush()
         
     def revert_manifest(self):
         self.manifest.revert()
         self._init_manifests_emptydatastructures()
     
-    def put_stream(self, filename, filetostream, version=None, metadata=False, sync=True):
+    @_locked
+    def put_stream(self, filename, filetostream, version=None, metadata=False, sync=True, buffer_size=None):
+        """Write a file to a version of the item from a string, a file-like object or an iterable of strings
+        (e.g. a generator of chunks from an upload). The data is written buffer_size bytes at a time to a
+        temporary file, which is only renamed into place once complete.
+
+        Returns {'size': bytes written}, with the file's 'checksum' and its 'type' as well if the silo's pairtree
+        store hashes files (hashing_type) or the record keeps files in its blob store."""
         if not version:
             version = self.manifest['currentversion']
+        if not buffer_size:
+            buffer_size = self.buffer_size
+        hashers = []
+        hasher = store_hash = None
+        if self.checksum_algorithms:
+            hasher = Hasher(self.checksum_algorithms)
+            hashers.append(hasher)
+        if self.po.fs.hashing_type:
+            store_hash = hashlib.new(self.po.fs.hashing_type)
+            hashers.append(store_hash)
+        if self.dedup:
+            resp = self._put_blob(filename, filetostream, version, buffer_size, hashers)
+        else:
+            # Renaming the new file into place also leaves any other links to the old one as they were
+            size = write_atomic(self.to_dirpath(filepath=filename, version=version), filetostream, buffer_size, hashers)
+            resp = {"size":size}
+            self._forget_blob(version, filename)
+        if store_hash is not None:
+            resp.update({"checksum":store_hash.hexdigest(), "type":self.po.fs.hashing_type})
+        # Only once the file is safely written
+        self.manifest.mark_dirty(version)
         if metadata and filename not in self.manifest['metadata_files'][version]:
             self.manifest['metadata_files'][version].append(filename)
-        if filename not in self.manifest['files'][version]:
-            self.manifest['files'][version].append(filename)
         self.manifest['versionlog'][version].append("Added or updated file %s"%filename)
-        resp = self.po.add_bytestream_by_path(os.path.join("__" + str(version), filename), filetostream)
-        self._reload_filelist(version)
+        self._register_file(version, filename)
+        self._track_file_size(version, filename)
+        self._update_checksum(version, filename, hasher and hasher.digests())
+        self._file_added(filename, version)
         if sync:
             self.sync()
+        self._changed("put", version, filename)
         return resp
 
+    def _put_blob(self, filename, filetostream, version, buffer_size=BUFFER_SIZE, hashers=()):
+        previous = self.manifest['blobs'].get(version, {}).get(filename)
+        digest, blob_path, size = self.blobs.put(filetostream, buffer_size, hashers)
+        self.blobs.link(digest, self.to_dirpath(filepath=filename, version=version))
+        self.manifest['blobs'].setdefault(version, {})[filename] = digest
+        self.manifest.mark_dirty(version)
+        if previous and previous != digest:
+            self.blobs.release(previous)
+        return {"size":size, "checksum":digest, "type":"sha256"}
+
+    def _file_added(self, filename, version):
+        """Called after a file has been written to a version, before the manifest is synced."""
+        pass
+
     def get_stream(self, filename, version=None, writeable=False):
         """NB If writeable is set to True, then the file is opened "wb+" and can accept writes.
-        Otherwise, the file is opened read-only."""
+        Otherwise, the file is opened read-only. A writeable file that shares its contents with
+        other versions is given its own copy first."""
         if not version:
             version = self.manifest['currentversion']
         if self.isfile(filename, version):
+            if writeable:
+                self._unshare_file(version, filename)
+                # The contents are about to change
+                self.manifest['checksums'].get(version, {}).pop(filename, None)
+                self.manifest.mark_dirty(version)
             return self.po.get_bytestream_by_path(os.path.join("__" + str(version), filename),
                                                   streamable=True, appendable=writeable)
         else:
             raise FileNotFoundException
     
+    def _known_file(self, filename, version=None):
+        """Path to a file of a version, checked against the manifest rather than the disc.
+        Raises FileNotFoundException if the manifest does not list it, or if the path would lead
+        outside the item (an absolute path, a '..' segment or a symlink pointing elsewhere)."""
+        if not version:
+            version = self.manifest['currentversion']
+        if version not in self.manifest['versions'] or not self.manifest['files'].has_key(version):
+            raise FileNotFoundException
+        if os.path.isabs(filename) or ".." in filename.replace(os.sep, "/").split("/"):
+            raise FileNotFoundException
+        filename = os.path.normpath(filename).strip("/")
+        top = filename.split("/")[0]
+        if top not in self._fileset(version):
+            raise FileNotFoundException
+        if top != filename and top not in self.manifest['subdir'].get(version, []):
+            raise FileNotFoundException
+        filepath = self.to_dirpath(filepath=filename, version=version)
+        # Delta versions link to files in other versions of the item, so the item is the boundary
+        itempath = os.path.realpath(self.itempath)
+        if not os.path.realpath(filepath).startswith(itempath + os.sep):
+            raise FileNotFoundException
+        return filepath
+
+    def get_mmap(self, filename, version=None):
+        """A read-only memory map of a file, which can be sliced without copying the rest of the file.
+        An empty file gives an empty string, as empty files cannot be mapped."""
+        filepath = self._known_file(filename, version)
+        try:
+            with open(filepath, "rb") as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return ""
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except IOError:
+            raise FileNotFoundException
+
+    def get_range(self, filename, offset, length=None, version=None):
+        """length bytes (or the rest of the file, if length is None) of a file from offset on,
+        e.g. for an HTTP Range request. Fewer bytes are returned if the file ends first."""
+        if offset < 0 or (length is not None and length < 0):
+            raise ValueError("Range offset and length must not be negative")
+        filepath = self._known_file(filename, version)
+        if length == 0:
+            return ""
+        try:
+            with open(filepath, "rb") as f:
+                f.seek(offset)
+                if length is None:
+                    return f.read()
+                return f.read(length)
+        except IOError:
+            raise FileNotFoundException
+
+    @_locked
     def del_stream(self, filename, versions=[]):
         if not versions:
             versions = [self.manifest['currentversion']]
+        deleted = []
         for version in versions:
             try:
                 self.po.del_file_by_path(os.path.join("__" + str(version), filename))
-                if self.isfile(filename, version):
+                self._forget_blob(version, filename)
+                self.manifest.mark_dirty(version)
+                self.manifest['checksums'].get(version, {}).pop(filename, None)
+                if filename in self.manifest['metadata_files'][version]:
                     self.manifest['metadata_files'][version].remove(filename)
                 self.manifest['versionlog'][version].append("Deleted file %s"%filename)
-                self._reload_filelist(version)
+                self._unregister_file(version, filename)
+                self._track_file_size(version, filename)
+                deleted.append(version)
             except FileNotFoundException:
                 logger.info("File %s not found at version %s and so cannot be deleted" % (filename, version))
         self.sync()
+        for version in deleted:
+            self._changed("del", version, filename)
 
     def isfile(self, filepath, version=None):
         if not version:
@@ -353,6 +1010,18 @@ class HarvestedRecord(object):
     def get_versions(self):
         return self.manifest['versions']
 
+    @_locked
+    def set_manifest_layout(self, split):
+        """Convert the item's manifest to the split layout (split True) or back to the original single file,
+        writing it out at once. Returns True if the layout was changed."""
+        if self.manifest.split == bool(split):
+            return False
+        # Anything deferred by a batch() goes out, with its listeners, in the old layout first
+        self._sync()
+        self._pending_syncs = 0
+        return self.manifest.convert(split)
+
+    @_locked
     def increment_version(self, date=None, clone_previous_version=False):
         if not date:
             date = datetime.now().isoformat()
@@ -365,9 +1034,12 @@ class HarvestedRecord(object):
         if clone_previous_version:
             self._copy_version(latest_version, new_version)
         self.manifest['versionlog'][new_version].append("Version number incremented from %s to %s"%(latest_version, new_version))
+        self.manifest.mark_dirty(new_version)
         self.sync()
+        self._changed("new_version", new_version)
         return new_version
 
+    @_locked
     def increment_version_delta(self, date=None, clone_previous_version=False, copy_filenames=[], copy_extensions=[]):
         if not date:
             date = datetime.now().isoformat()
@@ -380,9 +1052,12 @@ class HarvestedRecord(object):
         if clone_previous_version:
             self._copy_version_delta(latest_version, new_version, copy_filenames=copy_filenames, copy_extensions=copy_extensions)
         self.manifest['versionlog'][new_version].append("Version number incremented from %s to %s"%(latest_version, new_version))
+        self.manifest.mark_dirty(new_version)
         self.sync()
+        self._changed("new_version", new_version)
         return new_version
 
+    @_locked
     def move_directory_as_new_version(self, src_directory, version=None, force=False, date=None, log="Directory contents", _sync=True):
         newVersion = True
         if not date:
@@ -405,19 +1080,34 @@ class HarvestedRecord(object):
             if os.path.isdir(src_directory) and not os.path.isdir(version_path):
                 copytree(src_directory, version_path, symlinks=True)
                 rmtree(src_directory) 
+        # Caches and manifests that came in with the directory describe some other version, so are not to be trusted
+        for name in os.listdir(version_path):
+            if is_sidecar(name) or is_version_manifest(name):
+                os.remove(os.path.join(version_path, name))
         self._setup_version_dir(version, date)
         self.manifest['date'] = date
         self._read_date()
         self._reload_filelist(version)
+        self._count_version_bytes(version)
+        self.manifest['blobs'].pop(version, None)
+        self.manifest['checksums'].pop(version, None)
+        self.manifest.mark_dirty(version)
+        if self.dedup:
+            self._dedup_version(version)
+        if self.checksum_algorithms:
+            self._hash_version(version, self.checksum_algorithms)
         self.set_version_cursor(version)
         if newVersion:
             self.manifest['versionlog'][version].append("%s added as version %s"%(log, version))
         else:
             self.manifest['versionlog'][version].append("%s replaced version %s"%(log, version))
+        self.manifest.mark_dirty(version)
         if _sync:
             self.sync()
+        self._changed("new_version", version)
         return version
 
+    @_locked
     def clone_version(self, original_version, new_version, exclude_filenames=[]):
         if original_version in self.manifest['versions']:
             date = self.manifest['version_dates'][original_version]
@@ -426,12 +1116,15 @@ class HarvestedRecord(object):
             self._copy_version(original_version, new_version, exclude_filenames)
             self.set_version_cursor(new_version)
             self.manifest['versionlog'][new_version].append("Version %s cloned from %s"%(new_version, original_version))
+            self.manifest.mark_dirty(new_version)
             self.sync()
+            self._changed("new_version", new_version)
             return new_version
         else:
             logger.error("Version %s is not found in the object. Cannot be cloned" % original_version)
             return False
 
+    @_locked
     def clone_version_delta(self, original_version, new_version, copy_filenames=[], copy_extensions=[]):
         if original_version in self.manifest['versions']:
             date = self.manifest['version_dates'][original_version]
@@ -440,46 +1133,61 @@ class HarvestedRecord(object):
             self._copy_version_delta(original_version, new_version, copy_filenames=copy_filenames, copy_extensions=copy_extensions)
             self.set_version_cursor(new_version)
             self.manifest['versionlog'][new_version].append("Version %s cloned from %s"%(new_version, original_version))
+            self.manifest.mark_dirty(new_version)
             self.sync()
+            self._changed("new_version", new_version)
             return new_version
         else:
             logger.error("Version %s is not found in the object. Cannot be cloned" % original_version)
             return False
 
+    @_locked
     def copy_file_between_versions(self, filename, from_version, to_version):
         if from_version in self.manifest['versions'] and to_version in self.manifest['versions'] and filename in self.manifest['files'][from_version]:
             self._copy_file(filename, from_version, to_version)
             self.manifest['versionlog'][to_version].append("File %s copied from version %s to %s"%(filename, from_version, to_version))
+            self.manifest.mark_dirty(to_version)
 
+    @_locked
     def rename_version(self, original_version, new_name):
         if original_version in self.manifest['versions']:
             self.manifest['versions'].append(new_name)
             self.manifest['version_dates'][new_name] = self.manifest['version_dates'][original_version]
             self.manifest['files'][new_name] = self.manifest['files'][original_version]
             self.manifest['metadata_files'][new_name] = self.manifest['metadata_files'][original_version]
+            self.manifest['versionlog'][new_name] = self.manifest['versionlog'].pop(original_version, [])
             self.manifest['versionlog'][new_name].append("Version %s renamed to %s"%(original_version, new_name))
+            for key in ['subdir', 'sizes', 'usage', 'blobs', 'checksums']:
+                if self.manifest.has_key(key) and self.manifest[key].has_key(original_version):
+                    self.manifest[key][new_name] = self.manifest[key].pop(original_version)
             os.rename(os.path.join(self.path_to_item(), "__"+str(original_version)), os.path.join(self.path_to_item(), "__" + str(new_name)))
             self.set_version_cursor(new_name)
             self.manifest['versions'].remove(original_version)
             del self.manifest['version_dates'][original_version]
             del self.manifest['files'][original_version]
             del self.manifest['metadata_files'][original_version]
+            self.manifest.mark_dirty(original_version, new_name)
             self.sync()
+            self._changed("rename_version", new_name, original_version)
             return new_name
         else:
             logger.error("Version %s is not found in the object. Cannot be renamed" % original_version)
             return False
 
+    @_locked
     def create_new_version(self, version, date=None):
         version = str(version)
         if version not in self.manifest['versions']:
             self._setup_version_dir(version, date)
             self.set_version_cursor(version)
             self.manifest['versionlog'][version].append("Created new version %s"%version)
+            self.manifest.mark_dirty(version)
             self.sync()
+            self._changed("new_version", version)
         else:
             logger.error("Cannot create new version %s - version directory already exists" % version)
 
+    @_locked
     def del_version(self, version):
         if version not in self.manifest['versions']:
             logger.error("Version %s does not exist" % version)
@@ -490,6 +1198,9 @@ class HarvestedRecord(object):
                 del self.manifest['files'][version]
             if self.manifest['metadata_files'].has_key(version):
                 del self.manifest['metadata_files'][version]
+            self._forget_sizes(version)
+            digests = set(self.manifest['blobs'].pop(version, {}).values())
+            self.manifest['checksums'].pop(version, None)
             if self.manifest['versions']:
                 # TODO revert object manifest to previous version if current version is being deleted
                 self.manifest['currentversion'] = self.manifest['versions'][-1]
@@ -503,9 +1214,15 @@ class HarvestedRecord(object):
                     date = datetime.now().isoformat()  
                 self._setup_version_dir(version, date)
             self.manifest['versionlog'][version].append("Deleted version %s"%version)
+            self.manifest.mark_dirty(version)
             self.sync()
-            return self.po.del_path("__"+str(version), recursive=True)
+            resp = self.po.del_path("__"+str(version), recursive=True)
+            for digest in digests:
+                self.blobs.release(digest)
+            self._changed("del_version", version)
+            return resp
 
+    @_locked
     def del_versions(self, versions=[]):
         results = []
         for version in versions:
@@ -515,7 +1232,8 @@ class HarvestedRecord(object):
     def set_version_date(self, version, date):
         if version in self.manifest['versions']:
             self.manifest['version_dates'][version] = date
-            self.po.add_bytestream_by_path(os.path.join("__"+str(version), "3=%s" % id_encode(date)), date)
+            self.manifest.mark_dirty()
+            self._write_namaste_tag(version, "3=%s" % id_encode(date), date)
             return True
         else:
             logger.error("Version %s does not exist" % version)
@@ -525,14 +1243,32 @@ class HarvestedRecord(object):
         return self.manifest['currentversion']
 
 class RDFRecord(HarvestedRecord):
-    def __init__(self, pairtree_object, date=None, rdf_manifest_filename="manifest.rdf", rdf_manifest_format="xml", manifest_filename="__manifest.json", startversion="1"):
-        super(RDFRecord, self).__init__(pairtree_object, date=None, manifest_filename="__manifest.json", startversion=startversion)
+    """HarvestedRecord with an RDF manifest per version.
+
+    The RDF manifest of the current version is only parsed when it is first needed by one of the triple
+    or graph methods, and is only written back by sync() if it was loaded. rdf_sync_listeners are called
+    with the record whenever the current version's RDF manifest file is written, with the triples added and
+    removed by the write in record.rdf_changes if they are known.
+
+    With rdf_sidecar set, the RDF manifests keep a marshalled copy of their graph alongside, which is much
+    quicker to load than the RDF itself (see RDFManifest)."""
+    def __init__(self, pairtree_object, date=None, rdf_manifest_filename="manifest.rdf", rdf_manifest_format="xml", manifest_filename="__manifest.json", startversion="1", rdf_sidecar=True, **kw):
+        self._rdfmanifest = None
+        self.rdf_sidecar = rdf_sidecar
+        self.rdf_sync_listeners = []
+        self.rdf_changes = None
+        super(RDFRecord, self).__init__(pairtree_object, date=None, manifest_filename="__manifest.json", startversion=startversion, **kw)
         self.set_rdf_manifest_filename(rdf_manifest_filename, format=rdf_manifest_format)
         
+    @_locked
     def set_rdf_manifest_filename(self, filename, format="xml"):
-        self.manifest['rdffilename'] = filename
-        self.manifest['rdffileformat'] = format
-        self.load_rdf_manifest()
+        # Set on every load, so it is written straight away if it changes rather than left for
+        # whatever is written next, which may be another writer's changes
+        if self.manifest.get('rdffilename') != filename or self.manifest.get('rdffileformat') != format:
+            self.manifest['rdffilename'] = filename
+            self.manifest['rdffileformat'] = format
+            self.sync()
+        self._unload_rdf_manifest()
     
     def _path_to_rdfmanifest(self, version=None):
         if not version:
@@ -540,53 +1276,92 @@ class RDFRecord(HarvestedRecord):
         fn = self.manifest.get('rdffilename', 'manifest.rdf')
         return os.path.join(self.po.fs._id_to_dirpath(self.po.id), "__"+str(version), fn)
 
+    def _register_rdf_manifest_file(self):
+        if self.manifest.has_key('rdffilename') and self.manifest['rdffilename'] not in self.manifest['files'][self.manifest['currentversion']]:
+            self.manifest['files'][self.manifest['currentversion']].append(self.manifest['rdffilename'])
+            self.manifest.mark_dirty(self.manifest['currentversion'])
+
     def load_rdf_manifest(self, version=None):
         format = self.manifest.get('rdffileformat', 'xml')
         fpath = self._path_to_rdfmanifest()
-        if self.manifest.has_key('rdffilename') and self.manifest['rdffilename'] not in self.manifest['files'][self.manifest['currentversion']]:
-            self.manifest['files'][self.manifest['currentversion']].append(self.manifest['rdffilename'])
-        self._rdfmanifest = RDFManifest(fpath, format=format, uri=self.po.uri)
+        self._register_rdf_manifest_file()
+        self._rdfmanifest = RDFManifest(fpath, format=format, uri=self.po.uri, sidecar=self.rdf_sidecar)
+
+    def _unload_rdf_manifest(self):
+        """Drop the parsed RDF manifest; it is loaded again from the current version on next use."""
+        self._register_rdf_manifest_file()
+        self._rdfmanifest = None
+
+    def rdf_manifest_loaded(self):
+        return self._rdfmanifest is not None
     
+    def is_stale(self):
+        if super(RDFRecord, self).is_stale():
+            return True
+        return self._rdfmanifest is not None and self._rdfmanifest.changed_on_disc()
+
+    def _refresh(self):
+        super(RDFRecord, self)._refresh()
+        if self._rdfmanifest is not None and not self._rdfmanifest.dirty and self._rdfmanifest.changed_on_disc():
+            self._unload_rdf_manifest()
+
     def get_rdf_manifest(self):
-        if not self._rdfmanifest:
+        if self._rdfmanifest is None:
             self.load_rdf_manifest()
         return self._rdfmanifest
 
     def triple_exists(self, s, p, o):
-        return self._rdfmanifest.triple_exists(s,p,o)
+        return self.get_rdf_manifest().triple_exists(s,p,o)
     def list_rdf_objects(self, s, p):
-        return self._rdfmanifest.list_objects(s,p)
+        return self.get_rdf_manifest().list_objects(s,p)
+    def iter_rdf_objects(self, s, p):
+        return self.get_rdf_manifest().iter_objects(s,p)
+    def count_triples(self, s='*', p='*', o='*'):
+        return self.get_rdf_manifest().count_triples(s,p,o)
     def add_triple(self, s, p, o):
-        return self._rdfmanifest.add_triple(s,p,o)
+        return self.get_rdf_manifest().add_triple(s,p,o)
+    def add_triples(self, triples):
+        return self.get_rdf_manifest().add_triples(triples)
     def add_namespace(self, prefix, uri):
-        return self._rdfmanifest.add_namespace(prefix, uri)
+        return self.get_rdf_manifest().add_namespace(prefix, uri)
     def del_triple(self, s, p, o=None):
-        return self._rdfmanifest.del_triple(s,p,o)
+        return self.get_rdf_manifest().del_triple(s,p,o)
+    def del_triples(self, patterns):
+        return self.get_rdf_manifest().del_triples(patterns)
     def del_namespace(self, prefix):
-        return self._rdfmanifest.del_namespace(prefix)
+        return self.get_rdf_manifest().del_namespace(prefix)
     def get_graph(self):
-        return self._rdfmanifest.get_graph()
+        return self.get_rdf_manifest().get_graph()
     def rdf_to_string(self, format="xml"):
-        return self._rdfmanifest.to_string(format)
+        return self.get_rdf_manifest().to_string(format)
     
     ##############
     ## Classes to annotate with rdf manifest updating
     
-    def put_stream(self, filename, filetostream, version=None, metadata=False, sync=True):
-        super(RDFRecord, self).put_stream(filename, filetostream, version=version, metadata=metadata, sync=False)
+    def aggregate_files(self, filenames):
+        """Add ore:aggregates triples for a number of files in the current version in one go."""
+        rdffilename = self.manifest['rdffilename']
+        self.add_triples([(self.uri, "ore:aggregates", "%s/%s" % (self.uri, filename))
+                          for filename in filenames if filename != rdffilename])
+
+    def _file_added(self, filename, version):
         if filename == self.manifest['rdffilename']:
-            self.load_rdf_manifest()
-        else:
+            self._unload_rdf_manifest()
+            if version == self.currentversion:
+                self._rdf_written()
+        elif version == self.currentversion:
+            # Only the current version's RDF manifest is held; copies into other versions (clone_version)
+            # bring that version's manifest.rdf with them
             self.add_triple(self.uri, "ore:aggregates", "%s/%s" % (self.uri, filename))
-        if sync:
-            self.sync()
     
+    @_locked
     def del_stream(self, filename, versions=[]):
         super(RDFRecord, self).del_stream(filename, versions=versions)
         if self.currentversion in versions or not versions:
             self.del_triple(self.uri, "ore:aggregates", "%s/%s" % (self.uri, filename))
         self.sync()
 
+    @_locked
     def del_dir(self, dirpath):
         dirpath_f = self.to_dirpath(filepath=dirpath)
         #for p in (os.path.join(dirpath_f,f) for f in os.listdir(dirpath_f)):
@@ -602,28 +1377,44 @@ class RDFRecord(HarvestedRecord):
         self.sync()
     
     def set_version_cursor(self, version):
-        super(RDFRecord, self).set_version_cursor(version)
-        self.load_rdf_manifest()
+        result = super(RDFRecord, self).set_version_cursor(version)
+        self._unload_rdf_manifest()
+        return result
         
     def revert(self, **kw):
         super(RDFRecord, self).revert(**kw)
-        if self.manifest.has_key('rdffilename') and self.manifest['rdffilename'] not in self.manifest['files'][self.manifest['currentversion']]:
-            self.manifest['files'][self.manifest['currentversion']].append(self.manifest['rdffilename'])
-        self.load_rdf_manifest()
+        self._unload_rdf_manifest()
         
-    def sync(self):
-        super(RDFRecord, self).sync()
-        if self.manifest.has_key('rdffilename') and self.manifest['rdffilename'] not in self.manifest['files'][self.manifest['currentversion']]:
-            self.manifest['files'][self.manifest['currentversion']].append(self.manifest['rdffilename'])
-        if self._rdfmanifest:
-            self._rdfmanifest.sync()
+    def _sync(self):
+        self._register_rdf_manifest_file()
+        if self._rdfmanifest is None and not os.path.isfile(self._path_to_rdfmanifest()):
+            # Every version is expected to carry an RDF manifest file, even an empty one
+            self.load_rdf_manifest()
+        if self._rdfmanifest is not None and self._rdfmanifest.sync():
+            self._forget_blob(self.currentversion, self.manifest['rdffilename'])
+            self._track_file_size(self.currentversion, self.manifest['rdffilename'])
+            self._update_checksum(self.currentversion, self.manifest['rdffilename'])
+            self._rdf_written(self._rdfmanifest.synced_changes)
+        super(RDFRecord, self)._sync()
+
+    def _rdf_written(self, changes=None):
+        # Listeners find (added, removed) triples in rdf_changes, or None if the whole graph is to be read
+        self.rdf_changes = changes
+        try:
+            for listener in self.rdf_sync_listeners:
+                listener(self)
+        finally:
+            self.rdf_changes = None
 
     def _copy_version(self, latest_version, new_version, exclude_filenames=[]):
         super(RDFRecord, self)._copy_version(latest_version, new_version, exclude_filenames)
-        self.load_rdf_manifest()
+        self._unload_rdf_manifest()
     
+    @_locked
     def move_directory_as_new_version(self, src_directory, version=None, force=False, date=None, log="Directory contents", _sync=True):
-        super(RDFRecord, self).move_directory_as_new_version(src_directory, version=version, force=force, date=date, log=log, _sync=False)
-        self.load_rdf_manifest()
+        version = super(RDFRecord, self).move_directory_as_new_version(src_directory, version=version, force=force, date=date, log=log, _sync=False)
+        self._unload_rdf_manifest()
+        self.aggregate_files(self.files)
         if _sync:
             self.sync()
+        return version
@@ -0,0 +1,126 @@
+"""Whole-silo jobs run across a pool of worker processes.
+
+The pairtree is partitioned by the shorty directories directly under pairtree_root. Each
+partition is handed to a worker, which opens the silo itself, loads every record in that
+partition and calls the user's function on it. The function (and what it returns) must be
+picklable, so it has to be defined at module level."""
+
+import os
+
+import traceback
+
+from collections import namedtuple
+
+from multiprocessing import Pool, cpu_count
+
+import logging
+
+logger = logging.getLogger("SiloScan")
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+
+logger.addHandler(ch)
+
+PAIRTREE_ROOT_DIR = "pairtree_root"
+
+# Silos opened by this worker process, keyed by (class, storage_dir, uri_base, record options). Scans run
+# in the calling process keep their own, for the length of the scan.
+_open_silos = {}
+
+# error is a formatted traceback, or None if func succeeded
+ScanResult = namedtuple("ScanResult", "silo item_id result error")
+
+def silo_partitions(storage_dir):
+    """Names of the top level shorty directories of a silo's pairtree."""
+    root = os.path.join(storage_dir, PAIRTREE_ROOT_DIR)
+    if not os.path.isdir(root):
+        return []
+    return sorted([x for x in os.listdir(root) if os.path.isdir(os.path.join(root, x))])
+
+def list_partition_ids(store, partition):
+    """Ids of the objects under one top level shorty directory, found the same way as
+    PairtreeStorageClient.list_ids walks the whole tree."""
+    paths = [os.path.join(store.pairtree_root, partition)]
+    seen = set()
+    while paths:
+        d = paths.pop()
+        for t in os.listdir(d):
+            if len(t) > store.shorty_length:
+                item_id = store._get_id_from_dirpath(d)
+                if item_id not in seen:
+                    seen.add(item_id)
+                    yield item_id
+            elif os.path.isdir(os.path.join(d, t)):
+                paths.append(os.path.join(d, t))
+
+def _get_silo(silo_class, storage_dir, uri_base, record_options, silos):
+    # repr, as some option values (checksums) may be lists
+    key = (silo_class, storage_dir, uri_base, repr(sorted(record_options.items())))
+    if key not in silos:
+        kw = dict(record_options)
+        silos[key] = silo_class(storage_dir, uri_base=uri_base, **kw)
+    return silos[key]
+
+def _scan_partition(task, silos=None):
+    if silos is None:
+        silos = _open_silos
+    silo_class, storage_dir, uri_base, record_options, label, partition, func = task
+    results = []
+    try:
+        silo = _get_silo(silo_class, storage_dir, uri_base, record_options, silos)
+        item_ids = list(list_partition_ids(silo._store, partition))
+    except Exception:
+        return [ScanResult(label, None, None, traceback.format_exc())]
+    for item_id in item_ids:
+        try:
+            record = silo.get_item(item_id)
+            results.append(ScanResult(label, item_id, func(record), None))
+        except Exception:
+            results.append(ScanResult(label, item_id, None, traceback.format_exc()))
+    return results
+
+def silo_tasks(silo, func, label=None):
+    """One task per partition of the given (open) silo."""
+    storage_dir = silo.state['storage_dir']
+    return [(silo.__class__, storage_dir, silo.state['uri_base'], silo.record_options, label, partition, func)
+            for partition in silo_partitions(storage_dir)]
+
+def run_tasks(tasks, workers=None, chunksize=1, ordered=True, progress=None):
+    """Generator of ScanResults for the given partition tasks.
+
+    workers - number of processes (defaults to the number of CPUs); 1 runs everything in this process
+    chunksize - number of partitions handed to a worker at a time
+    ordered - yield results in partition order, rather than as each partition completes
+    progress - called with the number of items processed so far, after each item"""
+    if workers is None:
+        workers = cpu_count()
+    done = 0
+    if workers <= 1:
+        # Not _open_silos, which would keep every silo scanned open in this process
+        silos = {}
+        batches = (_scan_partition(task, silos) for task in tasks)
+        pool = None
+    else:
+        pool = Pool(workers)
+        if ordered:
+            batches = pool.imap(_scan_partition, tasks, chunksize)
+        else:
+            batches = pool.imap_unordered(_scan_partition, tasks, chunksize)
+    try:
+        for batch in batches:
+            for result in batch:
+                if result.error:
+                    logger.debug("Scan of item %s in %s failed: %s" % (result.item_id, result.silo, result.error))
+                done += 1
+                if progress:
+                    progress(done)
+                yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
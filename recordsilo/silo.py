@@ -6,13 +6,31 @@ from persiststate import PersistentState
 
 from records import HarvestedRecord, RDFRecord
 
+from itemindex import ItemIndex
+
+from siloindex import SiloIndex, index_entry
+
+from tripleindex import TripleIndex, triple_entry
+
+from manifesthelper import ManifestHelper
+
+from journal import Journal, SEGMENT_SIZE
+
+from diskusage import tree_usage
+
+from lrucache import LRUCache
+
+from scan import silo_tasks, run_tasks
+
+from ingest import BUFFER_SIZE
+
 from pairtree import PairtreeStorageClient
 from pairtree import id_encode, id_decode
 from pairtree import FileNotFoundException, ObjectNotFoundException
 
 from datetime import datetime
 
-from os import path, mkdir, rename, listdir, popen
+from os import path, mkdir, rename, listdir
 
 from shutil import copy2, rmtree
 
@@ -24,6 +42,8 @@ import sys, traceback
 
 import re
 
+import threading
+
 logger = logging.getLogger("RecordSilo")
 logger.setLevel(logging.INFO)
 
@@ -39,12 +59,50 @@ PAIRTREE_ROOT_DIR = "pairtree_root"
 
 NAMASTE_PATTERN = re.compile(r"[^0=|1=|2=|3=|4=|5=]")  # Must try hard to better this regex
 
+def _split_manifest(record):
+    return record.set_manifest_layout(True)
+
+def _join_manifest(record):
+    return record.set_manifest_layout(False)
+
 class SiloNotFound(Exception):
     pass
 
 class Silo(object):
-    """Item persistence layer - uses pairtree as a basis for storage."""
-    def __init__(self, storage_dir, uri_base=None, **kw):
+    """Item persistence layer - uses pairtree as a basis for storage.
+
+    If item_index is True, the ids of the items are kept in a persistent index next to the silo's
+    state file, so that len(), keys(), exists() and listing do not need to walk the pairtree.
+
+    manifest_fsync, manifest_backup and manifest_serialiser are passed on to the records' manifests (see PersistentState).
+
+    If dedup is True, records store file contents once per item in a content addressed blob store (see HarvestedRecord).
+    If copy_hardlinks is True, files copied between versions may be hard linked rather than copied.
+    checksums names the hashlib algorithm(s) records hash their files with as they are written, if any.
+    buffer_size is the chunk size records read and write files in.
+    If locking is True, records lock their item while changing it, so several processes can write to the silo (see HarvestedRecord).
+    If split_manifest is True, new items keep each version's part of their manifest in the version's directory (see HarvestedRecord);
+    convert_manifests() moves the existing items over, or back.
+    If track_sizes is True, records keep per-file and per-version byte counts in their manifests (see HarvestedRecord).
+
+    If search_index is True, an SQLite index of the items' versions, files and metadata is kept up to date
+    as records are written, for query(). rebuild_search_index() builds it for an existing silo.
+
+    If journal is True, every change made to the items through this silo is appended to a journal of
+    segments of up to journal_segment_size bytes, which changes(since) reads back (see journal.py).
+    journal_fsync flushes each entry to disc as it is written.
+
+    If cache_size is set, up to that many records are kept open and get_item hands back the same
+    object for an item until its manifest is rewritten by someone else; records asked for with a date or a
+    startversion other than "1" are not cached. See cache_info()."""
+    record_class = HarvestedRecord
+
+    def __init__(self, storage_dir, uri_base=None, item_index=False, manifest_fsync=True, manifest_backup=False, manifest_serialiser=None, cache_size=0, dedup=False, copy_hardlinks=False, checksums=None, buffer_size=BUFFER_SIZE, locking=False, lock_timeout=None, split_manifest=False, track_sizes=False, search_index=False, journal=False, journal_segment_size=SEGMENT_SIZE, journal_fsync=False, **kw):
+        self.record_options = {'manifest_fsync':manifest_fsync, 'manifest_backup':manifest_backup,
+                               'manifest_serialiser':manifest_serialiser, 'dedup':dedup,
+                               'copy_hardlinks':copy_hardlinks, 'checksums':checksums,
+                               'buffer_size':buffer_size, 'locking':locking, 'lock_timeout':lock_timeout,
+                               'split_manifest':split_manifest, 'track_sizes':track_sizes}
         self.state = PersistentState()
         self.state['storage_dir'] = storage_dir
         if not uri_base:
@@ -56,6 +114,20 @@ class Silo(object):
             self.state['uri_base'] = uri_base
         self.state.update(kw)
         self._init_storage()
+        self._index = None
+        if item_index:
+            self._init_item_index()
+        self._cache = None
+        if cache_size:
+            self._cache = LRUCache(cache_size)
+        # Guards the item index and record cache, for callers using the silo from several threads
+        self._lock = threading.RLock()
+        self._search_index = None
+        if search_index:
+            self._init_search_index()
+        self._journal = None
+        if journal:
+            self._journal = Journal(self.state['storage_dir'], segment_size=journal_segment_size, fsync=journal_fsync)
         
     def _init_storage(self):
         try:
@@ -74,6 +146,78 @@ class Silo(object):
             logger.error("Cannot setup the state persistence file at %s/%s" % (self.state['storage_dir'], "__manifest.json"))
             raise Exception("Cannot setup the state persistence file at %s/%s" % (self.state['storage_dir'], "__manifest.json"))
 
+    def _init_item_index(self):
+        self._index = ItemIndex(self.state['storage_dir'])
+        if not self._index.is_persisted():
+            logger.info("Building item index for silo at %s" % self.state['storage_dir'])
+            self.rebuild_item_index()
+
+    def rebuild_item_index(self):
+        """Rebuild the item index by walking the pairtree. Use this if the silo has been
+        written to by something that does not maintain the index."""
+        if self._index is None:
+            self._index = ItemIndex(self.state['storage_dir'])
+        self._index.rebuild(self._store.list_ids())
+
+    def _init_search_index(self):
+        self._search_index = SiloIndex(self.state['storage_dir'])
+        if self._search_index.created:
+            logger.info("Building search index for silo at %s" % self.state['storage_dir'])
+            self.rebuild_search_index(workers=1)
+
+    def rebuild_search_index(self, workers=None, progress=None):
+        """Rebuild the search index from the records' manifests, read in parallel by map_items (workers as there).
+        Returns the ScanResults of any items that could not be read."""
+        if self._search_index is None:
+            self._search_index = SiloIndex(self.state['storage_dir'])
+        self._search_index.clear()
+        failed = []
+        batch = []
+        for result in self.map_items(index_entry, workers=workers, ordered=False, progress=progress):
+            if result.error:
+                failed.append(result)
+                continue
+            batch.append(result.result)
+            if len(batch) >= 500:
+                self._search_index.update_entries(batch)
+                batch = []
+        self._search_index.update_entries(batch)
+        return failed
+
+    def convert_manifests(self, split=True, workers=None, progress=None):
+        """Convert the manifest of every item to the split layout (or, with split False, back to the original one),
+        in parallel by map_items (workers as there). Returns the ScanResults of any items that could not be converted."""
+        func = split and _split_manifest or _join_manifest
+        return [result for result in self.map_items(func, workers=workers, ordered=False, progress=progress) if result.error]
+
+    def query(self, metadata=None, prefix=None, filename=None, version_date_from=None, version_date_to=None,
+              item_prefix=None, limit=None, offset=0):
+        """Ids of the items matching the given filters, from the search index. See SiloIndex.query."""
+        if self._search_index is None:
+            raise Exception("This silo was not opened with search_index=True")
+        return self._search_index.query(metadata=metadata, prefix=prefix, filename=filename,
+                                        version_date_from=version_date_from, version_date_to=version_date_to,
+                                        item_prefix=item_prefix, limit=limit, offset=offset)
+
+    def changes(self, since=0):
+        """Generator of the journal's Changes (seq, time, item_id, version, op, filename) after seq since, oldest first.
+        Keep the seq of the last change handled and pass it as since next time."""
+        if self._journal is None:
+            raise Exception("This silo was not opened with journal=True")
+        return self._journal.changes(since)
+
+    def journal_position(self):
+        """Seq of the newest change in the journal, for a consumer starting from the silo as it is now."""
+        if self._journal is None:
+            raise Exception("This silo was not opened with journal=True")
+        return self._journal.last_seq()
+
+    def prune_journal(self, upto):
+        """Delete the journal segments holding only changes up to seq upto, once every consumer has read them."""
+        if self._journal is None:
+            raise Exception("This silo was not opened with journal=True")
+        return self._journal.prune(upto)
+
     def __iter__(self):
         return self.list_items()
 
@@ -81,59 +225,186 @@ class Silo(object):
         for item in self.list_items():
             yield self.get_item(item)
 
+    def map_items(self, func, workers=None, chunksize=1, ordered=True, progress=None):
+        """Call func(record) on every item of the silo using a pool of worker processes, yielding a
+        ScanResult (silo, item_id, result, error) per item. Failures are reported in error rather than raised.
+        func must be picklable, i.e. defined at module level. See recordsilo.scan.run_tasks for the options."""
+        name = path.basename(path.normpath(self.state['storage_dir']))
+        return run_tasks(silo_tasks(self, func, label=name), workers=workers, chunksize=chunksize,
+                         ordered=ordered, progress=progress)
+
     def __getitem__(self, key):
         if self.exists(key):
             return self.get_item(key)
 
-    def __len__(self): return len(self.keys())
+    def __len__(self):
+        if self._index is not None:
+            return len(self._index)
+        return len(self.keys())
 
     def keys(self): return [x for x in self.__iter__()]
     def has_key(self, key): return self.exists(key)
     def exists(self, item_id):
+        if self._index is not None:
+            return item_id in self._index
         return self._store.exists(item_id)
 
+    def _get_pairtree_object(self, item_id, force=False):
+        if not self.exists(item_id) and not force and self.exists(self.state['uri_base'] + item_id):
+            item_id = self.state['uri_base'] + item_id
+        p_obj = self._store.get_object(item_id)
+        if self._index is not None:
+            with self._lock:
+                self._index.add(p_obj.id)
+        return p_obj
+
     def get_item(self, item_id, date=None, force=False, startversion="1"):
-        if self.exists(item_id):
-            p_obj = self._store.get_object(item_id)
-            return HarvestedRecord(p_obj, date, startversion=startversion)
-        elif self.exists(self.state['uri_base'] + item_id) and not force:
-            p_obj = self._store.get_object(self.state['uri_base'] + item_id)
-            return HarvestedRecord(p_obj, date, startversion=startversion)
-        else:
-            p_obj = self._store.get_object(item_id)
-            return HarvestedRecord(p_obj, date, startversion=startversion)
+        p_obj = self._get_pairtree_object(item_id, force=force)
+        # A record opened with another date or startversion is not the one the cache holds
+        cached = self._cache is not None and date is None and startversion == "1"
+        if cached:
+            with self._lock:
+                record = self._cache.get(p_obj.id)
+                if record is not None:
+                    if not record.is_stale():
+                        return record
+                    self._cache.miss()
+                    self._cache.discard(p_obj.id)
+        record = self.record_class(p_obj, date, startversion=startversion, **self.record_options)
+        self._record_opened(record)
+        if cached:
+            with self._lock:
+                self._cache.put(p_obj.id, record)
+        return record
+
+    def _record_opened(self, record):
+        """Hook up a newly loaded record to the silo's indexes."""
+        if self._search_index is not None:
+            record.sync_listeners.append(self._search_index.update)
+            if record.created:
+                self._search_index.update(record)
+        if self._journal is not None:
+            record.change_listeners.append(self._journal.record_change)
+            if record.created:
+                self._journal.append(record.item_id, "create_item", record.currentversion)
+
+    def _item_deleted(self, item_id):
+        if self._search_index is not None:
+            self._search_index.remove(item_id)
+        if self._journal is not None:
+            self._journal.append(item_id, "del_item")
+
+    def cache_info(self):
+        """Hit/miss counts and size of the record cache, or None if caching is off."""
+        if self._cache is not None:
+            return self._cache.info()
+
+    def clear_cache(self):
+        if self._cache is not None:
+            self._cache.clear()
 
     def del_item(self, item_id):
-        if self.exists(item_id):
-            return self._store.delete_object(item_id)
-        elif self.exists(self.state['uri_base'] + item_id):
-            return self._store.delete_object(self.state['uri_base'] + item_id)
-        else:
-            raise ObjectNotFoundException
-
-    def list_items(self):
+        if not self.exists(item_id):
+            if self.exists(self.state['uri_base'] + item_id):
+                item_id = self.state['uri_base'] + item_id
+            else:
+                raise ObjectNotFoundException
+        resp = self._store.delete_object(item_id)
+        with self._lock:
+            if self._cache is not None:
+                self._cache.discard(item_id)
+            if self._index is not None:
+                self._index.remove(item_id)
+        self._item_deleted(item_id)
+        return resp
+
+    def list_items(self, prefix=None):
+        if self._index is not None:
+            if prefix:
+                return self._index.ids_with_prefix(prefix)
+            return iter(self._index)
+        if prefix:
+            return (x for x in self._store.list_ids() if x.startswith(prefix))
         return self._store.list_ids()
 
 
 class RDFSilo(Silo):
-    def get_item(self, item_id, date=None, force=False, startversion="1"):
-        if self.exists(item_id):
-            p_obj = self._store.get_object(item_id)
-            return RDFRecord(p_obj, date, startversion=startversion)
-        elif self.exists(self.state['uri_base'] + item_id) and not force:
-            p_obj = self._store.get_object(self.state['uri_base'] + item_id)
-            return RDFRecord(p_obj, date, startversion=startversion)
-        else:
-            p_obj = self._store.get_object(item_id)
-            return RDFRecord(p_obj, date, startversion=startversion)
-
-    def del_item(self, item_id):
-        if self.exists(item_id):
-            return self._store.delete_object(item_id)
-        elif self.exists(self.state['uri_base'] + item_id):
-            return self._store.delete_object(self.state['uri_base'] + item_id)
-        else:
-            raise ObjectNotFoundException
+    """Silo of RDFRecords.
+
+    If triple_index is True, the triples of the current version of every item's RDF manifest are kept in
+    an SQLite index next to the silo's state file, updated as records write their RDF manifests, so that
+    triples() and find_items() can answer without opening the items. rebuild_triple_index() builds it
+    for an existing silo.
+
+    rdf_sidecar is passed on to the records (see RDFRecord)."""
+    record_class = RDFRecord
+
+    def __init__(self, storage_dir, uri_base=None, triple_index=False, rdf_sidecar=True, **kw):
+        self._triple_index = None
+        self._term_helper = None
+        super(RDFSilo, self).__init__(storage_dir, uri_base=uri_base, **kw)
+        self.record_options['rdf_sidecar'] = rdf_sidecar
+        if triple_index:
+            self._init_triple_index()
+
+    def _init_triple_index(self):
+        self._triple_index = TripleIndex(self.state['storage_dir'])
+        if self._triple_index.created:
+            logger.info("Building triple index for silo at %s" % self.state['storage_dir'])
+            self.rebuild_triple_index(workers=1)
+
+    def rebuild_triple_index(self, workers=None, progress=None):
+        """Rebuild the triple index from the records' RDF manifests, read in parallel by map_items (workers as there).
+        Returns the ScanResults of any items that could not be read."""
+        if self._triple_index is None:
+            self._triple_index = TripleIndex(self.state['storage_dir'])
+        self._triple_index.clear()
+        failed = []
+        batch = []
+        for result in self.map_items(triple_entry, workers=workers, ordered=False, progress=progress):
+            if result.error:
+                failed.append(result)
+                continue
+            batch.append(result.result)
+            if len(batch) >= 100:
+                self._triple_index.update_entries(batch)
+                batch = []
+        self._triple_index.update_entries(batch)
+        return failed
+
+    def _record_opened(self, record):
+        super(RDFSilo, self)._record_opened(record)
+        if self._triple_index is not None:
+            record.rdf_sync_listeners.append(self._triple_index.update)
+            # Catches the cursor being moved to another version, whose RDF manifest is already on disc
+            record.sync_listeners.append(self._triple_index.check_version)
+
+    def _item_deleted(self, item_id):
+        super(RDFSilo, self)._item_deleted(item_id)
+        if self._triple_index is not None:
+            self._triple_index.remove(item_id)
+
+    def _normalise_pattern(self, s, p, o):
+        if self._term_helper is None:
+            self._term_helper = ManifestHelper()
+        return self._term_helper._normalise_triple(s, p, o, wildcards=True)
+
+    def triples(self, s='*', p='*', o='*', item_id=None, limit=None, offset=0):
+        """Generator of (item id, (s, p, o)) for the triples in the items' current RDF manifests that match the
+        pattern, from the triple index. Terms are given as for RDFRecord.triple_exists ('*' or None matches anything),
+        and item_id restricts the search to one item."""
+        if self._triple_index is None:
+            raise Exception("This silo was not opened with triple_index=True")
+        s, p, o = self._normalise_pattern(s, p, o)
+        return self._triple_index.triples(s, p, o, item_id=item_id, limit=limit, offset=offset)
+
+    def find_items(self, s='*', p='*', o='*'):
+        """Sorted ids of the items whose current RDF manifest has a triple matching the pattern, e.g.
+        find_items(p="ore:aggregates", o=file_uri) for the items that aggregate a file."""
+        if self._triple_index is None:
+            raise Exception("This silo was not opened with triple_index=True")
+        s, p, o = self._normalise_pattern(s, p, o)
+        return self._triple_index.item_ids(s, p, o)
 
 class Granary(object):
     def __init__(self, dir_of_silos="data"):
@@ -184,12 +455,24 @@ class Granary(object):
     def get_rdf_silo(self, silo_name, uri_base=None, **kw):
         return RDFSilo(path.join(self.root_dir, silo_name), uri_base=uri_base, **kw)
 
+    def map_silos(self, func, silo_names=None, rdf=False, workers=None, chunksize=1, ordered=True, progress=None):
+        """As Silo.map_items, across all (or the named) silos of the granary, sharing one pool of workers.
+        The items are loaded as RDFRecords if rdf is True."""
+        if silo_names is None:
+            silo_names = self.silos
+        tasks = []
+        for silo_name in silo_names:
+            if not self.issilo(silo_name):
+                raise SiloNotFound(silo_name)
+            if rdf:
+                silo = self.get_rdf_silo(silo_name)
+            else:
+                silo = self.get_silo(silo_name)
+            tasks.extend(silo_tasks(silo, func, label=silo_name))
+        return run_tasks(tasks, workers=workers, chunksize=chunksize, ordered=ordered, progress=progress)
+
     def disk_usage_silo(self, silo_name):
+        """Space taken by a silo in KB, as a string like `du -ks` gives."""
         if self.issilo(silo_name):
             silo_dir = path.join(self.root_dir, silo_name)
-            command = "du -ks %s" %silo_dir
-            fileobject = popen(command)
-            dataline = fileobject.read()
-            fileobject.close()
-            data = dataline[:-1].split("\t") 
-            return data[0]
\ No newline at end of file
+            return str(tree_usage(silo_dir)[1])
\ No newline at end of file
@@ -0,0 +1,212 @@
+"""Searchable index of the items of a silo, kept in an SQLite database next to the silo's state file.
+
+For each item it holds the current version and date, the date of every version, the files of every
+version and the item's metadata, flattened so that {'a': {'b': 1}, 'c': [2, 3]} becomes the
+key/value pairs a.b=1, c=2 and c=3. Records update it whenever they write their manifest; only the file
+lists of the versions changed by that write (see ItemManifest.synced_versions) are re-read and replaced."""
+
+from __future__ import with_statement
+
+import os
+
+import threading
+
+import sqlite3
+
+import logging
+
+logger = logging.getLogger("SiloIndex")
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+
+logger.addHandler(ch)
+
+SILO_INDEX_FILENAME = "__silo_index.sqlite"
+
+# Seconds to wait for another process's write to finish
+DB_TIMEOUT = 30
+
+# Sorts after any character likely to be found in a value, for prefix ranges
+PREFIX_END = u"\uffff"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (item_id TEXT PRIMARY KEY, currentversion TEXT, date TEXT);
+CREATE TABLE IF NOT EXISTS versions (item_id TEXT, version TEXT, date TEXT);
+CREATE TABLE IF NOT EXISTS files (item_id TEXT, version TEXT, filename TEXT);
+CREATE TABLE IF NOT EXISTS metadata (item_id TEXT, key TEXT, value TEXT);
+CREATE INDEX IF NOT EXISTS versions_item ON versions (item_id);
+CREATE INDEX IF NOT EXISTS versions_date ON versions (date);
+CREATE INDEX IF NOT EXISTS files_item ON files (item_id);
+CREATE INDEX IF NOT EXISTS files_filename ON files (filename);
+CREATE INDEX IF NOT EXISTS metadata_item ON metadata (item_id);
+CREATE INDEX IF NOT EXISTS metadata_key_value ON metadata (key, value);
+"""
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    return unicode(value)
+
+def flatten_metadata(metadata, prefix=""):
+    """List of (dotted key, value) pairs for a nested dict of metadata."""
+    pairs = []
+    for key, value in metadata.iteritems():
+        key = prefix + _text(key)
+        if isinstance(value, dict):
+            pairs.extend(flatten_metadata(value, key + "."))
+        elif isinstance(value, (list, tuple, set)):
+            for v in value:
+                if isinstance(v, dict):
+                    pairs.extend(flatten_metadata(v, key + "."))
+                else:
+                    pairs.append((key, _text(v)))
+        elif value is not None:
+            pairs.append((key, _text(value)))
+    return pairs
+
+def index_entry(record, versions=None):
+    """What the index holds for a record, as a picklable dict (so that it can be worked out in another process).
+    If versions is given, the files of only those versions are listed, and entry['changed'] says which they were."""
+    manifest = record.manifest
+    entry = {'item_id':record.item_id, 'currentversion':manifest['currentversion'], 'date':manifest.get('date'),
+             'versions':[], 'files':[], 'metadata':flatten_metadata(manifest.get('metadata') or {}),
+             'changed':None}
+    if versions is not None:
+        entry['changed'] = [v for v in manifest['versions'] if v in versions]
+    for version in manifest['versions']:
+        entry['versions'].append((version, manifest['version_dates'].get(version)))
+        if versions is not None and version not in versions:
+            continue
+        for filename in manifest['files'].get(version, []):
+            entry['files'].append((version, filename))
+    return entry
+
+class SiloIndex(object):
+    def __init__(self, dirpath, filename=SILO_INDEX_FILENAME):
+        self.filepath = os.path.join(dirpath, filename)
+        self._lock = threading.RLock()
+        existed = os.path.isfile(self.filepath)
+        self._db = sqlite3.connect(self.filepath, timeout=DB_TIMEOUT, check_same_thread=False)
+        with self._lock:
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+        self.created = not existed
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _delete(self, item_id):
+        for table in ("items", "versions", "files", "metadata"):
+            self._db.execute("DELETE FROM %s WHERE item_id = ?" % table, (item_id,))
+
+    def _indexed_versions(self, item_id):
+        """Versions of an item the index has files for, or None if the item is not in the index."""
+        if self._db.execute("SELECT 1 FROM items WHERE item_id = ?", (item_id,)).fetchone() is None:
+            return None
+        return set(row[0] for row in self._db.execute("SELECT version FROM versions WHERE item_id = ?", (item_id,)))
+
+    def _insert(self, entry):
+        item_id = _text(entry['item_id'])
+        if entry.get('changed') is None:
+            self._delete(item_id)
+        else:
+            # Keep the file rows of the versions that have not changed, but not of those since deleted
+            current = set(v for v, d in entry['versions'])
+            stale = set(row[0] for row in self._db.execute("SELECT DISTINCT version FROM files WHERE item_id = ?", (item_id,)))
+            stale = stale.difference(current).union(entry['changed'])
+            for table in ("items", "versions", "metadata"):
+                self._db.execute("DELETE FROM %s WHERE item_id = ?" % table, (item_id,))
+            self._db.executemany("DELETE FROM files WHERE item_id = ? AND version = ?", [(item_id, v) for v in stale])
+        self._db.execute("INSERT INTO items VALUES (?, ?, ?)", (item_id, entry['currentversion'], entry['date']))
+        self._db.executemany("INSERT INTO versions VALUES (?, ?, ?)", [(item_id, v, d) for v, d in entry['versions']])
+        self._db.executemany("INSERT INTO files VALUES (?, ?, ?)", [(item_id, v, _text(f)) for v, f in entry['files']])
+        self._db.executemany("INSERT INTO metadata VALUES (?, ?, ?)", [(item_id, k, v) for k, v in entry['metadata']])
+
+    def update(self, record):
+        """Bring the index up to date with a record. Suitable as a record sync listener: the file lists of
+        the versions its last sync covered, and of any versions the index does not have yet, are replaced."""
+        versions = getattr(record.manifest, 'synced_versions', None)
+        if versions is not None:
+            with self._lock:
+                indexed = self._indexed_versions(_text(record.item_id))
+            if indexed is None:
+                versions = None
+            else:
+                versions = set(versions) | set(v for v in record.manifest['versions'] if v not in indexed)
+        self.update_entries([index_entry(record, versions)])
+
+    def update_entries(self, entries):
+        with self._lock:
+            try:
+                for entry in entries:
+                    self._insert(entry)
+                self._db.commit()
+            except:
+                self._db.rollback()
+                raise
+
+    def remove(self, item_id):
+        with self._lock:
+            self._delete(_text(item_id))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            for table in ("items", "versions", "files", "metadata"):
+                self._db.execute("DELETE FROM %s" % table)
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def query(self, metadata=None, prefix=None, filename=None, version_date_from=None, version_date_to=None,
+              item_prefix=None, limit=None, offset=0):
+        """Ids of the items matching all of the given filters, sorted, a page at a time.
+
+        metadata - {key: value} that must all be present (keys are dotted paths into the metadata)
+        prefix - {key: prefix} of metadata values that must be present
+        filename - the name of a file in any version of the item
+        version_date_from, version_date_to - some version of the item is dated within this range (inclusive, ISO dates)
+        item_prefix - start of the item id
+        limit, offset - the page of results wanted"""
+        clauses = []
+        args = []
+        for key, value in (metadata or {}).iteritems():
+            clauses.append("item_id IN (SELECT item_id FROM metadata WHERE key = ? AND value = ?)")
+            args.extend([_text(key), _text(value)])
+        for key, value in (prefix or {}).iteritems():
+            clauses.append("item_id IN (SELECT item_id FROM metadata WHERE key = ? AND value >= ? AND value < ?)")
+            args.extend([_text(key), _text(value), _text(value) + PREFIX_END])
+        if filename is not None:
+            clauses.append("item_id IN (SELECT item_id FROM files WHERE filename = ?)")
+            args.append(_text(filename))
+        if version_date_from is not None or version_date_to is not None:
+            date_clauses = []
+            if version_date_from is not None:
+                date_clauses.append("date >= ?")
+                args.append(version_date_from)
+            if version_date_to is not None:
+                date_clauses.append("date <= ?")
+                args.append(version_date_to)
+            clauses.append("item_id IN (SELECT item_id FROM versions WHERE %s)" % " AND ".join(date_clauses))
+        if item_prefix:
+            clauses.append("item_id >= ? AND item_id < ?")
+            args.extend([_text(item_prefix), _text(item_prefix) + PREFIX_END])
+        sql = "SELECT item_id FROM items"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY item_id"
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            args.extend([limit is None and -1 or limit, offset])
+        with self._lock:
+            return [row[0] for row in self._db.execute(sql, args)]
@@ -0,0 +1,164 @@
+"""Silo-wide index of the triples in the RDF manifests of an RDFSilo's items, kept in an SQLite database
+next to the silo's state file.
+
+It holds the current version's RDF manifest of each item, as rows of (item id, version, subject,
+predicate, object) with the terms in N3 form, and is updated whenever a record writes its RDF
+manifest (with just the triples added and removed, where the record knows them) or moves to another
+version. Queries never have to open the items themselves."""
+
+from __future__ import with_statement
+
+import os
+
+import threading
+
+import sqlite3
+
+from rdflib.util import from_n3
+
+import logging
+
+logger = logging.getLogger("TripleIndex")
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.INFO)
+
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+
+logger.addHandler(ch)
+
+TRIPLE_INDEX_FILENAME = "__triple_index.sqlite"
+
+DB_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (item_id TEXT PRIMARY KEY, version TEXT);
+CREATE TABLE IF NOT EXISTS quads (item_id TEXT, version TEXT, s TEXT, p TEXT, o TEXT);
+CREATE INDEX IF NOT EXISTS quads_item ON quads (item_id);
+CREATE INDEX IF NOT EXISTS quads_s ON quads (s, p);
+CREATE INDEX IF NOT EXISTS quads_po ON quads (p, o);
+CREATE INDEX IF NOT EXISTS quads_o ON quads (o);
+"""
+
+def triple_entry(record):
+    """(item id, version, [(s, p, o) in N3]) for the current version of an RDFRecord - picklable,
+    so that it can be worked out in another process."""
+    graph = record.get_rdf_manifest().g
+    return (record.item_id, record.currentversion, [(s.n3(), p.n3(), o.n3()) for s, p, o in graph])
+
+class TripleIndex(object):
+    def __init__(self, dirpath, filename=TRIPLE_INDEX_FILENAME):
+        self.filepath = os.path.join(dirpath, filename)
+        self._lock = threading.RLock()
+        existed = os.path.isfile(self.filepath)
+        self._db = sqlite3.connect(self.filepath, timeout=DB_TIMEOUT, check_same_thread=False)
+        with self._lock:
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+        self.created = not existed
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _insert(self, entry):
+        item_id, version, triples = entry
+        self._db.execute("DELETE FROM quads WHERE item_id = ?", (item_id,))
+        self._db.execute("INSERT OR REPLACE INTO items VALUES (?, ?)", (item_id, version))
+        self._db.executemany("INSERT INTO quads VALUES (?, ?, ?, ?, ?)",
+                             [(item_id, version, s, p, o) for s, p, o in triples])
+
+    def update(self, record):
+        """Bring an item's triples up to date with the record's current RDF manifest. Suitable as an RDF sync
+        listener: the changes in record.rdf_changes are applied if there are any, otherwise all of the item's
+        triples are replaced."""
+        changes = getattr(record, 'rdf_changes', None)
+        if changes is not None and self.indexed_version(record.item_id) == record.currentversion:
+            self.apply_changes(record.item_id, record.currentversion, *changes)
+        else:
+            self.update_entries([triple_entry(record)])
+
+    def apply_changes(self, item_id, version, added, removed):
+        """Remove and add sets of rdflib triples for an item."""
+        with self._lock:
+            try:
+                self._db.executemany("DELETE FROM quads WHERE item_id = ? AND s = ? AND p = ? AND o = ?",
+                                     [(item_id, s.n3(), p.n3(), o.n3()) for s, p, o in removed])
+                self._db.executemany("INSERT INTO quads VALUES (?, ?, ?, ?, ?)",
+                                     [(item_id, version, s.n3(), p.n3(), o.n3()) for s, p, o in added])
+                self._db.commit()
+            except:
+                self._db.rollback()
+                raise
+
+    def update_entries(self, entries):
+        with self._lock:
+            try:
+                for entry in entries:
+                    self._insert(entry)
+                self._db.commit()
+            except:
+                self._db.rollback()
+                raise
+
+    def indexed_version(self, item_id):
+        with self._lock:
+            row = self._db.execute("SELECT version FROM items WHERE item_id = ?", (item_id,)).fetchone()
+        if row:
+            return row[0]
+
+    def check_version(self, record):
+        """Re-index a record if it has moved to another version since it was indexed. Suitable as a sync listener."""
+        if self.indexed_version(record.item_id) != record.currentversion:
+            self.update(record)
+
+    def remove(self, item_id):
+        with self._lock:
+            self._db.execute("DELETE FROM quads WHERE item_id = ?", (item_id,))
+            self._db.execute("DELETE FROM items WHERE item_id = ?", (item_id,))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM quads")
+            self._db.execute("DELETE FROM items")
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM quads").fetchone()[0]
+
+    def _where(self, s, p, o, item_id):
+        clauses = []
+        args = []
+        for column, term in (("s", s), ("p", p), ("o", o)):
+            if term is not None:
+                clauses.append("%s = ?" % column)
+                args.append(term.n3())
+        if item_id is not None:
+            clauses.append("item_id = ?")
+            args.append(item_id)
+        if clauses:
+            return " WHERE " + " AND ".join(clauses), args
+        return "", args
+
+    def triples(self, s=None, p=None, o=None, item_id=None, limit=None, offset=0):
+        """Generator of (item id, (s, p, o)) for the triples matching the pattern, given as rdflib terms
+        with None as a wildcard."""
+        where, args = self._where(s, p, o, item_id)
+        sql = "SELECT item_id, s, p, o FROM quads" + where + " ORDER BY item_id"
+        if limit is not None or offset:
+            sql += " LIMIT ? OFFSET ?"
+            args.extend([limit is None and -1 or limit, offset])
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        for item_id, s, p, o in rows:
+            yield item_id, (from_n3(s), from_n3(p), from_n3(o))
+
+    def item_ids(self, s=None, p=None, o=None):
+        """Sorted ids of the items with a triple matching the pattern."""
+        where, args = self._where(s, p, o, None)
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT DISTINCT item_id FROM quads" + where + " ORDER BY item_id", args)]
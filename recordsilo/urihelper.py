@@ -21,6 +21,9 @@ NAMESPACES['foaf'] = Namespace(u'http://xmlns.com/foaf/0.1/')
 NAMESPACES['oxds'] = Namespace(u'http://vocab.ox.ac.uk/dataset/schema#')
 NAMESPACES['ore'] = Namespace(u'http://www.openarchives.org/ore/terms/')
 
+# Upper bound on the number of remembered term resolutions per URIHelper
+TERM_CACHE_SIZE = 4096
+
 
 class NotANamespaceException(Exception):
     """An attempt to get a namespace was made and the URI didn't end in # or /"""
@@ -35,7 +38,11 @@ class URINotSetException(Exception):
     pass
 
 class URIHelper:
-    def __init__(self, namespaces):
+    """Turns text (full URIs or prefix:name shorthand) into rdflib terms.
+
+    Resolutions of text are remembered (up to cache_size of them, 0 to disable) until the set
+    of known prefixes is changed through add_namespace or del_namespace."""
+    def __init__(self, namespaces, cache_size=TERM_CACHE_SIZE):
         #Just a placeholder
         if not namespaces:
             self.namespaces = {}
@@ -43,7 +50,30 @@ class URIHelper:
                 self.namespaces[ns] = NAMESPACES[ns]
         else:
             self.namespaces = namespaces
+        self.cache_size = cache_size
+        self._term_cache = {}
         return
+
+    def add_namespace(self, prefix, namespace):
+        self.namespaces[prefix] = namespace
+        self._term_cache.clear()
+
+    def del_namespace(self, prefix):
+        if prefix in self.namespaces:
+            del self.namespaces[prefix]
+            self._term_cache.clear()
+
+    def _cached(self, key, resolve, *args):
+        try:
+            return self._term_cache[key]
+        except KeyError:
+            pass
+        term = resolve(*args)
+        if self.cache_size:
+            if len(self._term_cache) >= self.cache_size:
+                self._term_cache.clear()
+            self._term_cache[key] = term
+        return term
     
     def literal_datetime_to_obj(self, lit_datetime):
         l = lit_datetime.toPython()
@@ -57,21 +87,25 @@ class URIHelper:
         elif isinstance(rdf_text, BNode):
             return rdf_text
         elif isinstance(rdf_text, basestring):
-            if URI_P.match(rdf_text.strip()):
-                return URIRef(rdf_text.strip())
-            elif URI_SHORT.match(rdf_text.strip()):
-                prefix, tail = URI_SHORT.match(rdf_text.strip()).groups()
-                try:
-                    return self.uriref_shorthand_uri(prefix, tail)
-                except PrefixNotKnownException:
-                    if return_Literal_not_Exception:
-                        return Literal(rdf_text)
-                    else:
-                        raise URINotSetException
-            if return_Literal_not_Exception:
-                return Literal(rdf_text)
-            else:
-                raise URINotSetException
+            # type is part of the key as str, unicode and Literal values can compare equal
+            return self._cached((type(rdf_text), rdf_text, return_Literal_not_Exception, 'parse'),
+                                self._parse_text, rdf_text, return_Literal_not_Exception)
+
+    def _parse_text(self, rdf_text, return_Literal_not_Exception):
+        text = rdf_text.strip()
+        if URI_P.match(text):
+            return URIRef(text)
+        short = URI_SHORT.match(text)
+        if short:
+            prefix, tail = short.groups()
+            try:
+                return self.uriref_shorthand_uri(prefix, tail)
+            except PrefixNotKnownException:
+                pass
+        if return_Literal_not_Exception:
+            return Literal(rdf_text)
+        else:
+            raise URINotSetException
     
     def uriref_shorthand_uri(self, prefix, tail):
         if prefix not in self.namespaces:
@@ -84,14 +118,20 @@ class URIHelper:
         if isinstance(rdf_text, URIRef):
             return rdf_text
         elif isinstance(rdf_text, basestring):
-            if URI_P.match(rdf_text.strip()):
-                return URIRef(rdf_text.strip())
+            uriref = self._cached((type(rdf_text), rdf_text, 'uriref'), self._text_to_uriref, rdf_text)
+            if uriref is not None:
+                return uriref
         elif force:
             # Force a URIRef to be created
             return URIRef(rdf_text.strip())
         # Not a URIRef nor, recognised as a URI in text.
         raise URINotSetException()
 
+    def _text_to_uriref(self, rdf_text):
+        text = rdf_text.strip()
+        if URI_P.match(text):
+            return URIRef(text)
+
     def get_namespace(self, namespace_uri):
         if namespace_uri.endswith('/') or namespace_uri.endswith('#'):
             return Namespace(self.get_uriref(namespace_uri))
@@ -0,0 +1,64 @@
+import os, sys, shutil, tempfile, threading, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import Silo, AsyncSilo
+from pairtree import FileNotFoundException
+
+class TestAsyncSilo(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.silo = AsyncSilo(Silo(os.path.join(self.tmpdir, "silo")), workers=2)
+
+    def tearDown(self):
+        self.silo.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_calls_on_an_item_run_in_order(self):
+        record = self.silo.get_item("itemone").result()
+        futures = [record.put_stream("file.txt", str(i)) for i in range(20)]
+        [future.result() for future in futures]
+        self.assertEqual(record.get_stream("file.txt").result().read(), "19")
+        self.assertEqual(self.silo._queues, {})
+
+    def test_busy_item_does_not_hold_up_others(self):
+        record = self.silo.get_item("itemone").result()
+        other = self.silo.get_item("itemtwo").result()
+        release = threading.Event()
+        blocked = self.silo._submit_queued("itemone", release.wait, 10)
+        queued = [record.put_stream("file%d.txt" % i, "data") for i in range(5)]
+        try:
+            # Both workers would be taken by itemone if its queued calls waited in the pool
+            other.put_stream("file.txt", "data").result(5)
+            self.assertFalse(blocked.done())
+        finally:
+            release.set()
+        [future.result() for future in queued]
+        self.assertEqual(len(record.files), 5)
+
+    def test_errors_come_back_in_the_future(self):
+        record = self.silo.get_item("itemone").result()
+        future = record.get_range("missing.txt", 0)
+        self.assertRaises(FileNotFoundException, future.result)
+        chunks = record.read_chunks("missing.txt")
+        self.assertRaises(FileNotFoundException, chunks.next().result)
+        self.assertEqual(list(chunks), [])
+
+    def test_read_chunks(self):
+        record = self.silo.get_item("itemone").result()
+        record.put_stream("file.txt", "a" * 1000 + "b" * 5).result()
+        record.put_stream("empty.txt", "").result()
+        chunks = [future.result() for future in record.read_chunks("file.txt", buffer_size=300)]
+        self.assertEqual([len(chunk) for chunk in chunks], [300, 300, 300, 105])
+        self.assertEqual("".join(chunks), "a" * 1000 + "b" * 5)
+        self.assertEqual([future.result() for future in record.read_chunks("empty.txt")], [""])
+
+    def test_batch(self):
+        record = self.silo.get_item("itemone").result()
+        with record.batch():
+            [future.result() for future in [record.put_stream("file%d.txt" % i, "data") for i in range(5)]]
+            self.assertEqual(record.record._batch_depth, 1)
+        self.assertEqual(len(Silo(os.path.join(self.tmpdir, "silo")).get_item("itemone").files), 5)
+
+if __name__ == "__main__":
+    unittest.main()
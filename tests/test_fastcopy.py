@@ -0,0 +1,50 @@
+import os, sys, shutil, stat, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import fastcopy
+from recordsilo.fastcopy import fast_copy, CopyStats
+
+class TestFastCopy(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, "src")
+        self.data = "".join(chr(i % 251) for i in range(100000))
+        with open(self.src, "wb") as f:
+            f.write(self.data)
+        os.chmod(self.src, 0640)
+        self.chunk_size = fastcopy.CHUNK_SIZE
+        # So that the copies take several calls
+        fastcopy.CHUNK_SIZE = 4096
+
+    def tearDown(self):
+        fastcopy.CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.tmpdir)
+
+    def copy_with(self, strategy, **kw):
+        dst = os.path.join(self.tmpdir, strategy)
+        stats = CopyStats()
+        used = fast_copy(self.src, dst, strategies=(strategy,), stats=stats, **kw)
+        if used is None:
+            self.skipTest("%s is not supported here" % strategy)
+        self.assertEqual(used, strategy)
+        self.assertEqual(open(dst, "rb").read(), self.data)
+        self.assertEqual(stat.S_IMODE(os.stat(dst).st_mode), 0640)
+        self.assertEqual(stats.strategies[strategy][:2], (1, len(self.data)))
+
+    def test_copy_file_range(self):
+        self.copy_with("copy_file_range")
+
+    def test_sendfile(self):
+        self.copy_with("sendfile")
+
+    def test_hardlink_only_if_asked_for(self):
+        self.assertEqual(fast_copy(self.src, os.path.join(self.tmpdir, "dst"), strategies=("hardlink",)), None)
+        self.copy_with("hardlink", hardlinks=True)
+
+    def test_nothing_to_try(self):
+        self.assertEqual(fast_copy(self.src, os.path.join(self.tmpdir, "dst"), strategies=()), None)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, "dst")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import Silo
+from recordsilo.itemindex import ItemIndex
+
+class TestItemIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_changes_by_other_writers_are_seen(self):
+        one = ItemIndex(self.tmpdir)
+        two = ItemIndex(self.tmpdir)
+        one.add("item/one")
+        one.add("itemtwo")
+        self.assertTrue("item/one" in two)
+        self.assertEqual(len(two), 2)
+        self.assertEqual(list(two.ids_with_prefix("item")), ["item/one", "itemtwo"])
+        two.remove("item/one")
+        self.assertEqual(list(one), ["itemtwo"])
+        two.rebuild(["itemthree"])
+        self.assertEqual(list(one), ["itemthree"])
+        one.add("itemfour")
+        self.assertEqual(list(two), ["itemfour", "itemthree"])
+
+    def test_line_being_written_is_left_until_complete(self):
+        index = ItemIndex(self.tmpdir)
+        index.add("itemone")
+        with open(index.filepath, "a") as logfile:
+            logfile.write("+itemtw")
+        self.assertEqual(list(index), ["itemone"])
+        with open(index.filepath, "a") as logfile:
+            logfile.write("o\n")
+        self.assertEqual(list(index), ["itemone", "itemtwo"])
+
+    def test_silos_sharing_an_index(self):
+        one = Silo(os.path.join(self.tmpdir, "silo"), item_index=True)
+        two = Silo(os.path.join(self.tmpdir, "silo"), item_index=True)
+        one.get_item("itemone")
+        self.assertTrue(two.exists("itemone"))
+        self.assertEqual(len(two), 1)
+        one.del_item("itemone")
+        self.assertFalse(two.exists("itemone"))
+        self.assertEqual(two.keys(), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os, sys, shutil, tempfile, unittest
+
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import Silo
+from recordsilo.itemlock import ItemLock, LockTimeout, LockUpgradeError
+
+def _writer(silo_dir, n):
+    record = Silo(silo_dir, locking=True, manifest_fsync=False).get_item("shared")
+    for i in range(10):
+        record.put_stream("file_%d_%d.txt" % (n, i), "data")
+
+class TestItemLock(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_and_exclusive(self):
+        one, two, three = [ItemLock(self.tmpdir) for i in range(3)]
+        one.acquire("r")
+        two.acquire("r", timeout=0.5)
+        self.assertRaises(LockTimeout, three.acquire, "w", 0.1)
+        one.release()
+        two.release()
+        three.acquire("w", timeout=0.5)
+        self.assertRaises(LockTimeout, one.acquire, "r", 0.1)
+        three.release()
+
+    def test_reentrant_but_no_upgrade(self):
+        lock = ItemLock(self.tmpdir)
+        lock.acquire("w")
+        lock.acquire("r")
+        lock.acquire("w")
+        self.assertEqual(lock.depth, 3)
+        [lock.release() for i in range(3)]
+        self.assertFalse(lock.held())
+        lock.acquire("r")
+        self.assertRaises(LockUpgradeError, lock.acquire, "w")
+        self.assertEqual(lock.depth, 1)
+        lock.release()
+
+    def test_writers_in_several_processes(self):
+        silo_dir = os.path.join(self.tmpdir, "silo")
+        Silo(silo_dir).get_item("shared")
+        writers = [Process(target=_writer, args=(silo_dir, n)) for n in range(4)]
+        [p.start() for p in writers]
+        [p.join() for p in writers]
+        self.assertEqual(len(Silo(silo_dir).get_item("shared").files), 40)
+
+    def test_manifest_is_reread_on_locking(self):
+        silo_dir = os.path.join(self.tmpdir, "silo")
+        one = Silo(silo_dir, locking=True).get_item("itemone")
+        two = Silo(silo_dir, locking=True).get_item("itemone")
+        one.put_stream("a.txt", "aaa")
+        two.put_stream("b.txt", "bbb")
+        self.assertEqual(sorted(two.files), ["a.txt", "b.txt"])
+        with one.lock("r"):
+            self.assertEqual(sorted(one.files), ["a.txt", "b.txt"])
+
+if __name__ == "__main__":
+    unittest.main()
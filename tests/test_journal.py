@@ -0,0 +1,55 @@
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import Silo
+from recordsilo.journal import Journal
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_segments_roll_over_and_are_pruned(self):
+        journal = Journal(self.tmpdir, segment_size=200)
+        for i in range(20):
+            self.assertEqual(journal.append("item%d" % i, "put", "1", "file.txt"), i + 1)
+        segments = journal.segments()
+        self.assertTrue(len(segments) > 2)
+        self.assertEqual(segments[0][0], 1)
+        self.assertEqual([c.seq for c in journal.changes()], range(1, 21))
+        self.assertEqual([c.item_id for c in journal.changes(since=15)], ["item%d" % i for i in range(15, 20)])
+        # Another writer picks up where the segments leave off
+        self.assertEqual(Journal(self.tmpdir, segment_size=200).append("item", "del_item"), 21)
+        journal.prune(15)
+        self.assertTrue(journal.segments()[0][0] <= 16)
+        self.assertEqual([c.seq for c in journal.changes(since=15)], range(16, 22))
+        self.assertEqual(journal.last_seq(), 21)
+
+    def test_torn_line_is_skipped(self):
+        journal = Journal(self.tmpdir)
+        journal.append("itemone", "put", "1", "a.txt")
+        with open(journal.segments()[-1][1], "ab") as segment:
+            # An append cut short by a crash
+            segment.write('[2,"2011-01-01T00:00:00","itemtwo",')
+        self.assertEqual([c.seq for c in journal.changes()], [1])
+        self.assertEqual(Journal(self.tmpdir).append("itemthree", "put", "1", "b.txt"), 2)
+        self.assertEqual([(c.seq, c.item_id) for c in journal.changes()], [(1, "itemone"), (2, "itemthree")])
+
+    def test_silo_changes(self):
+        silo = Silo(os.path.join(self.tmpdir, "silo"), journal=True)
+        start = silo.journal_position()
+        record = silo.get_item("itemone")
+        record.put_stream("a.txt", "aaa")
+        record.increment_version()
+        record.del_stream("a.txt", versions=["1"])
+        silo.del_item("itemone")
+        self.assertEqual([(c.item_id, c.op, c.version, c.filename) for c in silo.changes(start)],
+                         [("itemone", "create_item", "1", None), ("itemone", "put", "1", "a.txt"),
+                          ("itemone", "new_version", "2", None), ("itemone", "del", "1", "a.txt"),
+                          ("itemone", "del_item", None, None)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import Silo
+from recordsilo.persiststate import PersistentState, BACKUP_SUFFIX
+
+class TestBackupRecovery(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_missing_file_is_recovered_from_backup(self):
+        ps = PersistentState(self.tmpdir, "state.json", keep_backup=True)
+        ps['a'] = 1
+        ps.sync()
+        ps['a'] = 2
+        ps.sync()
+        os.remove(ps.filepath)
+        recovered = PersistentState(self.tmpdir, "state.json", keep_backup=True)
+        self.assertTrue(recovered.recovered)
+        self.assertEqual(recovered['a'], 1)
+        # The backup is not overwritten by the recovered state's first sync
+        recovered.sync()
+        self.assertEqual(PersistentState(self.tmpdir, "state.json")['a'], 1)
+        self.assertTrue(os.path.isfile(ps.filepath + BACKUP_SUFFIX))
+
+    def test_missing_item_manifest_is_recovered(self):
+        silo = Silo(os.path.join(self.tmpdir, "silo"), manifest_backup=True)
+        record = silo.get_item("itemone")
+        record.put_stream("fileone.txt", "one")
+        record.put_stream("filetwo.txt", "two")
+        os.remove(os.path.join(record.itempath, "__manifest.json"))
+        record = Silo(os.path.join(self.tmpdir, "silo"), manifest_backup=True).get_item("itemone")
+        self.assertFalse(record.created)
+        self.assertTrue(record.manifest.recovered)
+        self.assertTrue("fileone.txt" in record.files)
+
+    def test_missing_file_without_backup_starts_empty(self):
+        ps = PersistentState(self.tmpdir, "state.json")
+        self.assertFalse(ps.recovered)
+        self.assertEqual(len(ps), 0)
+        self.assertTrue(os.path.isfile(ps.filepath))
+
+class TestChangeTracking(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_unchanged_state_is_not_rewritten(self):
+        ps = PersistentState(self.tmpdir, "state.json", track_changes=True)
+        ps['a'] = 1
+        self.assertTrue(ps.is_dirty())
+        self.assertTrue(ps.sync())
+        self.assertFalse(ps.is_dirty())
+        self.assertEqual(ps['a'], 1)
+        self.assertFalse(ps.sync())
+
+    def test_in_place_change_is_written(self):
+        ps = PersistentState(self.tmpdir, "state.json", track_changes=True)
+        ps['d'] = {}
+        ps.sync()
+        ps['d']['k'] = 1
+        self.assertTrue(ps.is_dirty())
+        self.assertTrue(ps.sync())
+        self.assertEqual(PersistentState(self.tmpdir, "state.json")['d'], {'k':1})
+        # Only looked at
+        ps['d']
+        self.assertFalse(ps.is_dirty())
+        self.assertFalse(ps.sync())
+
+    def test_in_place_metadata_change_is_synced(self):
+        for split in (False, True):
+            silo_dir = os.path.join(self.tmpdir, "silo%s" % split)
+            record = Silo(silo_dir, split_manifest=split).get_item("itemone")
+            record.put_stream("fileone.txt", "one")
+            record.metadata['title'] = "One"
+            record.sync()
+            record.manifest['metadata']['creator'] = "Someone"
+            record.sync()
+            record['metadata']['date'] = "2011"
+            record.sync()
+            record.manifest['versionlog'][record.currentversion].append("Checked")
+            record.sync()
+            record = Silo(silo_dir, split_manifest=split).get_item("itemone")
+            self.assertEqual(record.manifest['metadata']['title'], "One")
+            self.assertEqual(record.manifest['metadata']['creator'], "Someone")
+            self.assertEqual(record.manifest['metadata']['date'], "2011")
+            self.assertEqual(record.manifest['versionlog'][record.currentversion][-1], "Checked")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import os, sys, shutil, tempfile, time, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rdflib import Literal
+from rdflib.compare import isomorphic
+
+from recordsilo import RDFSilo, RDFManifest
+from recordsilo import rdfmanifest
+from recordsilo.rdfmanifest import sidecar_path
+
+class TestSidecar(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.silo_dir = os.path.join(self.tmpdir, "silo")
+        self.record = RDFSilo(self.silo_dir).get_item("itemone")
+        self.record.put_stream("fileone.txt", "one")
+        self.record.add_triple(self.record.uri, "dcterms:title", Literal(u"Caf\xe9", lang="fr"))
+        self.record.add_triple(self.record.uri, "dcterms:extent", Literal(42))
+        self.record.sync()
+        self.rdfpath = self.record._path_to_rdfmanifest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sidecar_loads_the_same_graph(self):
+        self.assertTrue(os.path.isfile(sidecar_path(self.rdfpath)))
+        cached = RDFManifest(self.rdfpath)
+        self.assertTrue(cached._load_sidecar())
+        self.assertFalse(cached.dirty)
+        self.assertTrue(isomorphic(cached.g, RDFManifest(self.rdfpath, sidecar=False).g))
+
+    def test_out_of_date_or_damaged_sidecar_is_not_used(self):
+        other = RDFManifest(self.rdfpath, sidecar=False)
+        other.add_triple(self.record.uri, "dcterms:creator", "Someone")
+        time.sleep(0.01)
+        other.sync()
+        manifest = RDFManifest(self.rdfpath)
+        self.assertTrue(manifest.triple_exists(self.record.uri, "dcterms:creator", "Someone"))
+        with open(sidecar_path(self.rdfpath), "wb") as sidecar_file:
+            sidecar_file.write("garbage")
+        manifest = RDFManifest(self.rdfpath)
+        self.assertTrue(manifest.triple_exists(self.record.uri, "dcterms:creator", "Someone"))
+        # Rewritten from the parsed graph
+        self.assertTrue(RDFManifest(self.rdfpath)._load_sidecar())
+
+    def test_sidecar_and_temp_files_are_not_content(self):
+        # A sync that dies between writing its temp file and renaming it into place
+        def crash(src, dst):
+            raise OSError("crashed")
+        rename, remove = rdfmanifest.rename, rdfmanifest.remove
+        rdfmanifest.rename, rdfmanifest.remove = crash, lambda filepath: None
+        try:
+            self.record.add_triple(self.record.uri, "dcterms:creator", "Someone")
+            self.assertRaises(OSError, self.record.sync)
+        finally:
+            rdfmanifest.rename, rdfmanifest.remove = rename, remove
+        leftovers = [name for name in os.listdir(os.path.dirname(self.rdfpath)) if name.startswith("manifest.rdf.")]
+        self.assertEqual(len(leftovers), 1)
+        record = RDFSilo(self.silo_dir).get_item("itemone")
+        record.resync_from_disk()
+        self.assertEqual(sorted(record.files), ["fileone.txt", "manifest.rdf"])
+        new_version = record.increment_version(clone_previous_version=True)
+        self.assertEqual(sorted(record.manifest['files'][new_version]), ["fileone.txt", "manifest.rdf"])
+        self.assertFalse([name for name in os.listdir(record.to_dirpath(version=new_version)) if name.startswith("manifest.rdf.")])
+
+class TestDirtyTracking(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmpdir, "manifest.rdf")
+        self.uri = "http://example.org/item"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_only_changes_are_written(self):
+        manifest = RDFManifest(self.filepath, uri=self.uri)
+        manifest.add_triple(self.uri, "dcterms:title", "Title")
+        self.assertTrue(manifest.sync())
+        self.assertFalse(manifest.sync())
+        manifest = RDFManifest(self.filepath, uri=self.uri)
+        self.assertFalse(manifest.dirty)
+        # Already there, or nothing to delete
+        manifest.add_triple(self.uri, "dcterms:title", "Title")
+        manifest.del_triple(self.uri, "dcterms:creator", "Someone")
+        self.assertFalse(manifest.sync())
+        manifest.del_triple(self.uri, "dcterms:title", "*")
+        self.assertTrue(manifest.sync())
+        self.assertFalse(RDFManifest(self.filepath, uri=self.uri).triple_exists(self.uri, "dcterms:title", "Title"))
+
+if __name__ == "__main__":
+    unittest.main()
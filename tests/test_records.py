@@ -0,0 +1,269 @@
+import os, sys, shutil, tempfile, hashlib, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import Silo
+from pairtree import FileNotFoundException
+
+class TestFileLists(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.silo_dir = os.path.join(self.tmpdir, "silo")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertListsMatchDisc(self, record):
+        """The file lists kept up as files were written are those a rescan of the disc gives."""
+        kept = dict((v, (sorted(record.manifest['files'][v]), sorted(record.manifest['subdir'][v])))
+                    for v in record.manifest['versions'])
+        rescanned = Silo(self.silo_dir).get_item(record.item_id)
+        rescanned.resync_from_disk()
+        for v in record.manifest['versions']:
+            self.assertEqual(kept[v], (sorted(rescanned.manifest['files'][v]), sorted(rescanned.manifest['subdir'][v])))
+
+    def test_lists_follow_writes_and_deletes(self):
+        record = Silo(self.silo_dir).get_item("itemone")
+        record.put_stream("a.txt", "aaa")
+        record.put_stream("a.txt", "again")
+        record.put_stream("mods.xml", "<mods/>", metadata=True)
+        record.put_stream("sub/c.txt", "ccc")
+        record.put_stream("sub/deeper/d.txt", "ddd")
+        self.assertEqual(sorted(record.files), ["a.txt", "mods.xml", "sub"])
+        self.assertEqual(record.manifest['subdir'][record.currentversion], ["sub"])
+        self.assertEqual(record.manifest['metadata_files'][record.currentversion], ["mods.xml"])
+        self.assertListsMatchDisc(record)
+        record.del_stream("sub/c.txt")
+        self.assertEqual(sorted(record.files), ["a.txt", "mods.xml", "sub"])
+        record.del_stream("a.txt")
+        self.assertEqual(sorted(record.files), ["mods.xml", "sub"])
+        self.assertListsMatchDisc(record)
+        record.increment_version(clone_previous_version=True)
+        record.put_stream("b.txt", "bbb")
+        self.assertListsMatchDisc(record)
+        # Persisted, not just held in memory
+        self.assertEqual(sorted(Silo(self.silo_dir).get_item("itemone").files), ["b.txt", "mods.xml", "sub"])
+
+    def test_lists_follow_writes_in_a_batch(self):
+        record = Silo(self.silo_dir).get_item("itemone")
+        with record.batch():
+            for i in range(50):
+                record.put_stream("file%02d.txt" % i, "data")
+            record.del_stream("file10.txt")
+        self.assertEqual(len(record.files), 49)
+        self.assertListsMatchDisc(record)
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.silo_dir = os.path.join(self.tmpdir, "silo")
+        self.record = Silo(self.silo_dir).get_item("itemone")
+        self.writes = []
+        self.record.sync_listeners.append(self.writes.append)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def stored_files(self):
+        return sorted(Silo(self.silo_dir).get_item("itemone").files)
+
+    def test_manifest_is_written_once_on_exit(self):
+        with self.record.batch():
+            with self.record.batch():
+                for i in range(10):
+                    self.record.put_stream("file%d.txt" % i, "data")
+            self.assertEqual(self.stored_files(), [])
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(len(self.stored_files()), 10)
+
+    def test_flush_every(self):
+        with self.record.batch(flush_every=4):
+            for i in range(10):
+                self.record.put_stream("file%d.txt" % i, "data")
+                self.assertEqual(len(self.stored_files()), (i + 1) // 4 * 4)
+        self.assertEqual(len(self.writes), 3)
+        self.assertEqual(len(self.stored_files()), 10)
+
+    def test_written_on_error(self):
+        try:
+            with self.record.batch():
+                self.record.put_stream("file.txt", "data")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.stored_files(), ["file.txt"])
+
+class TestVersionCloning(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def clone_with_subdir(self, **kw):
+        record = Silo(os.path.join(self.tmpdir, "silo"), **kw).get_item("itemone")
+        record.put_stream("a.txt", "aaa")
+        record.put_stream("sub/c.txt", "ccc")
+        new_version = record.increment_version(clone_previous_version=True)
+        self.assertEqual(record.currentversion, new_version)
+        self.assertEqual(sorted(record.files), ["a.txt", "sub"])
+        self.assertEqual(record.manifest['subdir'][new_version], ["sub"])
+        self.assertEqual(str(record.get_range("sub/c.txt", 0, 3)), "ccc")
+        self.assertRaises(FileNotFoundException, record.get_range, "a.txt/c.txt", 0, 3)
+        return record
+
+    def test_clone_registers_subdirectories(self):
+        self.clone_with_subdir()
+
+    def test_clone_by_hardlink_registers_subdirectories(self):
+        self.clone_with_subdir(copy_hardlinks=True)
+
+class TestFixity(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.silo_dir = os.path.join(self.tmpdir, "silo")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_checksums_are_taken_as_files_are_written(self):
+        record = Silo(self.silo_dir, checksums=["md5", "sha256"]).get_item("itemone")
+        record.put_stream("a.txt", iter(["a" * 10, "b" * 5]))
+        self.assertEqual(record.checksums()["a.txt"], {'size':15, 'md5':hashlib.md5("a" * 10 + "b" * 5).hexdigest(),
+                                                        'sha256':hashlib.sha256("a" * 10 + "b" * 5).hexdigest()})
+        record.put_stream("sub/c.txt", "ccc")
+        self.assertTrue("sub/c.txt" in record.checksums())
+        record.del_stream("a.txt")
+        self.assertFalse("a.txt" in record.checksums())
+
+    def test_verify_finds_changed_and_missing_files(self):
+        record = Silo(self.silo_dir, checksums="sha1").get_item("itemone")
+        record.put_stream("a.txt", "aaa")
+        record.put_stream("b.txt", "bbb")
+        record.put_stream("c.txt", "ccc")
+        self.assertEqual(record.verify(), [])
+        with open(record.to_dirpath("a.txt"), "wb") as f:
+            f.write("changed behind its back")
+        os.remove(record.to_dirpath("b.txt"))
+        found = dict((m.filename, m.found) for m in record.verify(workers=2))
+        self.assertEqual(sorted(found), ["a.txt", "b.txt"])
+        self.assertEqual(found["a.txt"]['sha1'], hashlib.sha1("changed behind its back").hexdigest())
+        self.assertEqual(found["b.txt"], None)
+
+    def test_update_checksums_for_files_written_without(self):
+        record = Silo(self.silo_dir).get_item("itemone")
+        record.put_stream("a.txt", "aaa")
+        self.assertEqual(record.checksums(), {})
+        record.update_checksums(algorithms="md5")
+        self.assertEqual(record.checksums()["a.txt"]['md5'], hashlib.md5("aaa").hexdigest())
+        self.assertEqual(Silo(self.silo_dir).get_item("itemone").verify(), [])
+
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.silo = Silo(os.path.join(self.tmpdir, "silo"), dedup=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def blob_count(self, record):
+        return sum(len(files) for root, dirs, files in os.walk(record.blobs.dirpath))
+
+    def test_identical_contents_are_stored_once(self):
+        record = self.silo.get_item("itemone")
+        record.put_stream("a.txt", "same")
+        record.put_stream("b.txt", "same")
+        self.assertEqual(os.stat(record.to_dirpath("a.txt")).st_ino, os.stat(record.to_dirpath("b.txt")).st_ino)
+        self.assertEqual(self.blob_count(record), 1)
+
+    def test_clone_links_files_and_subdirectories(self):
+        record = self.silo.get_item("itemone")
+        record.put_stream("a.txt", "aaa")
+        record.put_stream("sub/c.txt", "ccc")
+        old_version = record.currentversion
+        new_version = record.increment_version(clone_previous_version=True)
+        self.assertEqual(self.blob_count(record), 2)
+        self.assertEqual(os.stat(record.to_dirpath("sub/c.txt", version=old_version)).st_ino,
+                         os.stat(record.to_dirpath("sub/c.txt", version=new_version)).st_ino)
+        self.assertEqual(record.manifest['subdir'][new_version], ["sub"])
+        self.assertEqual(str(record.get_range("sub/c.txt", 0, 3)), "ccc")
+
+    def test_writing_in_place_does_not_change_other_versions(self):
+        record = self.silo.get_item("itemone")
+        record.put_stream("a.txt", "aaa")
+        old_version = record.currentversion
+        record.increment_version(clone_previous_version=True)
+        with record.get_stream("a.txt", writeable=True) as f:
+            f.write("bbb")
+        self.assertEqual(record.get_stream("a.txt", version=old_version).read(), "aaa")
+
+    def test_unused_blobs_are_removed(self):
+        record = self.silo.get_item("itemone")
+        record.put_stream("a.txt", "aaa")
+        old_version = record.currentversion
+        record.increment_version()
+        record.put_stream("b.txt", "bbb")
+        self.assertEqual(self.blob_count(record), 2)
+        record.del_version(old_version)
+        self.assertEqual(self.blob_count(record), 1)
+        # Left behind by a writer that went away before releasing it
+        os.link(record.to_dirpath("b.txt"), os.path.join(self.tmpdir, "elsewhere"))
+        record.del_stream("b.txt")
+        self.assertEqual(self.blob_count(record), 1)
+        os.remove(os.path.join(self.tmpdir, "elsewhere"))
+        self.assertEqual(record.collect_garbage(), 1)
+        self.assertEqual(self.blob_count(record), 0)
+
+class TestSplitManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.silo_dir = os.path.join(self.tmpdir, "silo")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_item(self, **kw):
+        record = Silo(self.silo_dir, **kw).get_item("itemone")
+        record.put_stream("a.txt", "aaa")
+        record.increment_version(clone_previous_version=True)
+        record.put_stream("b.txt", "bbb")
+        return record
+
+    def test_versions_are_kept_in_their_own_manifests(self):
+        record = self.make_item(split_manifest=True)
+        self.assertEqual(record.manifest.state['manifest_layout'], 2)
+        self.assertFalse('files' in record.manifest.state)
+        self.assertTrue(os.path.isfile(os.path.join(record.to_dirpath(version="1"), "__version.json")))
+        record = Silo(self.silo_dir).get_item("itemone")
+        self.assertEqual(record.manifest.loaded_versions(), [])
+        self.assertEqual(sorted(record.files), ["a.txt", "b.txt"])
+        self.assertEqual(record.manifest['files']["1"], ["a.txt"])
+
+    def test_convert_both_ways(self):
+        record = self.make_item()
+        self.assertTrue(record.set_manifest_layout(True))
+        self.assertFalse(record.set_manifest_layout(True))
+        record = Silo(self.silo_dir).get_item("itemone")
+        self.assertTrue(record.manifest.split)
+        self.assertEqual(record.manifest['files']["1"], ["a.txt"])
+        self.assertTrue(record.set_manifest_layout(False))
+        self.assertFalse(os.path.exists(os.path.join(record.to_dirpath(version="1"), "__version.json")))
+        record = Silo(self.silo_dir).get_item("itemone")
+        self.assertFalse(record.manifest.split)
+        self.assertEqual(record.manifest['files']["1"], ["a.txt"])
+        self.assertEqual(sorted(record.manifest['files']["2"]), ["a.txt", "b.txt"])
+
+    def test_version_manifest_files_are_not_content(self):
+        record = self.make_item(split_manifest=True, manifest_backup=True)
+        version_dir = record.to_dirpath(version=record.currentversion)
+        self.assertTrue(os.path.isfile(os.path.join(version_dir, "__version.json.bak")))
+        # As left by a sync that was interrupted
+        open(os.path.join(version_dir, "__version.json.123.456.tmp"), "w").close()
+        record.resync_from_disk()
+        self.assertEqual(sorted(record.files), ["a.txt", "b.txt"])
+        new_version = record.increment_version(clone_previous_version=True)
+        self.assertEqual(sorted(record.manifest['files'][new_version]), ["a.txt", "b.txt"])
+        self.assertFalse(os.path.exists(os.path.join(record.to_dirpath(version=new_version), "__version.json.123.456.tmp")))
+
+if __name__ == "__main__":
+    unittest.main()
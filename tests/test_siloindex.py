@@ -0,0 +1,71 @@
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from recordsilo import Silo
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.silo_dir = os.path.join(self.tmpdir, "silo")
+        self.silo = Silo(self.silo_dir, search_index=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_metadata_changed_in_place_is_indexed(self):
+        record = self.silo.get_item("itemone")
+        record.metadata['title'] = "One"
+        record.sync()
+        record.manifest['metadata']['title'] = "Two"
+        record['metadata']['creator'] = {'name': "Someone"}
+        record.sync()
+        self.assertEqual(self.silo.query(metadata={'title': "One"}), [])
+        self.assertEqual(self.silo.query(metadata={'title': "Two", 'creator.name': "Someone"}), ["itemone"])
+        # What was indexed is what was written
+        record = Silo(self.silo_dir).get_item("itemone")
+        self.assertEqual(record.metadata['title'], "Two")
+
+    def rows(self):
+        index = self.silo._search_index
+        return dict((table, sorted(index._db.execute("SELECT * FROM %s" % table).fetchall()))
+                    for table in ("items", "versions", "files", "metadata"))
+
+    def test_updates_match_a_rebuild(self):
+        for split in (False, True):
+            silo = Silo(self.silo_dir, search_index=True, split_manifest=split)
+            record = silo.get_item("item%s" % split)
+            record.put_stream("a.txt", "aaa")
+            record.metadata['title'] = "Title"
+            record.sync()
+            record.increment_version(clone_previous_version=True)
+            record.put_stream("b.txt", "bbb")
+            with record.batch():
+                record.increment_version(clone_previous_version=True)
+                record.del_stream("a.txt")
+            record.del_version("1")
+            record.rename_version("2", "two")
+            record.set_version_date("3", "2011-01-01T00:00:00")
+            silo.get_item("other%s" % split).put_stream("c.txt", "ccc")
+        updated = self.rows()
+        self.silo.rebuild_search_index(workers=1)
+        self.assertEqual(updated, self.rows())
+
+    def test_queries(self):
+        for i in range(5):
+            record = self.silo.get_item("item%d" % i)
+            record.put_stream("file%d.txt" % i, "data")
+            record.metadata['type'] = i % 2 and "odd" or "even"
+            record.metadata['title'] = "Title %d" % i
+            record.set_version_date(record.currentversion, "2011-01-0%dT00:00:00" % (i + 1))
+            record.sync()
+        self.assertEqual(self.silo.query(metadata={'type':"odd"}), ["item1", "item3"])
+        self.assertEqual(self.silo.query(prefix={'title':"Title "}, limit=2, offset=1), ["item1", "item2"])
+        self.assertEqual(self.silo.query(filename="file4.txt"), ["item4"])
+        self.assertEqual(self.silo.query(version_date_from="2011-01-02", version_date_to="2011-01-03T23"), ["item1", "item2"])
+        self.assertEqual(self.silo.query(item_prefix="item3"), ["item3"])
+        self.silo.del_item("item3")
+        self.assertEqual(self.silo.query(metadata={'type':"odd"}), ["item1"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rdflib import URIRef, Literal
+
+from recordsilo import RDFSilo
+
+class TestTripleIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.silo_dir = os.path.join(self.tmpdir, "silo")
+        self.silo = RDFSilo(self.silo_dir, triple_index=True, manifest_fsync=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def rows(self):
+        return sorted(self.silo._triple_index._db.execute("SELECT * FROM quads").fetchall())
+
+    def test_deltas_match_a_rebuild(self):
+        record = self.silo.get_item("itemone")
+        record.put_stream("one.txt", "1")
+        record.add_triple(record.uri, "dcterms:title", "Title")
+        record.add_triples([(record.uri, "dcterms:subject", "s%d" % i) for i in range(5)])
+        record.sync()
+        record.del_triple(record.uri, "dcterms:subject", "s1")
+        # Added and removed again before the write
+        record.add_triple(record.uri, "dcterms:creator", "Someone")
+        record.del_triple(record.uri, "dcterms:creator", "*")
+        record.sync()
+        # Changed through the graph itself, so not known as a delta
+        record.get_graph().add((URIRef(record.uri), URIRef("http://purl.org/dc/terms/rights"), Literal("Rights")))
+        record.sync()
+        record.del_stream("one.txt")
+        record.increment_version(clone_previous_version=True)
+        record.add_triple(record.uri, "dcterms:title", "Second")
+        record.sync()
+        # Another record object for the same item
+        other = RDFSilo(self.silo_dir, triple_index=True).get_item("itemone")
+        other.add_triple(other.uri, "dcterms:title", "Third")
+        other.sync()
+        self.silo.get_item("itemtwo").add_triple("http://example.org/x", "dcterms:title", "Title")
+        self.silo.get_item("itemtwo").sync()
+        updated = self.rows()
+        self.silo.rebuild_triple_index(workers=1)
+        self.assertEqual(updated, self.rows())
+
+    def test_queries(self):
+        for item_id in ("itemone", "itemtwo"):
+            record = self.silo.get_item(item_id)
+            record.put_stream("file.txt", "data")
+            record.add_triple(record.uri, "dcterms:title", "Title of %s" % item_id)
+            record.sync()
+        one = self.silo.get_item("itemone")
+        self.assertEqual(self.silo.find_items(p="ore:aggregates"), ["itemone", "itemtwo"])
+        self.assertEqual(self.silo.find_items(o="%s/file.txt" % one.uri), ["itemone"])
+        titles = list(self.silo.triples(p="dcterms:title", item_id="itemone"))
+        self.assertEqual(titles, [("itemone", (URIRef(one.uri), URIRef("http://purl.org/dc/terms/title"), Literal("Title of itemone")))])
+        self.silo.del_item("itemone")
+        self.assertEqual(self.silo.find_items(p="ore:aggregates"), ["itemtwo"])
+
+if __name__ == "__main__":
+    unittest.main()